@@ -0,0 +1,111 @@
+import math
+
+# time constant of the fast moving average, relative to the slow one
+FAST_RATIO = 0.25
+
+
+class AdaptiveRate:
+    """Chooses the period of a loop from the dynamics of its filtered output
+
+    The rate of change and the variance of the signal are tracked online with exponentially
+    weighted estimates over time_constant seconds. The rate of change is the gap between a fast
+    and a slow moving average divided by the gap of their lags, which is exact on a ramp and far
+    less noisy than differencing consecutive values at short periods. When either goes over its threshold, the
+    period drops to min_period at once. Once both have stayed under fall_ratio of their
+    thresholds for hold_second, the period doubles, and again after every further hold_second,
+    up to max_period. The gap between the rise and fall thresholds and the hold keep the rate
+    from flapping around a threshold.
+    """
+
+    def __init__(self, min_period: float, max_period: float, slope_threshold: float, std_threshold: float = 0.0,
+                 fall_ratio: float = 0.5, hold_second: float = 2.0, time_constant: float = 1.0):
+        """Initialize at the max period
+
+        Args:
+            min_period (float): fastest period in seconds, used while the signal moves
+            max_period (float): slowest period in seconds, used while the signal is steady
+            slope_threshold (float): rate of change per second above which the signal moves
+            std_threshold (float, optional): standard deviation above which the signal moves, 0 to ignore. Defaults to 0.0.
+            fall_ratio (float, optional): fraction of the thresholds under which the signal is steady again. Defaults to 0.5.
+            hold_second (float, optional): seconds the signal must stay steady before each doubling of the period. Defaults to 2.0.
+            time_constant (float, optional): seconds of history of the slope and variance estimates. Defaults to 1.0.
+        """
+        self.min_period = min_period
+        self.max_period = max_period
+        self.slope_threshold = slope_threshold
+        self.std_threshold = std_threshold
+        self.fall_ratio = fall_ratio
+        self.hold_second = hold_second
+        self.time_constant = time_constant
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the signal history and return to the max period"""
+        self.period = self.max_period
+        self.last_time = math.nan
+        self.fast_mean = math.nan
+        self.mean = math.nan
+        self.variance = 0.0
+        self.steady_since = math.nan
+
+    @property
+    def slope(self) -> float:
+        """Rate of change estimate of the signal per second"""
+        if math.isnan(self.mean):
+            return 0.0
+        return (self.fast_mean - self.mean) / (self.time_constant - self.time_constant * FAST_RATIO)
+
+    @property
+    def std(self) -> float:
+        """Standard deviation estimate of the signal"""
+        return math.sqrt(self.variance)
+
+    def is_moving(self, ratio: float = 1.0) -> bool:
+        """Check if the slope or the standard deviation is above a fraction of its threshold
+
+        Args:
+            ratio (float, optional): fraction of the thresholds. Defaults to 1.0.
+        """
+        if abs(self.slope) > ratio * self.slope_threshold:
+            return True
+        return self.std_threshold > 0 and self.std > ratio * self.std_threshold
+
+    def update(self, value: float, now: float) -> float:
+        """Take the filtered value of a tick and get the period of the next tick
+
+        Args:
+            value (float): filtered value, nan is ignored
+            now (float): monotonic time of the value in seconds
+
+        Returns:
+            float: period in seconds
+        """
+        if math.isnan(value):
+            return self.period
+
+        if math.isnan(self.mean):
+            self.fast_mean = self.mean = value
+        else:
+            dt = now - self.last_time
+            if dt > 0:
+                # weights of the new value for each time constant, whatever the period
+                alpha = 1.0 - math.exp(-dt / self.time_constant)
+                fast_alpha = 1.0 - math.exp(-dt / (self.time_constant * FAST_RATIO))
+                self.fast_mean += fast_alpha * (value - self.fast_mean)
+                delta = value - self.mean
+                self.mean += alpha * delta
+                self.variance = (1.0 - alpha) * (self.variance + alpha * delta * delta)
+        self.last_time = now
+
+        if self.is_moving():
+            self.period = self.min_period
+            self.steady_since = math.nan
+        elif self.is_moving(self.fall_ratio):
+            # between the thresholds, keep the current period
+            self.steady_since = math.nan
+        elif math.isnan(self.steady_since):
+            self.steady_since = now
+        elif now - self.steady_since >= self.hold_second:
+            self.period = min(self.max_period, self.period * 2)
+            self.steady_since = now
+        return self.period
@@ -0,0 +1,276 @@
+import fcntl
+import threading
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Dict, Optional, Union
+from decouple import config
+from instrumentation import METRICS, Logger
+from sampler import SampleRing
+
+if TYPE_CHECKING:
+    import adafruit_ads1x15.ads1115 as ADS
+    from adc_backends import ADCBackend
+
+log = Logger("adc")
+
+# single ended inputs of the ADS1115, the values of ADS.P0 to ADS.P3
+P0, P1, P2, P3 = 0, 1, 2, 3
+
+# input of the temperature sensor, see temp_sensors.py
+TEMPERATURE_ADDRESS = 0x48
+TEMPERATURE_PIN = P3
+
+# full scale volts of each ADC gain, as in adafruit_ads1x15.analog_in, which is only imported with the ADC
+PGA_RANGE = {2 / 3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+
+# busio.I2C of the process, board and busio detect the platform so they are only imported with the bus
+_i2c = None
+_managers: Dict[int, "ADCManager"] = dict()
+
+
+def get_i2c():
+    """Get the I2C bus of the process, created on first use
+
+    Returns:
+        busio.I2C: the I2C bus
+    """
+    global _i2c
+    if _i2c is None:
+        import board
+        import busio
+        _i2c = busio.I2C(board.SCL, board.SDA)
+    return _i2c
+
+
+def create_ads(address: int = 0x48, gain: float = 1, data_rate: Optional[int] = None,
+               backend: Optional[str] = None) -> Union["ADS.ADS1115", "ADCBackend"]:
+    """Create the ADS1115 at an address in single shot mode, or its stand-in without hardware, see adc_backends.py
+
+    The driver of the ADS1115 and the stand-ins are imported with the first ADC of their kind.
+
+    Args:
+        address (int, optional): I2C address of the ADS1115. Defaults to 0x48.
+        gain (float, optional): ADC gain. Defaults to 1.
+        data_rate (Optional[int], optional): conversion data rate. Defaults to the ADS1115 default of 128.
+        backend (Optional[str], optional): ads1115, synthetic[:SEED[:STEP]] or replay:PATH[:SPEED]. Defaults to the ADC_BACKEND env variable or ads1115.
+
+    Raises:
+        ValueError: if the backend is invalid
+
+    Returns:
+        Union[ADS.ADS1115, ADCBackend]: the ADC
+    """
+    backend = config('ADC_BACKEND', default='ads1115') if backend is None else backend
+    if backend.strip().lower() == 'ads1115':
+        import adafruit_ads1x15.ads1115 as ADS
+        from adafruit_ads1x15.ads1x15 import Mode
+        return ADS.ADS1115(get_i2c(), gain=gain, data_rate=data_rate, mode=Mode.SINGLE, address=address)
+
+    from adc_backends import create_adc_backend
+    return create_adc_backend(backend, address, gain)
+
+
+def get_adc_manager(address: int = 0x48) -> "ADCManager":
+    """Get the manager of the ADS1115 at an address, created on first use
+
+    The lock file shared with other processes using the same ADC is read from the ADC_LOCK_FILE env variable.
+
+    Args:
+        address (int, optional): I2C address of the ADS1115. Defaults to 0x48.
+
+    Returns:
+        ADCManager: the manager owning the ADC
+    """
+    if address not in _managers:
+        _managers[address] = ADCManager(create_ads(address, data_rate=860), lock_file=config('ADC_LOCK_FILE', default='') or None)
+    return _managers[address]
+
+
+class ADCChannel(SampleRing):
+    """One input of an ADCManager
+
+    Reads like AnalogIn: value and voltage return the latest sample of a scheduled channel, or
+    convert on demand if the channel has no rate. Scheduled samples are also kept in the ring, see SampleRing.read.
+    """
+
+    def __init__(self, manager: "ADCManager", pin: int, rate: float = 0, capacity: int = 8192):
+        """Initialize the channel
+
+        Args:
+            manager (ADCManager): manager owning the ADC
+            pin (int): single ended input of the ADS1115, ADS.P0 to ADS.P3
+            rate (float, optional): scheduled conversions per second, 0 to convert on demand only. Defaults to 0.
+            capacity (int, optional): number of samples kept in the ring. Defaults to 8192.
+        """
+        super().__init__(capacity)
+        self.manager = manager
+        self.pin = pin
+        self.rate = rate
+        self.next_time = monotonic()
+        # whether the last scheduled conversion raised something else than an I2C error
+        self.failed = False
+        # same attribute as AnalogIn, used to convert values to volts
+        self._ads = manager.ads
+
+    @property
+    def value(self) -> int:
+        """Latest sample of a scheduled channel, or a new conversion of an on demand channel"""
+        if self.rate > 0 and self.count > 0:
+            return int(self.values[(self.count - 1) % self.capacity])
+        return self.manager.convert(self.pin)
+
+    @property
+    def voltage(self) -> float:
+        """Voltage of value, like AnalogIn.voltage"""
+        return self.value * PGA_RANGE[self._ads.gain] / 32767
+
+
+class ADCManager:
+    """Owns an ADS1115 and schedules single shot conversions across its channels
+
+    Every conversion sets the multiplexer, waits for the result and reads it while holding the
+    manager lock, and the lock file if given, so readers in this and other processes never
+    switch the multiplexer under each other. Scheduled channels are converted round robin by
+    earliest deadline in one background thread.
+    """
+
+    def __init__(self, ads: Union["ADS.ADS1115", "ADCBackend"], lock_file: Optional[str] = None):
+        """Initialize the manager
+
+        Args:
+            ads (Union[ADS.ADS1115, ADCBackend]): ADC in single shot mode, see create_ads. A high data rate shortens each conversion
+            lock_file (Optional[str], optional): file locked around each conversion, shared by all processes using the ADC. Defaults to None.
+        """
+        self.ads = ads
+        self.channels: Dict[int, ADCChannel] = dict()
+        self.errors = 0
+        self.read_timer = METRICS.timer("adc_read_ms", "ADS1115 single shot conversion including the bus locks")
+        self.error_counter = METRICS.counter("adc_errors_total", "ADS1115 scheduled conversions failed")
+        self._lock = threading.Lock()
+        self._lock_file = open(lock_file, 'a') if lock_file else None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add_channel(self, pin: int, rate: float = 0, capacity: int = 8192) -> ADCChannel:
+        """Get the channel of an input, created on first use. Starts scheduling if it has a rate
+
+        Args:
+            pin (int): single ended input of the ADS1115, ADS.P0 to ADS.P3
+            rate (float, optional): scheduled conversions per second, 0 to convert on demand only. Defaults to 0.
+            capacity (int, optional): number of samples kept in the ring. Defaults to 8192.
+
+        Returns:
+            ADCChannel: the channel
+        """
+        channel = self.channels.get(pin)
+        if channel is None:
+            channel = ADCChannel(self, pin, rate, capacity)
+            self.channels[pin] = channel
+        elif rate > channel.rate:
+            channel.rate = rate
+
+        if channel.rate > 0:
+            self.start()
+        return channel
+
+    def convert(self, pin: int) -> int:
+        """Run one single shot conversion of an input
+
+        Args:
+            pin (int): single ended input of the ADS1115
+
+        Returns:
+            int: the raw value
+        """
+        start = self.read_timer.start()
+        with self._lock:
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                return self.ads.read(pin)
+            finally:
+                if self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                self.read_timer.stop(start)
+
+    def start(self) -> None:
+        """Start converting the scheduled channels in a background thread"""
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ADCManager", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop converting and wait for the thread to exit"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """Convert the channel with the earliest deadline until stopped"""
+        while not self._stop.is_set():
+            scheduled = [channel for channel in list(self.channels.values()) if channel.rate > 0]
+            if not scheduled:
+                # nothing to convert until a channel gets a rate
+                self._stop.wait(0.1)
+                continue
+            channel = min(scheduled, key=lambda c: c.next_time)
+
+            delay = channel.next_time - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            try:
+                value = self.convert(channel.pin)
+            except OSError:
+                # I2C error, skip this sample
+                self.errors += 1
+                self.error_counter.inc()
+            except Exception as e:
+                # keep converting, a dead thread would leave every channel serving its last sample
+                self.errors += 1
+                self.error_counter.inc()
+                if not channel.failed:
+                    log.error("Conversion of input %d failed: %r", channel.pin, e)
+                channel.failed = True
+            else:
+                channel.append(value, monotonic())
+                channel.failed = False
+
+            channel.next_time += 1.0 / channel.rate
+            now = monotonic()
+            if channel.next_time < now:
+                # running late, do not try to catch up
+                channel.next_time = now
+
+
+def init_sensor(pin: int, rate: float = 0, address: int = 0x48) -> ADCChannel:
+    """Initialize the analog gas sensor
+
+    Sensors are channels of the process wide ADC manager, so every sensor shares one
+    I2C bus and one ADS1115 object and conversions of different channels never overlap.
+
+    Args:
+        pin (int): sensor pin of the plugged in sensor on the ADS1115, P0 to P3.
+        rate (float, optional): scheduled conversions per second, 0 to convert on each read. Defaults to 0.
+        address (int, optional): I2C address of the ADS1115, 0x48 to 0x4B. Defaults to 0x48.
+
+    Returns:
+        ADCChannel: the analog sensor object
+    """
+    return get_adc_manager(address).add_channel(pin, rate)
+
+
+def get_sensor_voltage(sensor: ADCChannel, value):
+    """Convert a raw value of the sensor to volts, like AnalogIn.voltage without reading the ADC again
+
+    Args:
+        sensor (ADCChannel): the analog sensor object the value was read from
+        value (int or np.ndarray): raw value(s)
+
+    Returns:
+        float or np.ndarray: voltage(s)
+    """
+    return value * PGA_RANGE[sensor._ads.gain] / 32767
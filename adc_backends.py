@@ -0,0 +1,276 @@
+"""
+Stand-ins for the ADS1115, to run and profile the services without I2C hardware
+
+The backend of every ADC of the process is selected with the ADC_BACKEND env variable, see
+adc.create_ads:
+
+ - ads1115: the ADS1115 on the I2C bus (default)
+ - synthetic[:SEED[:STEP]]: deterministic plume model with noise and outliers, see SyntheticADC
+ - replay:PATH[:SPEED]: plays a flight recording or its CSV export, see ReplayADC
+
+Input 3 of the ADS1115 at 0x48 reads as the temperature sensor, every other input as an MQ135.
+"""
+import csv
+import math
+from abc import ABC, abstractmethod
+from time import monotonic
+from typing import Dict, List, Tuple
+import numpy as np
+from decouple import config
+from adc import PGA_RANGE, TEMPERATURE_ADDRESS, TEMPERATURE_PIN
+
+ADC_BACKENDS = ('ads1115', 'synthetic', 'replay')
+
+
+class ADCBackend(ABC):
+    """Reads like ADS.ADS1115 for ADCManager, without I2C"""
+
+    # resolution of the codes, like ADS.ADS1115
+    bits = 16
+
+    def __init__(self, address: int = 0x48, gain: float = 1):
+        """Initialize the backend
+
+        Args:
+            address (int, optional): I2C address of the ADS1115 it stands in for. Defaults to 0x48.
+            gain (float, optional): ADC gain, converting codes to volts. Defaults to 1.
+        """
+        self.address = address
+        self.gain = gain
+
+    def is_temperature(self, pin: int) -> bool:
+        """Whether an input is the temperature sensor"""
+        return self.address == TEMPERATURE_ADDRESS and pin == TEMPERATURE_PIN
+
+    def to_code(self, voltage):
+        """Convert volts to codes at the gain, the inverse of AnalogIn.voltage"""
+        return np.clip(np.rint(np.asarray(voltage) * 32767 / PGA_RANGE[self.gain]), -32768, 32767).astype(int)
+
+    def temperature_code(self, temperature):
+        """Convert temperatures to the codes of the sensor, the inverse of utils.get_temp_sensor_reading"""
+        return self.to_code((np.asarray(temperature) + 50) / 100)
+
+    @abstractmethod
+    def read(self, pin: int, is_differential: bool = False) -> int:
+        """Convert an input
+
+        Args:
+            pin (int): single ended input, P0 to P3
+            is_differential (bool, optional): unused, same signature as ADS.ADS1115.read. Defaults to False.
+
+        Returns:
+            int: the raw value
+        """
+
+
+class SyntheticADC(ADCBackend):
+    """Deterministic plume model
+
+    Each MQ135 input sees a background concentration crossed by a Gaussian puff every
+    PLUME_PERIOD seconds, a little later on each input as if the sensors were apart. The
+    concentration is converted to the code the MQ135 class turns back into the same corrected
+    ppm at the modeled temperature, with multiplicative noise and occasional outliers. The
+    temperature input drifts slowly around TEMPERATURE.
+
+    Each input draws from its own random stream seeded by the seed, the address and the input.
+    With a step, time advances by the step at each read of an input instead of following the
+    clock, so the codes of a run are reproducible whatever the timing of the reads.
+    """
+
+    BACKGROUND_PPM = 420.0
+    PLUME_PPM = 800.0
+    PLUME_PERIOD = 60.0
+    PLUME_WIDTH = 4.0
+    # seconds between the plume at two consecutive inputs
+    PLUME_DELAY = 0.5
+    NOISE = 0.01
+    OUTLIER_PROBABILITY = 0.002
+    TEMPERATURE = 21.0
+    TEMPERATURE_NOISE = 0.05
+    HUMIDITY = 35.0
+
+    def __init__(self, address: int = 0x48, gain: float = 1, seed: int = 0, step: float = 0.0):
+        """Initialize the model
+
+        Args:
+            address (int, optional): I2C address of the ADS1115 it stands in for. Defaults to 0x48.
+            gain (float, optional): ADC gain. Defaults to 1.
+            seed (int, optional): seed of the noise. Defaults to 0.
+            step (float, optional): seconds of model time per read of an input, 0 to follow the clock. Defaults to 0.0.
+        """
+        super().__init__(address, gain)
+        self.seed = seed
+        self.step = step
+        self.sensor_max_value = config('SENSOR_ANALOG_VALUE_MAX', default=1023, cast=float)
+        self.start = monotonic()
+        self.generators: Dict[int, np.random.Generator] = dict()
+        self.reads: Dict[int, int] = dict()
+        self._mq135 = None
+
+    def time(self, pin: int) -> float:
+        """Get the model time of the next read of an input"""
+        if self.step <= 0:
+            return monotonic() - self.start
+        reads = self.reads.get(pin, 0)
+        self.reads[pin] = reads + 1
+        return reads * self.step
+
+    def ppm(self, pin: int, t: float) -> float:
+        """Get the modeled concentration at an input
+
+        Args:
+            pin (int): input of the MQ135
+            t (float): model time in seconds
+
+        Returns:
+            float: CO2 ppm
+        """
+        delay = ((self.address - 0x48) * 4 + pin) * self.PLUME_DELAY
+        offset = (t - delay) % self.PLUME_PERIOD - self.PLUME_PERIOD / 2
+        return self.BACKGROUND_PPM + self.PLUME_PPM * math.exp(-0.5 * (offset / self.PLUME_WIDTH) ** 2)
+
+    def temperature(self, t: float) -> float:
+        """Get the modeled temperature in degrees Celsius at a model time"""
+        return self.TEMPERATURE + 0.5 * math.sin(2 * math.pi * t / 600)
+
+    def gas_code(self, ppm: float, temperature: float) -> float:
+        """Convert a concentration to the MQ135 code, before rounding"""
+        if self._mq135 is None:
+            # needs the RZERO calibration, only loaded once an MQ135 input is read
+            from mq135 import MQ135
+            self._mq135 = MQ135(None, int(self.sensor_max_value))
+        mq135 = self._mq135
+        resistance = mq135.RZERO * (ppm / mq135.PARA) ** (-1 / mq135.PARB) * mq135.get_correction_factor(temperature, self.HUMIDITY)
+        return self.sensor_max_value / (resistance / mq135.RLOAD + 1)
+
+    def read(self, pin: int, is_differential: bool = False) -> int:
+        generator = self.generators.get(pin)
+        if generator is None:
+            generator = self.generators[pin] = np.random.default_rng([self.seed, self.address, pin])
+        t = self.time(pin)
+        if self.is_temperature(pin):
+            return int(self.temperature_code(self.temperature(t) + generator.normal(0, self.TEMPERATURE_NOISE)))
+
+        # draw the same numbers on every read so the stream stays aligned
+        noise, outlier, scale = generator.normal(0, self.NOISE), generator.random(), generator.uniform(0.3, 3)
+        code = self.gas_code(self.ppm(pin, t), self.temperature(t)) * (1 + noise)
+        if outlier < self.OUTLIER_PROBABILITY:
+            code *= scale
+        return int(min(max(round(code), 1), 32767))
+
+
+def load_trace(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Load the raw gas codes and temperatures of a flight recording or its CSV export
+
+    CSV files need the timestamp and value columns of recorder.py, with temperature optional.
+
+    Args:
+        path (str): flight recording or CSV file
+
+    Raises:
+        ValueError: if the file has no rows or misses a column
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: timestamps, codes and temperatures, nan when not recorded
+    """
+    from recorder import RECORDER_MAGIC, FlightRecording
+
+    with open(path, 'rb') as f:
+        magic = f.read(len(RECORDER_MAGIC))
+    if magic == RECORDER_MAGIC:
+        recording = FlightRecording(path)
+        timestamps, values, temperature = (np.array(recording[name], dtype=float) for name in ('timestamp', 'value', 'temperature'))
+    else:
+        with open(path, newline='') as f:
+            reader = csv.DictReader(f)
+            if not {'timestamp', 'value'} <= set(reader.fieldnames or ()):
+                raise ValueError(f"Replay trace {path} needs timestamp and value columns")
+            rows: List[Tuple[float, float, float]] = [(float(row['timestamp']), float(row['value']), float(row.get('temperature') or 'nan'))
+                                                      for row in reader]
+        if not rows:
+            raise ValueError(f"Replay trace {path} has no rows")
+        timestamps, values, temperature = (np.array(column, dtype=float) for column in zip(*rows))
+
+    if len(timestamps) == 0:
+        raise ValueError(f"Replay trace {path} has no rows")
+    return timestamps, values, temperature
+
+
+class ReplayADC(ADCBackend):
+    """Plays a recorded trace
+
+    Every MQ135 input reads the recorded codes, the temperature input the recorded temperature,
+    25 degrees where it was not recorded. At a speed, the trace plays at that many times real
+    time from the first read; at speed 0 each read of an input returns its next row, as fast as
+    the service reads. The trace loops at its end.
+    """
+
+    def __init__(self, path: str, address: int = 0x48, gain: float = 1, speed: float = 1.0):
+        """Load the trace
+
+        Args:
+            path (str): flight recording or CSV file, see load_trace
+            address (int, optional): I2C address of the ADS1115 it stands in for. Defaults to 0x48.
+            gain (float, optional): ADC gain. Defaults to 1.
+            speed (float, optional): times real time, 0 for one row per read. Defaults to 1.0.
+
+        Raises:
+            ValueError: if the trace cannot be loaded
+        """
+        super().__init__(address, gain)
+        timestamps, values, temperature = load_trace(path)
+        order = np.argsort(timestamps, kind='stable')
+        self.offsets = timestamps[order] - timestamps[order[0]]
+        self.codes = np.clip(np.nan_to_num(values[order]), -32768, 32767).astype(int).tolist()
+        self.temperature_codes = self.temperature_code(np.where(np.isnan(temperature[order]), 25.0, temperature[order])).tolist()
+        # the loop restarts one typical row interval after the last row
+        self.duration = float(self.offsets[-1] + (np.median(np.diff(self.offsets)) if len(self.offsets) > 1 else 1.0))
+        self.speed = speed
+        self.start = None
+        self.cursors: Dict[int, int] = dict()
+
+    def index(self, pin: int) -> int:
+        """Get the row of the next read of an input"""
+        if self.speed <= 0:
+            index = self.cursors.get(pin, 0)
+            self.cursors[pin] = (index + 1) % len(self.codes)
+            return index
+        if self.start is None:
+            self.start = monotonic()
+        elapsed = ((monotonic() - self.start) * self.speed) % self.duration
+        return max(int(np.searchsorted(self.offsets, elapsed, side='right')) - 1, 0)
+
+    def read(self, pin: int, is_differential: bool = False) -> int:
+        index = self.index(pin)
+        return self.temperature_codes[index] if self.is_temperature(pin) else self.codes[index]
+
+
+def create_adc_backend(spec: str, address: int = 0x48, gain: float = 1) -> ADCBackend:
+    """Create the stand-in of an ADS1115 from an ADC_BACKEND spec
+
+    Args:
+        spec (str): synthetic[:SEED[:STEP]] or replay:PATH[:SPEED]
+        address (int, optional): I2C address of the ADS1115. Defaults to 0x48.
+        gain (float, optional): ADC gain. Defaults to 1.
+
+    Raises:
+        ValueError: if the backend is unknown or its arguments are invalid
+
+    Returns:
+        ADCBackend: the backend
+    """
+    name, *arguments = spec.strip().split(':')
+    name = name.lower()
+    try:
+        if name == 'synthetic' and len(arguments) <= 2:
+            seed = int(arguments[0]) if arguments and arguments[0] else 0
+            step = float(arguments[1]) if len(arguments) > 1 else 0.0
+            return SyntheticADC(address, gain, seed, step)
+        if name == 'replay' and 1 <= len(arguments) <= 2 and arguments[0]:
+            speed = float(arguments[1]) if len(arguments) > 1 else 1.0
+            if speed < 0:
+                raise ValueError(f"Replay speed must be positive or 0, got {speed}")
+            return ReplayADC(arguments[0], address, gain, speed)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Invalid ADC backend {spec}: {e}")
+    raise ValueError(f"Invalid ADC backend {spec}, expected one of ads1115, synthetic[:SEED[:STEP]], replay:PATH[:SPEED]")
@@ -0,0 +1,200 @@
+import argparse
+import csv
+import math
+import os
+import sys
+from typing import List, Optional, Tuple
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from adaptive import AdaptiveRate
+from buffers import Buffer
+
+
+def synthetic_trace(duration: float, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Generate a clean ppm trace of a flight crossing plumes of different widths and heights
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: times in seconds and ppm, every 10 ms
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, duration, 0.01)
+    ppm = 420 + 5 * np.sin(t / 40)
+    centers = np.arange(30, duration - 20, 120)
+    for center in centers + rng.uniform(-10, 10, len(centers)):
+        width = rng.uniform(0.5, 6)
+        ppm += rng.uniform(80, 600) * np.exp(-((t - center) / width) ** 2)
+    return t, ppm
+
+
+def load_trace(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Load the GAS_PPM column of a CSV with a timestamp column, e.g. decode_telemetry.py output
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: times in seconds and ppm
+    """
+    with open(path, newline='') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('GAS_PPM')]
+    t = np.array([float(row['timestamp']) for row in rows])
+    ppm = np.array([float(row['GAS_PPM']) for row in rows])
+    return t - t[0], ppm
+
+
+def find_events(t: np.ndarray, ppm: np.ndarray, delta: float) -> List[Tuple[float, float, float]]:
+    """Find the intervals where the trace is more than delta above its median
+
+    Returns:
+        List[Tuple[float, float, float]]: start, end and peak ppm of each event
+    """
+    above = ppm > np.median(ppm) + delta
+    edges = np.flatnonzero(np.diff(above.astype(int)))
+    starts = list(edges[~above[edges]] + 1)
+    ends = list(edges[above[edges]] + 1)
+    if above[0]:
+        starts.insert(0, 0)
+    if above[-1]:
+        ends.append(len(ppm))
+    return [(float(t[s]), float(t[e - 1]), float(ppm[s:e].max())) for s, e in zip(starts, ends)]
+
+
+def simulate(t: np.ndarray, ppm: np.ndarray, period: float, buffer_size: int, noise: float, m: float,
+             adaptive: Optional[AdaptiveRate] = None, seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample the trace like gas_sensors.py: one noisy reading per tick through the Buffer filter
+
+    With an adaptive rate, the period of each tick comes from it and the buffer keeps its window
+    in seconds, like GasReader.scale_rate.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: tick times and filtered ppm
+    """
+    rng = np.random.default_rng(seed)
+    buffer = Buffer(buffer_size)
+    base_period = period
+    if adaptive is not None:
+        adaptive.reset()
+        period = adaptive.period
+        buffer.resize(max(3, round(buffer_size * base_period / period)))
+
+    times: List[float] = []
+    filtered: List[float] = []
+    now = float(t[0])
+    end = float(t[-1])
+    while now <= end:
+        reading = float(np.interp(now, t, ppm)) + rng.normal(0, noise)
+        if rng.random() < 0.01:
+            # occasional spike like a bad conversion
+            reading += rng.normal(0, 2000)
+        buffer.add(reading)
+        value = buffer.get(m=m)
+        times.append(now)
+        filtered.append(value)
+
+        if adaptive is not None:
+            new_period = adaptive.update(value, now)
+            if new_period != period:
+                period = new_period
+                buffer.resize(max(3, round(buffer_size * base_period / period)))
+        now += period
+    return np.array(times), np.array(filtered)
+
+
+def score(events: List[Tuple[float, float, float]], baseline: float, delta: float,
+          times: np.ndarray, filtered: np.ndarray) -> Tuple[List[float], int, List[float]]:
+    """Measure how fast and how fully each event shows in the filtered output
+
+    An event is detected when the filtered ppm first goes over the event threshold, before the
+    event ends plus its own duration.
+
+    Returns:
+        Tuple[List[float], int, List[float]]: detection latency of each detected event, missed events and peak error of each event in %
+    """
+    latencies: List[float] = []
+    peak_errors: List[float] = []
+    missed = 0
+    for start, end, peak in events:
+        window = (times >= start) & (times <= end + (end - start) + 1.0)
+        over = np.flatnonzero(window & (filtered > baseline + delta))
+        if len(over) == 0:
+            missed += 1
+        else:
+            latencies.append(float(times[over[0]] - start))
+        captured = filtered[window].max() if window.any() else baseline
+        peak_errors.append(100 * (peak - captured) / (peak - baseline))
+    return latencies, missed, peak_errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay gas traces through fixed and adaptive sampling rates')
+    parser.add_argument('-c', '--csv',
+                        type=str,
+                        help='CSV trace with timestamp and GAS_PPM columns. Default to a synthetic plume flight',
+                        default=None)
+    parser.add_argument('-D', '--duration',
+                        type=float,
+                        help='Synthetic trace duration in seconds. Default to 900',
+                        default=900.0)
+    parser.add_argument('-r', '--refresh-rate',
+                        type=float,
+                        help='Base refresh rate in seconds the buffer size applies to. Default to 0.1',
+                        default=0.1)
+    parser.add_argument('-b', '--buffer-size',
+                        type=int,
+                        help='Buffer size at the base refresh rate. Default to 10',
+                        default=10)
+    parser.add_argument('--min-refresh-rate',
+                        type=float,
+                        help='Adaptive fastest refresh rate in seconds. Default to 0.05',
+                        default=0.05)
+    parser.add_argument('--max-refresh-rate',
+                        type=float,
+                        help='Adaptive slowest refresh rate in seconds. Default to 0.8',
+                        default=0.8)
+    parser.add_argument('--slope',
+                        type=float,
+                        help='Adaptive slope threshold in ppm/s. Default to 5',
+                        default=5.0)
+    parser.add_argument('--std',
+                        type=float,
+                        help='Adaptive standard deviation threshold in ppm, 0 to ignore. Default to 10',
+                        default=10.0)
+    parser.add_argument('--hold',
+                        type=float,
+                        help='Adaptive hold in seconds before each slow down. Default to 2',
+                        default=2.0)
+    parser.add_argument('-n', '--noise',
+                        type=float,
+                        help='Reading noise standard deviation in ppm. Default to 3',
+                        default=3.0)
+    parser.add_argument('-t', '--threshold',
+                        type=float,
+                        help='Event threshold above the median in ppm. Default to 50',
+                        default=50.0)
+    args = parser.parse_args()
+
+    t, ppm = load_trace(args.csv) if args.csv else synthetic_trace(args.duration)
+    baseline = float(np.median(ppm))
+    events = find_events(t, ppm, args.threshold)
+    duration = float(t[-1] - t[0])
+    print(f"{len(events)} events over {duration:.0f} s")
+
+    adaptive = AdaptiveRate(args.min_refresh_rate, args.max_refresh_rate, args.slope, args.std, hold_second=args.hold)
+    runs: List[Tuple[str, float, Optional[AdaptiveRate]]] = [
+        (f"fixed {args.min_refresh_rate} s", args.min_refresh_rate, None),
+        (f"fixed {args.refresh_rate} s", args.refresh_rate, None),
+        (f"fixed {args.max_refresh_rate} s", args.max_refresh_rate, None),
+        ("adaptive", args.refresh_rate, adaptive),
+    ]
+    print(f"  {'rate':>16} {'samples':>8} {'samples/s':>10} {'mean latency':>13} {'max latency':>12} {'missed':>7} {'peak error':>11}")
+    for label, period, rate in runs:
+        # a fixed run keeps the buffer window in seconds of the base refresh rate
+        size = args.buffer_size if rate is not None else max(3, round(args.buffer_size * args.refresh_rate / period))
+        times, filtered = simulate(t, ppm, period, size, args.noise, 6.0, rate)
+        latencies, missed, peak_errors = score(events, baseline, args.threshold, times, filtered)
+        mean_latency = float(np.mean(latencies)) if latencies else math.nan
+        max_latency = float(np.max(latencies)) if latencies else math.nan
+        print(f"  {label:>16} {len(times):>8} {len(times) / duration:>10.2f} {mean_latency:>11.2f} s {max_latency:>10.2f} s "
+              f"{missed:>7} {float(np.mean(peak_errors)):>10.1f}%")
+
+
+if __name__ == "__main__":
+    main()
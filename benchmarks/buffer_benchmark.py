@@ -0,0 +1,133 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buffers import Buffer
+
+
+class NumpyBuffer:
+    """The previous Buffer implementation, recomputing both medians on every get()"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.buffer = np.empty(size)
+        self.buffer[:] = np.nan
+        self.index = 0
+
+    def add(self, value: float) -> None:
+        self.buffer[self.index] = value
+        self.index = (self.index + 1) % self.size
+
+    def get(self, m = 6.0) -> float:
+        data = self.buffer[~np.isnan(self.buffer)]
+
+        if len(data) == 0:
+            return np.nan
+
+        d = np.abs(data - np.median(data))
+        mdev = np.median(d)
+        s = d / (mdev if mdev else 1.)
+        return float(data[s < m].mean())
+
+
+def make_samples(count: int, seed: int = 0) -> np.ndarray:
+    """Generate a noisy ppm trace with occasional spikes and dropouts
+
+    Args:
+        count (int): number of samples
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: the samples
+    """
+    rng = np.random.default_rng(seed)
+    samples = 400 + 20 * np.sin(np.linspace(0, 20, count)) + rng.normal(0, 5, count)
+    spikes = rng.random(count) < 0.01
+    samples[spikes] += rng.normal(0, 2000, spikes.sum())
+    samples[rng.random(count) < 0.005] = np.nan
+    return samples
+
+
+def time_ticks(buffer, samples: np.ndarray, m: float) -> float:
+    """Time one add() followed by one get() per sample
+
+    Returns:
+        float: seconds per tick
+    """
+    values = samples.tolist()
+    start = time.perf_counter()
+    for value in values:
+        buffer.add(value)
+        buffer.get(m)
+    return (time.perf_counter() - start) / len(values)
+
+
+def time_blocks(buffer: Buffer, samples: np.ndarray, block: int, m: float) -> float:
+    """Time one add_many() followed by one get() per block
+
+    Returns:
+        float: seconds per sample
+    """
+    start = time.perf_counter()
+    for i in range(0, len(samples), block):
+        buffer.add_many(samples[i:i + block])
+        buffer.get(m)
+    return (time.perf_counter() - start) / len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the incremental Buffer against the full recompute implementation')
+    parser.add_argument('-s', '--sizes',
+                        type=int,
+                        nargs='+',
+                        help='Buffer sizes to benchmark. Default to 10 100 1000 5000',
+                        default=[10, 100, 1000, 5000])
+    parser.add_argument('-n', '--samples',
+                        type=int,
+                        help='Number of samples per run. Default to 20000',
+                        default=20000)
+    parser.add_argument('-k', '--block-size',
+                        type=int,
+                        help='Block size for add_many(). Default to 32',
+                        default=32)
+    parser.add_argument('-m', '--cutoff',
+                        type=float,
+                        help='Outlier cutoff value. Default to 6.0',
+                        default=6.0)
+    args = parser.parse_args()
+
+    samples = make_samples(args.samples)
+
+    print(f"{'size':>6} {'numpy us/tick':>14} {'incr us/tick':>13} {'speedup':>8} {'block us/sample':>16} {'max abs err':>12}")
+    for size in args.sizes:
+        reference = NumpyBuffer(size)
+        incremental = Buffer(size)
+
+        # warm up both buffers so every run measures a full window
+        for value in samples[:size].tolist():
+            reference.add(value)
+            incremental.add(value)
+
+        numpy_tick = time_ticks(reference, samples, args.cutoff)
+        incremental_tick = time_ticks(incremental, samples, args.cutoff)
+        block_sample = time_blocks(Buffer(size), samples, args.block_size, args.cutoff)
+
+        # check the estimators agree on the same window
+        error = 0.0
+        reference, incremental = NumpyBuffer(size), Buffer(size)
+        for value in samples[:min(len(samples), 2000)].tolist():
+            reference.add(value)
+            incremental.add(value)
+            expected = reference.get(args.cutoff)
+            if not np.isnan(expected):
+                error = max(error, abs(incremental.get(args.cutoff) - expected))
+
+        print(f"{size:>6} {numpy_tick * 1e6:>14.2f} {incremental_tick * 1e6:>13.2f} "
+              f"{numpy_tick / incremental_tick:>7.1f}x {block_sample * 1e6:>16.3f} {error:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
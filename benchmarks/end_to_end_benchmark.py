@@ -0,0 +1,352 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import redis
+from decouple import config
+from pymavlink.dialects.v20 import ardupilotmega as mavlink2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# calibration values of typical sensors if none are configured
+os.environ.setdefault('RZERO', '76.63')
+os.environ.setdefault('ATMOCO2', '420')
+from utils import SENSOR_UPDATES_CHANNELS, decode_sensor_update
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+# metrics compared against a baseline: higher is better for samples/s, lower for the others
+HIGHER_IS_BETTER = ('samples_per_second', 'values_per_second', 'messages_per_second')
+
+
+class RouterStandIn:
+    """Local TCP server standing in for mavlink-router, keeping the named values it receives with their receive time"""
+
+    def __init__(self, port: int):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen()
+        self.messages = 0
+        self.values: List[Tuple[str, float, float]] = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            client, _ = self.server.accept()
+            threading.Thread(target=self.read, args=(client,), daemon=True).start()
+
+    def read(self, client: socket.socket) -> None:
+        mav = mavlink2.MAVLink(None)
+        mav.robust_parsing = True
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return
+            received = time.time()
+            for msg in mav.parse_buffer(data) or ():
+                self.messages += 1
+                if msg.get_type() == 'NAMED_VALUE_FLOAT':
+                    self.values.append((msg.name, msg.value, received))
+
+
+class UpdateListener:
+    """Keeps the sensor timestamp of every value announced on the updates channel"""
+
+    def __init__(self, r: redis.Redis):
+        self.pubsub = r.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(*SENSOR_UPDATES_CHANNELS)
+        self.updates: List[Tuple[str, float, float]] = []
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self) -> None:
+        try:
+            for message in self.pubsub.listen():
+                for name, (value, timestamp) in decode_sensor_update(message['data']).items():
+                    self.updates.append((name, value, timestamp))
+        except redis.exceptions.ConnectionError:
+            # redis stopped with the benchmark
+            return
+
+
+def value_key(name: str, value: float) -> Tuple[str, float]:
+    """Key of a value as it arrives in a NAMED_VALUE_FLOAT: 10 character name, float32 of the value rounded to 2 decimals"""
+    return name[:10], float(np.float32(round(value, 2)))
+
+
+def match_latencies(updates: List[Tuple[str, float, float]], values: List[Tuple[str, float, float]], start: float, end: float) -> np.ndarray:
+    """Get the sensor to MAVLink latency of the values received in a window
+
+    Each received value is matched to the latest announcement of the same field and value
+    before it. Values matching an announcement already matched are heartbeats, not counted.
+
+    Returns:
+        np.ndarray: latencies in seconds
+    """
+    published: Dict[Tuple[str, float], List[float]] = dict()
+    for name, value, timestamp in updates:
+        published.setdefault(value_key(name, value), []).append(timestamp)
+    for timestamps in published.values():
+        timestamps.sort()
+
+    matched = set()
+    latencies = []
+    for name, value, received in values:
+        if not start <= received < end:
+            continue
+        key = (name, float(np.float32(value)))
+        timestamps = published.get(key, ())
+        index = bisect_right(timestamps, received) - 1
+        if index < 0 or (key, index) in matched:
+            continue
+        matched.add((key, index))
+        latencies.append(received - timestamps[index])
+    return np.array(latencies)
+
+
+def read_cpu_seconds(pid: int) -> float:
+    """User and system CPU time of a process"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def read_memory(pid: int) -> Tuple[float, float]:
+    """Resident and peak resident memory of a process in MB"""
+    memory = {'VmRSS': 0.0, 'VmHWM': 0.0}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in memory:
+                memory[key] = int(value.split()[0]) / 1024
+    return memory['VmRSS'], memory['VmHWM']
+
+
+def read_samples(r: redis.Redis, service: str) -> int:
+    """ADC conversions of a service so far, from its metrics hash"""
+    count = r.hget(f"METRICS_{service.upper()}", "adc_read_ms_count")
+    return int(float(count)) if count is not None else 0
+
+
+def connect(host: str, port: int, password: str, start_server: bool) -> Tuple[redis.Redis, Optional[subprocess.Popen]]:
+    """Connect to redis, starting a local redis-server if none answers"""
+    r = redis.Redis(host=host, port=port, password=password or None)
+    try:
+        r.ping()
+        return r, None
+    except redis.exceptions.ConnectionError:
+        if not start_server or shutil.which('redis-server') is None:
+            raise SystemExit(f"No redis server on {host}:{port}, start one or install redis-server")
+
+    server = subprocess.Popen(['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        time.sleep(0.1)
+        try:
+            r.ping()
+            return r, server
+        except redis.exceptions.ConnectionError:
+            pass
+    server.terminate()
+    raise SystemExit("redis-server did not start")
+
+
+def get_commands(args) -> Dict[str, List[str]]:
+    """Command line of each service"""
+    python = sys.executable
+    if args.runtime:
+        return {'runtime': [python, 'runtime.py', '-P', str(args.router_port), '--redis-mirror',
+                            '--gas-refresh-rate', str(args.gas_refresh_rate), '--gas-sample-rate', str(args.gas_sample_rate),
+                            '--temp-refresh-rate', str(args.temp_refresh_rate), '-e', args.encoding]}
+    return {
+        'gas': [python, 'gas_sensors.py', '-r', str(args.gas_refresh_rate), '-a', str(args.gas_sample_rate)],
+        'temp': [python, 'temp_sensors.py', '-r', str(args.temp_refresh_rate)],
+        'mavlink': [python, 'mavlink.py', '-P', str(args.router_port), '-m', args.mode, '-e', args.encoding],
+    }
+
+
+def snapshot(r: redis.Redis, processes: Dict[str, subprocess.Popen]) -> Dict[str, Tuple[float, int]]:
+    """CPU time and ADC conversions of each service"""
+    return {name: (read_cpu_seconds(process.pid), read_samples(r, name)) for name, process in processes.items()}
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Get the metrics worse than the baseline by more than the tolerance"""
+    regressions = []
+
+    def check(name: str, value: float, reference: Optional[float]) -> None:
+        if reference is None or not reference == reference or not value == value:
+            return
+        higher_is_better = name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER
+        worse = value < reference * (1 - tolerance) if higher_is_better else value > reference * (1 + tolerance)
+        if worse:
+            regressions.append(f"{name}: {value:.4g} against {reference:.4g}")
+
+    for name, value in results['totals'].items():
+        check(name, value, baseline.get('totals', {}).get(name))
+    for service, values in results['services'].items():
+        # samples/s of a slow service moves by whole samples over the window, the total covers it
+        for name in ('cpu_percent', 'rss_mb'):
+            check(f"{service}.{name}", values[name], baseline.get('services', {}).get(service, {}).get(name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the services end to end on a hardware-free ADC backend against a local redis-server and a '
+                                                 'TCP stand-in for mavlink-router, and report samples/s, sensor to MAVLink latency, CPU and memory')
+    parser.add_argument('-B', '--backend',
+                        type=str,
+                        help='ADC_BACKEND of the services, synthetic[:SEED[:STEP]] or replay:PATH[:SPEED], see adc_backends.py. Default to synthetic',
+                        default='synthetic')
+    parser.add_argument('-t', '--duration',
+                        type=float,
+                        help='Seconds measured. Default to 30',
+                        default=30.0)
+    parser.add_argument('-w', '--warmup',
+                        type=float,
+                        help='Seconds run before measuring. Default to 5',
+                        default=5.0)
+    parser.add_argument('-r', '--gas-refresh-rate',
+                        type=float,
+                        help='Gas loop refresh rate in seconds. Default to 0.05',
+                        default=0.05)
+    parser.add_argument('-a', '--gas-sample-rate',
+                        type=int,
+                        help='Background MQ135 samples per second, 0 to read once per tick. Default to 200',
+                        default=200)
+    parser.add_argument('-T', '--temp-refresh-rate',
+                        type=float,
+                        help='Temperature loop refresh rate in seconds, at least 5. Default to 5',
+                        default=5.0)
+    parser.add_argument('-m', '--mode',
+                        choices=['poll', 'event'],
+                        help='Mavlink service mode. Default to event',
+                        default='event')
+    parser.add_argument('-e', '--encoding',
+                        choices=['named', 'packed'],
+                        help='Mavlink encoding, latency is only matched for named values. Default to named',
+                        default='named')
+    parser.add_argument('-R', '--runtime',
+                        action='store_true',
+                        help='Run the single process runtime with its redis mirror instead of the three services')
+    parser.add_argument('-P', '--router-port',
+                        type=int,
+                        help='Local port for the mavlink-router stand-in. Default to 15761',
+                        default=15761)
+    parser.add_argument('-p', '--password',
+                        type=str,
+                        help='Redis password. Default to REDIS_PASSWORD env variable',
+                        default=config('REDIS_PASSWORD', default=''))
+    parser.add_argument('-H', '--host',
+                        type=str,
+                        help='Redis host. Default to REDIS_HOST env variable or 127.0.0.1',
+                        default=config('REDIS_HOST', default='127.0.0.1'))
+    parser.add_argument('--port',
+                        type=int,
+                        help='Redis port, a redis-server is started there if none answers. Default to REDIS_PORT env variable or 6379',
+                        default=config('REDIS_PORT', default=6379, cast=int))
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help='Write the results to this JSON file, e.g. as the next baseline',
+                        default=None)
+    parser.add_argument('-b', '--baseline',
+                        type=str,
+                        help='Compare against the results of a previous run and exit with 1 on a regression',
+                        default=None)
+    parser.add_argument('--tolerance',
+                        type=float,
+                        help='Fraction a metric may be worse than the baseline. Default to 0.2',
+                        default=0.2)
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='Show the output of the services')
+    args = parser.parse_args()
+    if args.temp_refresh_rate < 5.0:
+        parser.error("The temperature refresh rate cannot be lower than 5.0")
+
+    r, server = connect(args.host, args.port, args.password, True)
+    router = RouterStandIn(args.router_port)
+    listener = UpdateListener(r)
+
+    env = dict(os.environ, ADC_BACKEND=args.backend, METRICS_REDIS_SECOND='1', REDIS_HOST=args.host, REDIS_PORT=str(args.port),
+               REDIS_PASSWORD=args.password, MAVLINK_ROUTER_HOST='127.0.0.1')
+    output = None if args.verbose else subprocess.DEVNULL
+    processes = {name: subprocess.Popen(command, cwd=ROOT, env=env, stdout=output, stderr=output)
+                 for name, command in get_commands(args).items()}
+    try:
+        time.sleep(args.warmup)
+        failed = [name for name, process in processes.items() if process.poll() is not None]
+        if failed:
+            raise SystemExit(f"{', '.join(failed)} exited during the warm up, run with -v to see why")
+
+        start_time, start_messages, start_updates = time.time(), router.messages, len(listener.updates)
+        start = snapshot(r, processes)
+        time.sleep(args.duration)
+        # the metrics hashes are written every second, so both snapshots lag the services by up to a second
+        end = snapshot(r, processes)
+        end_time = time.time()
+        memory = {name: read_memory(process.pid) for name, process in processes.items()}
+    finally:
+        for process in processes.values():
+            process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if server is not None:
+            server.terminate()
+
+    elapsed = end_time - start_time
+    services = dict()
+    for name in processes:
+        services[name] = {
+            'samples_per_second': (end[name][1] - start[name][1]) / elapsed,
+            'cpu_percent': 100 * (end[name][0] - start[name][0]) / elapsed,
+            'rss_mb': memory[name][0],
+            'peak_rss_mb': memory[name][1],
+        }
+    latencies = match_latencies(listener.updates, router.values, start_time, end_time) * 1000
+    totals = {
+        'samples_per_second': sum(service['samples_per_second'] for service in services.values()),
+        'values_per_second': (len(listener.updates) - start_updates) / elapsed,
+        'messages_per_second': (router.messages - start_messages) / elapsed,
+        'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else float('nan'),
+        'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else float('nan'),
+        'latency_max_ms': float(latencies.max()) if len(latencies) else float('nan'),
+    }
+    results = {'backend': args.backend, 'commands': get_commands(args), 'services': services, 'totals': totals}
+
+    print(f"{'service':>8} {'samples/s':>10} {'cpu %':>7} {'rss MB':>7} {'peak MB':>8}")
+    for name, service in services.items():
+        print(f"{name:>8} {service['samples_per_second']:>10.1f} {service['cpu_percent']:>7.1f} {service['rss_mb']:>7.1f} {service['peak_rss_mb']:>8.1f}")
+    print(f"{'total':>8} {totals['samples_per_second']:>10.1f} {sum(s['cpu_percent'] for s in services.values()):>7.1f} "
+          f"{sum(s['rss_mb'] for s in services.values()):>7.1f}")
+    print(f"published values/s {totals['values_per_second']:.1f}, mavlink messages/s {totals['messages_per_second']:.1f}")
+    print(f"sensor to MAVLink latency over {len(latencies)} values: p50 {totals['latency_p50_ms']:.2f} ms, "
+          f"p99 {totals['latency_p99_ms']:.2f} ms, max {totals['latency_max_ms']:.2f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%} of {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} of {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import os
+import sys
+import time
+from typing import Callable, List, Tuple
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filters import parse_filter_chain
+from buffers import Buffer
+
+
+def make_stream(duration: float, rate: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Generate a ppm stream sampled at the ADC rate, with noise, spikes, dropouts and a plume
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: clean and noisy samples
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, duration, 1.0 / rate)
+    clean = 420 + 10 * np.sin(t / 5) + 300 * np.exp(-((t - duration / 2) / 2) ** 2)
+    noisy = clean + rng.normal(0, 15, len(t))
+    spikes = rng.random(len(t)) < 0.01
+    noisy[spikes] += rng.normal(0, 2000, spikes.sum())
+    noisy[rng.random(len(t)) < 0.005] = np.nan
+    return clean, noisy
+
+
+def run_per_sample(noisy: np.ndarray, tick: int, size: int, m: float) -> List[float]:
+    """One Buffer add() and get() per sample, publishing the last get() of each tick"""
+    buffer = Buffer(size)
+    published = []
+    for i, value in enumerate(noisy.tolist()):
+        buffer.add(value)
+        filtered = buffer.get(m)
+        if i % tick == tick - 1:
+            published.append(filtered)
+    return published
+
+
+def run_blocks(noisy: np.ndarray, tick: int, process: Callable[[np.ndarray], float]) -> List[float]:
+    """One call per tick with the block of samples of that tick"""
+    return [process(noisy[i:i + tick]) for i in range(0, len(noisy) - tick + 1, tick)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per sample Buffer filtering against block filter chains with decimation')
+    parser.add_argument('-D', '--duration',
+                        type=float,
+                        help='Stream duration in seconds. Default to 60',
+                        default=60.0)
+    parser.add_argument('-a', '--sample-rate',
+                        type=int,
+                        help='ADC samples per second. Default to 860',
+                        default=860)
+    parser.add_argument('-r', '--refresh-rate',
+                        type=float,
+                        help='Publish period in seconds. Default to 0.1',
+                        default=0.1)
+    parser.add_argument('-m', '--cutoff',
+                        type=float,
+                        help='Outlier cutoff value. Default to 6.0',
+                        default=6.0)
+    parser.add_argument('-F', '--filter',
+                        type=str,
+                        action='append',
+                        help='Extra chain to compare, as comma separated stage specs. Can be repeated',
+                        default=[])
+    args = parser.parse_args()
+
+    clean, noisy = make_stream(args.duration, args.sample_rate)
+    tick = int(round(args.sample_rate * args.refresh_rate))
+    truth = clean[tick - 1::tick]
+    print(f"{len(noisy)} samples at {args.sample_rate} SPS, {tick} samples per tick")
+
+    chains = [
+        f"outlier:{args.cutoff},cic:{tick}:1",
+        f"outlier:{args.cutoff},cic:{tick}:3",
+        f"outlier:{args.cutoff},fir:{tick}",
+        f"outlier:{args.cutoff},cic:{tick // 4}:3,ema:0.5",
+        f"outlier:{args.cutoff},cic:{tick}:3,kalman:1000:25:{args.refresh_rate}",
+    ] + args.filter
+
+    runs: List[Tuple[str, Callable[[], List[float]]]] = [
+        (f"per sample buffer:{tick}", lambda: run_per_sample(noisy, tick, tick, args.cutoff)),
+    ]
+    buffer = Buffer(tick)
+
+    def process_buffer(block: np.ndarray) -> float:
+        buffer.add_many(block)
+        return buffer.get(args.cutoff)
+    runs.append((f"block buffer:{tick}", lambda: run_blocks(noisy, tick, process_buffer)))
+
+    for spec in chains:
+        chain = parse_filter_chain(spec.split(','))
+
+        def process_chain(block: np.ndarray, chain=chain) -> float:
+            out = chain.process(block)
+            return float(out[-1]) if len(out) else np.nan
+        runs.append((spec, lambda process=process_chain: run_blocks(noisy, tick, process)))
+
+    # ticks away from the plume, where the error is noise rather than lag
+    tick_times = np.arange(1, len(truth) + 1) * args.refresh_rate
+    steady = np.abs(tick_times - args.duration / 2) > 10
+
+    print(f"  {'filter':<48} {'us/sample':>10} {'Msamples/s':>11} {'rms error':>10} {'steady rms':>11} {'max error':>10}")
+    for label, run in runs:
+        start = time.perf_counter()
+        published = np.array(run())
+        elapsed = time.perf_counter() - start
+        error = published - truth[:len(published)]
+        # skip the first second while the filters settle
+        error[:int(1 / args.refresh_rate)] = np.nan
+        print(f"  {label:<48} {elapsed / len(noisy) * 1e6:>10.3f} {len(noisy) / elapsed / 1e6:>11.2f} "
+              f"{float(np.sqrt(np.nanmean(error ** 2))):>10.2f} {float(np.sqrt(np.nanmean(error[steady[:len(error)]] ** 2))):>11.2f} "
+              f"{float(np.nanmax(np.abs(error))):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import math
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gasmap import METERS_PER_DEGREE, GasGrid, PositionTrack
+
+
+def survey(points: int, size: float, seed: int = 0):
+    """Lawnmower flight over a square of size meters through a gaussian plume, at 10 readings per second"""
+    rng = np.random.default_rng(seed)
+    lanes = 40
+    progress = np.linspace(0, lanes, points)
+    lane = np.minimum(np.floor(progress), lanes - 1)
+    along = (progress - lane) * size
+    east = np.where(lane % 2 == 0, along, size - along)
+    north = lane * size / lanes + rng.normal(0, 1, points)
+    ppm = 420 + 600 * np.exp(-((north - 0.7 * size) ** 2 + (east - 0.3 * size) ** 2) / (2 * 60 ** 2)) + rng.normal(0, 5, points)
+    lat = 47.0 + north / METERS_PER_DEGREE
+    lon = 8.0 + east / (METERS_PER_DEGREE * math.cos(math.radians(47.0)))
+    return lat, lon, ppm, np.arange(points) * 0.1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure gas map update and plume query times over a synthetic survey flight')
+    parser.add_argument('-n', '--points',
+                        type=int,
+                        help='Readings of the flight. Default to 500000',
+                        default=500_000)
+    parser.add_argument('-a', '--area',
+                        type=float,
+                        help='Side of the surveyed square in meters. Default to 2000',
+                        default=2000.0)
+    parser.add_argument('-c', '--cell-size',
+                        type=float,
+                        help='Side of a map cell in meters. Default to 5',
+                        default=5.0)
+    parser.add_argument('-r', '--radius',
+                        type=float,
+                        nargs='+',
+                        help='Query radii in meters. Default to 25 100 250',
+                        default=[25.0, 100.0, 250.0])
+    args = parser.parse_args()
+
+    lat, lon, ppm, timestamps = survey(args.points, args.area)
+
+    # one reading per update, as the mapper adds them between two fixes
+    grid = GasGrid(args.cell_size)
+    lat_list, lon_list, ppm_list, time_list = lat.tolist(), lon.tolist(), ppm.tolist(), timestamps.tolist()
+    start = time.perf_counter()
+    for i in range(args.points):
+        grid.add(lat_list[i], lon_list[i], ppm_list[i], time_list[i])
+    single = (time.perf_counter() - start) / args.points
+    print(f"{args.points} readings in {np.count_nonzero(grid.count)} cells of {args.cell_size:g} m, grid {grid.count.shape[0]}x{grid.count.shape[1]}")
+    print(f"update, one reading:        {single * 1e6:8.1f} us")
+
+    block_grid = GasGrid(args.cell_size)
+    start = time.perf_counter()
+    for i in range(0, args.points, 50):
+        block_grid.add_many(lat[i:i + 50], lon[i:i + 50], ppm[i:i + 50], timestamps[i:i + 50])
+    print(f"update, blocks of 50:       {(time.perf_counter() - start) / args.points * 1e6:8.1f} us per reading")
+    assert np.array_equal(np.sort(grid.count[grid.count > 0]), np.sort(block_grid.count[block_grid.count > 0]))
+
+    track = PositionTrack()
+    for i in range(0, 1024 * 5, 5):
+        track.add(timestamps[i], lat[i], lon[i], 50.0)
+    at = timestamps[1000:1005]
+    start = time.perf_counter()
+    for _ in range(10000):
+        track.interpolate(at)
+    print(f"interpolate 5 readings:     {(time.perf_counter() - start) / 10000 * 1e6:8.1f} us")
+
+    rng = np.random.default_rng(1)
+    queries = rng.integers(0, args.points, 2000)
+    for radius in args.radius:
+        found = 0
+        start = time.perf_counter()
+        for i in queries.tolist():
+            hotspot = grid.query(lat_list[i], lon_list[i], radius)
+            found += hotspot is not None
+        elapsed = (time.perf_counter() - start) / len(queries)
+        print(f"query within {radius:5g} m:      {elapsed * 1e6:8.1f} us ({found}/{len(queries)} found)")
+
+    hotspot = grid.query(lat[0], lon[0], args.area * 2)
+    print(f"plume of the whole map: {hotspot.value:.0f} ppm at {hotspot.lat:.6f}, {hotspot.lon:.6f}")
+
+
+if __name__ == "__main__":
+    main()
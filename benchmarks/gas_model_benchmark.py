@@ -0,0 +1,65 @@
+import argparse
+import math
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# calibration values of typical sensors if none are configured
+os.environ.setdefault('RZERO', '76.63')
+os.environ.setdefault('ATMOCO2', '420')
+from mq135 import MQ135, MQ135GasModel
+
+
+def per_gas(mq135: MQ135, model: MQ135GasModel, values: np.ndarray) -> np.ndarray:
+    """One converter object per gas: each converts the samples again and applies its own curve"""
+    columns = []
+    for gas in model.gases:
+        coefficient, exponent, ratio = model.CURVES[gas]
+        if ratio is not None:
+            coefficient *= math.pow(ratio * math.pow(mq135.ATMOCO2 / mq135.PARA, 1. / mq135.PARB), exponent)
+        reading = mq135.compute_many(values, 21.0, 35.0)
+        ratios = reading.corrected_rzero / (math.pow(mq135.ATMOCO2 / mq135.PARA, 1. / mq135.PARB) * mq135.RZERO)
+        with np.errstate(invalid='ignore'):
+            columns.append(coefficient * np.power(ratios, exponent))
+    return np.stack(columns, axis=-1)
+
+
+def shared(mq135: MQ135, model: MQ135GasModel, values: np.ndarray) -> np.ndarray:
+    """One conversion of the samples and one broadcast of every curve"""
+    return model.compute_many(model.get_ratios(mq135.compute_many(values, 21.0, 35.0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare one converter per gas against the broadcast multi-gas model')
+    parser.add_argument('-n', '--samples',
+                        type=int,
+                        nargs='+',
+                        help='Samples per block. Default to 1 100 860',
+                        default=[1, 100, 860])
+    parser.add_argument('-r', '--repeats',
+                        type=int,
+                        help='Blocks per run. Default to 2000',
+                        default=2000)
+    args = parser.parse_args()
+
+    mq135 = MQ135(None, 65536)
+    rng = np.random.default_rng(0)
+    print(f"{'samples':>8} {'gases':>6} {'per gas us':>11} {'model us':>9} {'max rel err':>12}")
+    for samples in args.samples:
+        values = np.round(rng.normal(40000, 500, samples))
+        for gases in range(1, len(MQ135GasModel.CURVES) + 1):
+            model = MQ135GasModel(mq135, list(MQ135GasModel.CURVES)[:gases])
+            results = []
+            for method in (per_gas, shared):
+                start = time.perf_counter()
+                for _ in range(args.repeats):
+                    method(mq135, model, values)
+                results.append((time.perf_counter() - start) / args.repeats * 1e6)
+            error = np.nanmax(np.abs(shared(mq135, model, values) / per_gas(mq135, model, values) - 1))
+            print(f"{samples:>8} {gases:>6} {results[0]:>11.1f} {results[1]:>9.1f} {error:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
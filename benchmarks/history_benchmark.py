@@ -0,0 +1,90 @@
+import argparse
+import os
+import sys
+import time
+import redis
+from typing import Tuple
+from decouple import config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import HistoryReader, RedisPublisher, SensorReadingFieldNames, get_fields, get_history_schema_key
+
+STREAM = "HISTORY_BENCHMARK"
+
+
+def publish(r: redis.Redis, ticks: int, batch_ticks: int, history_maxlen: int) -> Tuple[float, int]:
+    """Publish the gas fields of a number of ticks, polling the latest GAS_VALUE key after every batch like the poll mode forwarder
+
+    Returns:
+        Tuple[float, int]: ticks per second and distinct values seen by the poller
+    """
+    publisher = RedisPublisher(r, 10, batch_ticks, history=STREAM, history_maxlen=history_maxlen)
+    seen = set()
+    start = time.perf_counter()
+    for i in range(ticks):
+        value = 20000 + i
+        publisher.set(SensorReadingFieldNames.GAS_SENSOR_VOLTAGE, value * 4.096 / 32767)
+        publisher.set(SensorReadingFieldNames.GAS_SENSOR_VALUE, value)
+        publisher.set(SensorReadingFieldNames.GAS_SENSOR_PERCENT, value / 65536 * 100)
+        publisher.set(SensorReadingFieldNames.GAS_PPM, value / 100)
+        if publisher.tick():
+            seen.add(get_fields(r, [SensorReadingFieldNames.GAS_SENSOR_VALUE.value])[SensorReadingFieldNames.GAS_SENSOR_VALUE.value])
+    publisher.flush()
+    return ticks / (time.perf_counter() - start), len(seen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of the history streams against a local redis-server: publish rate, '
+                                                 'ticks recovered against latest value polling, bulk read rate and redis memory per record')
+    parser.add_argument('-p', '--password',
+                        type=str,
+                        help='Redis password. Default to REDIS_PASSWORD env variable',
+                        default=config('REDIS_PASSWORD', default=''))
+    parser.add_argument('-H', '--host',
+                        type=str,
+                        help='Redis host. Default to REDIS_HOST env variable or 127.0.0.1',
+                        default=config('REDIS_HOST', default='127.0.0.1'))
+    parser.add_argument('-P', '--port',
+                        type=int,
+                        help='Redis port. Default to REDIS_PORT env variable or 6379',
+                        default=config('REDIS_PORT', default=6379, cast=int))
+    parser.add_argument('-n', '--ticks',
+                        type=int,
+                        help='Number of ticks per run. Default to 20000',
+                        default=20000)
+    parser.add_argument('-b', '--batch-ticks',
+                        type=int,
+                        help='Ticks per publisher flush. Default to 4',
+                        default=4)
+    parser.add_argument('-m', '--maxlen',
+                        type=int,
+                        help='Approximate length of the stream. Default to 100000',
+                        default=100000)
+    args = parser.parse_args()
+
+    r = redis.Redis(host=args.host, port=args.port, password=args.password)
+    r.ping()
+
+    print(f"{'history':>8} {'ticks/s':>10} {'ticks seen':>11}")
+    for maxlen in (0, args.maxlen):
+        r.delete(STREAM)
+        rate, seen = publish(r, args.ticks, args.batch_ticks, maxlen)
+        reader = HistoryReader(r, [STREAM])
+        if maxlen:
+            start = time.perf_counter()
+            records = reader.range(STREAM)
+            read_rate = len(records) / (time.perf_counter() - start)
+            seen = len({record.values[SensorReadingFieldNames.GAS_SENSOR_VALUE.value] for record in records})
+        print(f"{'on' if maxlen else 'off':>8} {rate:>10.0f} {seen:>11}")
+
+    print(f"stream of {r.xlen(STREAM)} records for {args.ticks} ticks, read back at {read_rate:.0f} records/s")
+    try:
+        memory = r.memory_usage(STREAM, samples=0)
+        print(f"redis memory {memory / 1024:.0f} KiB, {memory / r.xlen(STREAM):.1f} bytes per record")
+    except redis.exceptions.ResponseError:
+        print("redis memory not reported by this server")
+    r.delete(STREAM, get_history_schema_key(STREAM))
+
+
+if __name__ == "__main__":
+    main()
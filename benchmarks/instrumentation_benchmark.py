@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import MetricsRegistry, Logger, set_log_level
+from buffers import Buffer
+from utils import print_if_debug
+
+
+def measure(name: str, step: Callable[[int], None], count: int) -> None:
+    """Print the time per call of a step"""
+    start = time.perf_counter()
+    for i in range(count):
+        step(i)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>28} {elapsed / count * 1e9:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the cost of disabled eager logs against the lazy logger, and of the metrics')
+    parser.add_argument('-n', '--count',
+                        type=int,
+                        help='Calls per measure. Default to 200000',
+                        default=200000)
+    parser.add_argument('-b', '--buffer-size',
+                        type=int,
+                        help='Buffer size of the outlier counting measure. Default to 10',
+                        default=10)
+    args = parser.parse_args()
+
+    set_log_level('info')
+    log = Logger("benchmark")
+    registry = MetricsRegistry()
+    counter = registry.counter("benchmark_total")
+    timer = registry.timer("benchmark_ms")
+    reading = {"rzero": 76.63, "corrected_rzero": 75.1, "resistance": 41.2, "ppm": 412.5, "corrected_ppm": 420.3}
+
+    print(f"{'disabled debug log / metric':>28} {'ns/call':>9}")
+    measure("eager concatenation", lambda i: print_if_debug("MQ135 RZero: " + str(reading["rzero"]) + "\t Corrected RZero: " + str(reading["corrected_rzero"]) +
+                                                            "\t Resistance: " + str(reading["resistance"]) + "\t PPM: " + str(reading["ppm"]) +
+                                                            "\t Corrected PPM: " + str(reading["corrected_ppm"]) + "ppm", False), args.count)
+    measure("eager f-string", lambda i: print_if_debug(f"Sent GAS_PPM to drone: {reading['ppm']}", False), args.count)
+    measure("lazy arguments", lambda i: log.debug("Sent %s to drone: %s", "GAS_PPM", reading["ppm"]), args.count)
+    measure("lazy fields", lambda i: log.debug("MQ135 reading", **reading), args.count)
+    measure("counter", lambda i: counter.inc(), args.count)
+
+    def timed(i: int) -> None:
+        start = timer.start()
+        timer.stop(start)
+    measure("timer", timed, args.count)
+
+    values = [20000.0 + (i * 7919) % 101 for i in range(args.count)]
+    plain, counted = Buffer(args.buffer_size), Buffer(args.buffer_size, "benchmark_buffer")
+
+    def plain_tick(i: int) -> None:
+        plain.add(values[i])
+        plain.get()
+
+    def counted_tick(i: int) -> None:
+        counted.add(values[i])
+        counted.get()
+    measure("buffer tick", plain_tick, args.count)
+    measure("buffer tick with outliers", counted_tick, args.count)
+
+
+if __name__ == "__main__":
+    main()
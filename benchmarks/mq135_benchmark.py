@@ -0,0 +1,91 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# calibration values are only needed to build the tables, use typical ones if none are configured
+os.environ.setdefault('RZERO', '76.63')
+os.environ.setdefault('ATMOCO2', '420')
+from mq135 import MQ135, MQ135LookupTable
+
+
+class FakeADC:
+    """Stand-in for AnalogIn, only the gain is used by the conversion"""
+
+    class _ads:
+        gain = 1
+
+
+def time_call(fn, repeat: int) -> float:
+    """Best time of a call over repeats
+
+    Returns:
+        float: seconds of the fastest call
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the MQ135 lookup table against the closed form conversion')
+    parser.add_argument('-n', '--samples',
+                        type=int,
+                        help='Samples per block. Default to 100000',
+                        default=100000)
+    parser.add_argument('-s', '--sensor-max-value',
+                        type=int,
+                        help='Sensor max value. Default to 65536',
+                        default=65536)
+    parser.add_argument('-r', '--repeat',
+                        type=int,
+                        help='Timing repeats, the best is kept. Default to 5',
+                        default=5)
+    args = parser.parse_args()
+
+    mq135 = MQ135(FakeADC(), args.sensor_max_value)
+    cache_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    table = MQ135LookupTable(mq135, cache_dir)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    table = MQ135LookupTable(mq135, cache_dir)
+    load = time.perf_counter() - start
+    print(f"table build {build * 1e3:.1f} ms, cached load {load * 1e3:.1f} ms, {os.path.getsize(table.path) / 1e6:.1f} MB")
+
+    rng = np.random.default_rng(0)
+    raw = rng.integers(1, 32767, args.samples)
+    temperature = rng.uniform(-10, 45, args.samples)
+    humidity = rng.uniform(5, 95, args.samples)
+
+    # accuracy over random codes, temperatures and humidities
+    exact = mq135.compute_many(raw, temperature, humidity)
+    lookup = table.compute_many(raw, temperature, humidity)
+    print(f"  {'field':>16} {'max rel error':>14}")
+    for field in ('rzero', 'corrected_rzero', 'ppm', 'corrected_ppm'):
+        expected = getattr(exact, field)
+        error = np.abs(getattr(lookup, field) - expected) / np.abs(expected)
+        print(f"  {field:>16} {float(np.nanmax(error)):>14.2e}")
+
+    # throughput of one block at the temperature and humidity of the tick, as gas_sensors.py converts it
+    values = raw.astype(float)
+    runs = (
+        ("closed form, per reading", lambda: [mq135.compute(v, 21.5, 40.) for v in raw[:args.samples // 100].tolist()], args.samples // 100),
+        ("closed form, block", lambda: mq135.compute_many(values, 21.5, 40.), args.samples),
+        ("lookup table, block", lambda: table.compute_many(values, 21.5, 40.), args.samples),
+        ("closed form, block, per sample T/H", lambda: mq135.compute_many(values, temperature, humidity), args.samples),
+        ("lookup table, block, per sample T/H", lambda: table.compute_many(values, temperature, humidity), args.samples),
+    )
+    print(f"  {'conversion':>36} {'samples/s':>12}")
+    for label, fn, count in runs:
+        print(f"  {label:>36} {count / time_call(fn, args.repeat):>12.3g}")
+
+
+if __name__ == "__main__":
+    main()
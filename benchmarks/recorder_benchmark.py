@@ -0,0 +1,74 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from recorder import FlightRecorder, FlightRecording
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure flight recorder append rates and commit latency')
+    parser.add_argument('-d', '--directory',
+                        type=str,
+                        help='Directory of the test recording, e.g. on the SD card. Default to a temp directory',
+                        default=None)
+    parser.add_argument('-n', '--rows',
+                        type=int,
+                        help='Number of rows per run. Default to 500000',
+                        default=500_000)
+    parser.add_argument('-k', '--block-size',
+                        type=int,
+                        help='Rows per append_many() call, e.g. the samples of one refresh. Default to 86',
+                        default=86)
+    parser.add_argument('-s', '--segment-rows',
+                        type=int,
+                        nargs='+',
+                        help='Segment sizes to benchmark. Default to 1024 4096 16384',
+                        default=[1024, 4096, 16384])
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp()
+    path = os.path.join(directory, 'benchmark.rec')
+    values = np.arange(args.rows) % 32768
+    timestamps = time.monotonic() + np.arange(args.rows) / 860
+    ppm = 400 + values * 1e-3
+
+    print(f"{'segment':>8} {'block rows/s':>13} {'scalar rows/s':>14} {'commit ms':>10} {'read ms':>8}")
+    for segment_rows in args.segment_rows:
+        recorder = FlightRecorder(path, args.rows * 2, segment_rows)
+        start = time.perf_counter()
+        for i in range(0, args.rows, args.block_size):
+            block = slice(i, i + args.block_size)
+            recorder.append_many(timestamps[block], values[block], ppm[block], 25.0, 35.0, ppm[block], ppm[block], ppm[block], ppm[block])
+        block_rate = args.rows / (time.perf_counter() - start)
+
+        scalar_rows = min(args.rows, 50_000)
+        start = time.perf_counter()
+        for i in range(scalar_rows):
+            recorder.append(timestamps[i], values[i], 0.5, 25.0, 35.0, 10.0, 10.0, 400.0, 410.0)
+        scalar_rate = scalar_rows / (time.perf_counter() - start)
+
+        # fill the segment but one row, the last row commits it
+        remaining = segment_rows - 1 - recorder.count % segment_rows
+        recorder.append_many(timestamps[:remaining], 0, 0.5, 25.0, 35.0, 10.0, 10.0, 400.0, 410.0)
+        start = time.perf_counter()
+        recorder.append(timestamps[0], values[0], 0.5, 25.0, 35.0, 10.0, 10.0, 400.0, 410.0)
+        commit_ms = (time.perf_counter() - start) * 1000
+        recorder.close()
+
+        start = time.perf_counter()
+        recording = FlightRecording(path)
+        mean = float(recording['ppm'].mean())
+        read_ms = (time.perf_counter() - start) * 1000
+        assert len(recording) == recorder.count and mean > 0
+
+        print(f"{segment_rows:>8} {block_rate:>13.0f} {scalar_rate:>14.0f} {commit_ms:>10.2f} {read_ms:>8.2f}")
+        del recording
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
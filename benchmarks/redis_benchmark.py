@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import time
+import redis
+from decouple import config
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import RedisPublisher, SensorReadingFieldNames, get_fields
+
+
+class CountingConnection(redis.Connection):
+    """Redis connection that counts the requests sent to the server"""
+
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def tick_before(r: redis.Redis, publisher: RedisPublisher, value: int, expire_time: int) -> None:
+    """One gas loop tick as it was before the publisher: two GETs and four SETs"""
+    r.get(SensorReadingFieldNames.TEMPERATURE)
+    r.get(SensorReadingFieldNames.HUMIDITY)
+    r.set(SensorReadingFieldNames.GAS_SENSOR_VOLTAGE, value * 4.096 / 32767, ex=expire_time)
+    r.set(SensorReadingFieldNames.GAS_SENSOR_VALUE, value, ex=expire_time)
+    r.set(SensorReadingFieldNames.GAS_SENSOR_PERCENT, value / 65536 * 100, ex=expire_time)
+    r.set(SensorReadingFieldNames.GAS_PPM, value / 100, ex=expire_time)
+
+
+def tick_after(r: redis.Redis, publisher: RedisPublisher, value: int, expire_time: int) -> None:
+    """One gas loop tick with one MGET and the writes queued on the publisher"""
+    get_fields(r, (SensorReadingFieldNames.TEMPERATURE, SensorReadingFieldNames.HUMIDITY))
+    publisher.set(SensorReadingFieldNames.GAS_SENSOR_VOLTAGE, value * 4.096 / 32767)
+    publisher.set(SensorReadingFieldNames.GAS_SENSOR_VALUE, value)
+    publisher.set(SensorReadingFieldNames.GAS_SENSOR_PERCENT, value / 65536 * 100)
+    publisher.set(SensorReadingFieldNames.GAS_PPM, value / 100)
+    publisher.tick()
+
+
+def run(r: redis.Redis, tick, batch_ticks: int, ticks: int, expire_time: int):
+    """Run the tick function as fast as possible
+
+    Returns:
+        Tuple[float, float]: round trips per tick and ticks per second
+    """
+    publisher = RedisPublisher(r, expire_time, batch_ticks)
+    CountingConnection.round_trips = 0
+    start = time.perf_counter()
+    for i in range(ticks):
+        tick(r, publisher, 20000 + i % 100, expire_time)
+    publisher.flush()
+    elapsed = time.perf_counter() - start
+    return CountingConnection.round_trips / ticks, ticks / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure redis round trips per gas loop tick against a local redis-server')
+    parser.add_argument('-p', '--password',
+                        type=str,
+                        help='Redis password. Default to REDIS_PASSWORD env variable',
+                        default=config('REDIS_PASSWORD', default=''))
+    parser.add_argument('-H', '--host',
+                        type=str,
+                        help='Redis host. Default to REDIS_HOST env variable or 127.0.0.1',
+                        default=config('REDIS_HOST', default='127.0.0.1'))
+    parser.add_argument('-P', '--port',
+                        type=int,
+                        help='Redis port. Default to REDIS_PORT env variable or 6379',
+                        default=config('REDIS_PORT', default=6379, cast=int))
+    parser.add_argument('-n', '--ticks',
+                        type=int,
+                        help='Number of ticks per run. Default to 5000',
+                        default=5000)
+    parser.add_argument('-b', '--batch-ticks',
+                        type=int,
+                        nargs='+',
+                        help='Batch sizes to benchmark for the publisher. Default to 1 4 16',
+                        default=[1, 4, 16])
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool(connection_class=CountingConnection, host=args.host, port=args.port, password=args.password)
+    r = redis.Redis(connection_pool=pool)
+    r.ping()
+
+    print(f"{'mode':>12} {'round trips/tick':>17} {'ticks/s':>10}")
+    round_trips, rate = run(r, tick_before, 1, args.ticks, 10)
+    print(f"{'before':>12} {round_trips:>17.2f} {rate:>10.0f}")
+    for batch_ticks in args.batch_ticks:
+        round_trips, rate = run(r, tick_after, batch_ticks, args.ticks, 10)
+        print(f"{'batch ' + str(batch_ticks):>12} {round_trips:>17.2f} {rate:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
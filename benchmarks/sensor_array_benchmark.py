@@ -0,0 +1,98 @@
+import argparse
+import os
+import sys
+import time
+from typing import Dict
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# calibration values of typical sensors if none are configured
+os.environ.setdefault('RZERO', '76.63')
+os.environ.setdefault('ATMOCO2', '420')
+from gas_sensors import GasArrayReader, GasReader
+from mq135 import MQ135
+from sensors import GasSensor
+from buffers import Buffer, BufferArray
+
+
+class FakeChannel:
+    """Stand-in for ADCChannel returning noisy codes without I2C"""
+
+    class _ads:
+        gain = 1
+
+    def __init__(self, seed: int):
+        self.rng = np.random.default_rng(seed)
+        self.rate = 0
+
+    @property
+    def value(self) -> int:
+        return int(20000 + self.rng.normal(0, 50))
+
+
+class CountingPublisher:
+    """Stand-in for RedisPublisher counting the values and transactions of the ticks"""
+
+    def __init__(self):
+        self.pending: Dict[str, float] = dict()
+        self.values = 0
+        self.transactions = 0
+
+    def set(self, key: str, value: float, ex=None, timestamp=None) -> None:
+        self.pending[key] = value
+
+    def tick(self) -> bool:
+        self.values += len(self.pending)
+        self.transactions += 1 if self.pending else 0
+        self.pending.clear()
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare one GasReader per sensor against the vectorized GasArrayReader')
+    parser.add_argument('-n', '--sensors',
+                        type=int,
+                        nargs='+',
+                        help='Sensor counts to benchmark. Default to 1 4 8 16',
+                        default=[1, 4, 8, 16])
+    parser.add_argument('-t', '--ticks',
+                        type=int,
+                        help='Ticks per run. Default to 2000',
+                        default=2000)
+    parser.add_argument('-b', '--buffer-size',
+                        type=int,
+                        help='Buffer size of each sensor. Default to 10',
+                        default=10)
+    args = parser.parse_args()
+
+    print(f"{'sensors':>8} {'reader':>8} {'us/tick':>9} {'values/tick':>12} {'transactions/tick':>18}")
+    for count in args.sensors:
+        sensors = [GasSensor(f"G{i}", 0x48 + i // 4, i % 4, 76.63) for i in range(count)]
+
+        # one reader per sensor, the process per sensor setup without its redis connections
+        publisher = CountingPublisher()
+        readers = [GasReader(MQ135(FakeChannel(i), 65536), MQ135(FakeChannel(i), 65536), Buffer(args.buffer_size), publisher)
+                   for i in range(count)]
+        start = time.perf_counter()
+        for _ in range(args.ticks):
+            for reader in readers:
+                reader.read(21.0, 35.0)
+                publisher.tick()
+        elapsed = time.perf_counter() - start
+        print(f"{count:>8} {'single':>8} {elapsed / args.ticks * 1e6:>9.1f} {publisher.values / args.ticks:>12.1f} "
+              f"{publisher.transactions / args.ticks:>18.1f}")
+
+        publisher = CountingPublisher()
+        array_reader = GasArrayReader(sensors, [FakeChannel(i) for i in range(count)], MQ135(None, 65536),
+                                      BufferArray(count, args.buffer_size), publisher)
+        start = time.perf_counter()
+        for _ in range(args.ticks):
+            array_reader.read(21.0, 35.0)
+            publisher.tick()
+        elapsed = time.perf_counter() - start
+        print(f"{count:>8} {'array':>8} {elapsed / args.ticks * 1e6:>9.1f} {publisher.values / args.ticks:>12.1f} "
+              f"{publisher.transactions / args.ticks:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+from decouple import config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# calibration values of typical sensors if none are configured
+os.environ.setdefault('RZERO', '76.63')
+os.environ.setdefault('ATMOCO2', '420')
+from end_to_end_benchmark import RouterStandIn, connect
+from sensors import get_field_names
+from utils import SENSOR_UPDATES_CHANNELS, SensorReadingFieldNames, decode_sensor_update
+
+# modules slow to import or touching the hardware, listed when a service imports them
+HEAVY_MODULES = ('board', 'busio', 'adafruit_ads1x15', 'numpy', 'redis', 'http.server', 'pymavlink')
+SERVICES = ('gas_sensors', 'temp_sensors', 'mavlink', 'runtime')
+
+IMPORT_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'ms': (time.perf_counter() - start) * 1000, 'modules': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module: str, env: Dict[str, str], runs: int) -> Tuple[float, List[str]]:
+    """Median import time of a module in a fresh interpreter, and the heavy modules it loads
+
+    Returns:
+        Tuple[float, List[str]]: milliseconds and heavy modules
+    """
+    times = []
+    modules: List[str] = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=ROOT, env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            raise SystemExit(f"Importing {module} failed:\n{output.stderr}")
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        times.append(result['ms'])
+        modules = result['modules']
+    return statistics.median(times), modules
+
+
+def measure_interpreter(env: Dict[str, str], runs: int) -> float:
+    """Median milliseconds to start and exit an empty interpreter"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], cwd=ROOT, env=env, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def wait_first_value(process: subprocess.Popen, poll, timeout: float) -> Optional[float]:
+    """Wait for the first value of a service
+
+    Args:
+        process (subprocess.Popen): the service
+        poll (Callable[[], Optional[float]]): unix time of the first value, None until there is one
+        timeout (float): seconds to wait
+
+    Returns:
+        Optional[float]: unix time of the first value, None on timeout or if the service exited
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline and process.poll() is None:
+        received = poll()
+        if received is not None:
+            return received
+        time.sleep(0.001)
+    return None
+
+
+def stop(process: subprocess.Popen) -> None:
+    """Stop a service like Ctrl+C"""
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start of each service on a hardware-free ADC backend: import time, heavy modules '
+                                                 'loaded, and time from process start to the first published value')
+    parser.add_argument('-n', '--runs',
+                        type=int,
+                        help='Runs per measure, the median is reported. Default to 5',
+                        default=5)
+    parser.add_argument('-B', '--backend',
+                        type=str,
+                        help='ADC_BACKEND of the services, see adc_backends.py. Default to synthetic',
+                        default='synthetic')
+    parser.add_argument('-s', '--service',
+                        choices=SERVICES,
+                        action='append',
+                        help='Service to measure, repeat for several. Default to every service',
+                        default=None)
+    parser.add_argument('-t', '--timeout',
+                        type=float,
+                        help='Seconds to wait for the first value of a run. Default to 30',
+                        default=30.0)
+    parser.add_argument('--budget',
+                        type=float,
+                        help='Seconds from process start to the first value a service may take, exit with 1 if one takes longer. Default to no budget',
+                        default=None)
+    parser.add_argument('-P', '--router-port',
+                        type=int,
+                        help='Local port for the mavlink-router stand-in. Default to 15762',
+                        default=15762)
+    parser.add_argument('-p', '--password',
+                        type=str,
+                        help='Redis password. Default to REDIS_PASSWORD env variable',
+                        default=config('REDIS_PASSWORD', default=''))
+    parser.add_argument('-H', '--host',
+                        type=str,
+                        help='Redis host. Default to REDIS_HOST env variable or 127.0.0.1',
+                        default=config('REDIS_HOST', default='127.0.0.1'))
+    parser.add_argument('--port',
+                        type=int,
+                        help='Redis port, a redis-server is started there if none answers. Default to REDIS_PORT env variable or 6379',
+                        default=config('REDIS_PORT', default=6379, cast=int))
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help='Write the results to this JSON file',
+                        default=None)
+    parser.add_argument('-v', '--verbose',
+                        action='store_true',
+                        help='Show the output of the services')
+    args = parser.parse_args()
+    services = args.service or list(SERVICES)
+
+    env = dict(os.environ, ADC_BACKEND=args.backend, REDIS_HOST=args.host, REDIS_PORT=str(args.port), REDIS_PASSWORD=args.password,
+               MAVLINK_ROUTER_HOST='127.0.0.1')
+    interpreter_ms = measure_interpreter(env, args.runs)
+    imports = {service: measure_import(service, env, args.runs) for service in services}
+
+    r, server = connect(args.host, args.port, args.password, True)
+    router = RouterStandIn(args.router_port)
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*SENSOR_UPDATES_CHANNELS)
+    # the poll mode of the mavlink service sends the fields it finds, so give it some
+    for field in get_field_names():
+        r.set(field, 1.0, ex=600)
+
+    def first_update(field: str):
+        def poll() -> Optional[float]:
+            message = pubsub.get_message(timeout=0.01)
+            if message is not None and field in decode_sensor_update(message['data']):
+                return time.time()
+            return None
+        return poll
+
+    def first_message() -> Optional[float]:
+        return router.values[0][2] if router.values else None
+
+    python = sys.executable
+    runs = {
+        'gas_sensors': ([python, 'gas_sensors.py'], first_update(SensorReadingFieldNames.GAS_PPM.value)),
+        'temp_sensors': ([python, 'temp_sensors.py'], first_update(SensorReadingFieldNames.TEMPERATURE.value)),
+        'mavlink': ([python, 'mavlink.py', '-P', str(args.router_port), '-m', 'poll'], first_message),
+        'runtime': ([python, 'runtime.py', '-P', str(args.router_port)], first_message),
+    }
+    output = None if args.verbose else subprocess.DEVNULL
+    first_values: Dict[str, float] = dict()
+    try:
+        for service in services:
+            command, poll = runs[service]
+            times = []
+            for _ in range(args.runs):
+                # drop what earlier runs left
+                while pubsub.get_message(timeout=0) is not None:
+                    pass
+                router.values.clear()
+                start = time.time()
+                process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=output, stderr=output)
+                received = wait_first_value(process, poll, args.timeout)
+                stop(process)
+                if received is None:
+                    raise SystemExit(f"{service} published nothing within {args.timeout} s, run with -v to see why")
+                times.append(received - start)
+            first_values[service] = statistics.median(times)
+    finally:
+        pubsub.close()
+        if server is not None:
+            server.terminate()
+
+    print(f"empty interpreter {interpreter_ms:.0f} ms")
+    print(f"{'service':>13} {'import ms':>10} {'first value ms':>15}  heavy modules")
+    for service in services:
+        import_ms, modules = imports[service]
+        print(f"{service:>13} {import_ms:>10.0f} {first_values[service] * 1000:>15.0f}  {', '.join(modules) or '-'}")
+
+    results = {'backend': args.backend, 'interpreter_ms': interpreter_ms,
+               'services': {service: {'import_ms': imports[service][0], 'modules': imports[service][1],
+                                      'first_value_ms': first_values[service] * 1000} for service in services}}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.budget is not None:
+        over = [service for service in services if first_values[service] > args.budget]
+        if over:
+            print(f"Over the budget of {args.budget} s: {', '.join(over)}")
+            exit(1)
+        print(f"Every service published within the budget of {args.budget} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import math
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mavlink import MavlinkMultiplexer, PackedSensorMavlinkConnection, SensorMavlinkConnection
+from utils import SensorReadingFieldNames
+
+
+class RouterStandIn:
+    """Local TCP server standing in for mavlink-router, counting the bytes it receives"""
+
+    def __init__(self, port: int):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', port))
+        self.server.listen()
+        self.received = 0
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self) -> None:
+        while True:
+            client, _ = self.server.accept()
+            threading.Thread(target=self.read, args=(client,), daemon=True).start()
+
+    def read(self, client: socket.socket) -> None:
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return
+            self.received += len(data)
+
+
+def tick_values(tick: int):
+    """Field values of one tick, with the fields that have no value as nan"""
+    return {
+        SensorReadingFieldNames.GAS_SENSOR_VOLTAGE.value: round(2.5 + 0.01 * math.sin(tick), 2),
+        SensorReadingFieldNames.GAS_PPM.value: round(420 + 5 * math.sin(tick / 10), 2),
+        SensorReadingFieldNames.GAS_SENSOR_VALUE.value: 20000 + tick % 50,
+        SensorReadingFieldNames.GAS_SENSOR_PERCENT.value: round(30.5 + 0.01 * (tick % 50), 2),
+        SensorReadingFieldNames.TEMPERATURE.value: 21.25,
+        SensorReadingFieldNames.HUMIDITY.value: float('nan'),
+    }
+
+
+def measure(router: RouterStandIn, multiplexer: MavlinkMultiplexer, send, ticks: int) -> float:
+    """Send ticks through the multiplexer and return the bytes received by the router per tick"""
+    time.sleep(0.2)
+    start = router.received
+    for tick in range(ticks):
+        send(tick_values(tick))
+        multiplexer.flush()
+
+    # wait for the router to read everything
+    time.sleep(0.5)
+    return (router.received - start) / ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare telemetry bytes/s of named value and packed encodings against a local TCP stand-in for mavlink-router')
+    parser.add_argument('-P', '--port',
+                        type=int,
+                        help='Local port for the router stand-in. Default to 15760',
+                        default=15760)
+    parser.add_argument('-n', '--ticks',
+                        type=int,
+                        help='Number of ticks per encoding. Default to 1000',
+                        default=1000)
+    parser.add_argument('-r', '--refresh-rate',
+                        type=float,
+                        help='Forwarder refresh rate in seconds used for bytes/s. Default to 0.2',
+                        default=0.2)
+    parser.add_argument('-b', '--baud',
+                        type=int,
+                        help='Telemetry radio baud rate. Default to 57600',
+                        default=57600)
+    args = parser.parse_args()
+
+    router = RouterStandIn(args.port)
+
+    named_multiplexer = MavlinkMultiplexer('127.0.0.1', args.port, 1)
+    senders = {name: SensorMavlinkConnection(name, named_multiplexer) for name in tick_values(0)}
+
+    def send_named(values):
+        for name, value in values.items():
+            senders[name].send(value)
+
+    packed_multiplexer = MavlinkMultiplexer('127.0.0.1', args.port, 1)
+    packed_sender = PackedSensorMavlinkConnection(packed_multiplexer)
+
+    # 8N1 serial framing sends 10 bits per byte
+    link_bytes = args.baud / 10
+    print(f"{'encoding':>9} {'bytes/tick':>11} {'bytes/s':>9} {'% of link':>10}")
+    for encoding, multiplexer, send in (('named', named_multiplexer, send_named), ('packed', packed_multiplexer, packed_sender.send)):
+        per_tick = measure(router, multiplexer, send, args.ticks)
+        per_second = per_tick / args.refresh_rate
+        print(f"{encoding:>9} {per_tick:>11.1f} {per_second:>9.1f} {100 * per_second / link_bytes:>9.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import argparse
+import csv
+import math
+import os
+import sys
+from typing import Dict, List, Tuple
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transmission import FieldPolicy, TransmissionScheduler, parse_policies
+
+
+def synthetic_traces(ticks: int, period: float, seed: int = 0) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Generate sensor traces of a flight crossing two gas plumes
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, np.ndarray]]: tick times in seconds and values of each field
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(ticks) * period
+    plume = 250 * np.exp(-((t - 0.3 * t[-1]) / 4) ** 2) + 600 * np.exp(-((t - 0.7 * t[-1]) / 2) ** 2)
+    ppm = 420 + plume + rng.normal(0, 1.5, ticks)
+    value = 20000 + 8 * plume + rng.normal(0, 10, ticks)
+    traces = {
+        "GAS_VOLTAGE": value * 4.096 / 32767,
+        "GAS_PPM": ppm,
+        "GAS_VALUE": np.round(value),
+        "GAS_PERCENT": value / 65536 * 100,
+        "TEMP": np.repeat(21 + 0.5 * np.sin(t[::50] / 60), 50)[:ticks],
+        "HUMIDITY": np.full(ticks, np.nan),
+    }
+    return t, {name: np.round(values, 2) for name, values in traces.items()}
+
+
+def load_traces(path: str) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """Load traces from a CSV with a timestamp column and one column per field, e.g. decode_telemetry.py output
+
+    Returns:
+        Tuple[np.ndarray, Dict[str, np.ndarray]]: tick times in seconds and values of each field
+    """
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    skip = {'timestamp', 'time_usec', 'sysid', 'compid', 'version'}
+    names = [name for name in rows[0] if name not in skip]
+    t = np.array([float(row['timestamp']) for row in rows])
+    traces = {name: np.array([float(row[name]) if row[name] else math.nan for row in rows]) for name in names}
+    return t - t[0], traces
+
+
+def simulate(t: np.ndarray, traces: Dict[str, np.ndarray], scheduler: TransmissionScheduler) -> Dict[str, Tuple[int, float, float]]:
+    """Feed the traces through the scheduler and reconstruct them with a zero-order hold
+
+    Returns:
+        Dict[str, Tuple[int, float, float]]: messages sent, RMS error and max absolute error of each field
+    """
+    names = list(traces)
+    received = {name: math.nan for name in names}
+    sent = {name: 0 for name in names}
+    errors: Dict[str, List[float]] = {name: [] for name in names}
+
+    for i, now in enumerate(t):
+        values = {name: float(traces[name][i]) for name in names}
+        for name in scheduler.select(values, float(now)):
+            received[name] = values[name]
+            sent[name] += 1
+        for name in names:
+            if not math.isnan(values[name]):
+                error = received[name] - values[name]
+                errors[name].append(abs(error) if not math.isnan(error) else math.inf)
+
+    result = dict()
+    for name in names:
+        e = np.array(errors[name]) if errors[name] else np.zeros(1)
+        finite = e[np.isfinite(e)]
+        rms = float(np.sqrt(np.mean(finite ** 2))) if len(finite) else 0.0
+        result[name] = (sent[name], rms, float(e.max()))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate the MAVLink transmission policy on recorded or synthetic traces')
+    parser.add_argument('-c', '--csv',
+                        type=str,
+                        help='CSV trace with a timestamp column and one column per field. Default to a synthetic plume flight',
+                        default=None)
+    parser.add_argument('-n', '--ticks',
+                        type=int,
+                        help='Synthetic trace ticks. Default to 3000',
+                        default=3000)
+    parser.add_argument('-r', '--refresh-rate',
+                        type=float,
+                        help='Synthetic trace refresh rate in seconds. Default to 0.05',
+                        default=0.05)
+    parser.add_argument('-F', '--field-policy',
+                        type=str,
+                        action='append',
+                        help='Policy of one field as FIELD=ABSOLUTE_DEADBAND:RELATIVE_DEADBAND:MAX_SILENCE:PRIORITY. Can be repeated',
+                        default=None)
+    parser.add_argument('-s', '--max-silence',
+                        type=float,
+                        help='Max silence in seconds of fields without a policy. Default to 1.0',
+                        default=1.0)
+    parser.add_argument('-B', '--byte-budget',
+                        type=float,
+                        help='Bytes per second for sensor messages, 0 for unlimited. Default to 300',
+                        default=300.0)
+    parser.add_argument('-m', '--message-bytes',
+                        type=int,
+                        help='Bytes of one message on the link. Default to 26',
+                        default=26)
+    args = parser.parse_args()
+
+    t, traces = load_traces(args.csv) if args.csv else synthetic_traces(args.ticks, args.refresh_rate)
+    default_policy = FieldPolicy(max_silence=args.max_silence)
+    policies = parse_policies(args.field_policy or [
+        "GAS_PPM=2:0.01:1:10",
+        "GAS_VALUE=20:0:2:5",
+        "GAS_VOLTAGE=0.01:0:2:1",
+        "GAS_PERCENT=0.05:0:2:1",
+        "TEMP=0.1:0:5:0",
+    ], default_policy)
+    duration = max(float(t[-1] - t[0]), 1e-9)
+
+    runs = (
+        ("every tick", TransmissionScheduler(dict(), FieldPolicy(max_silence=0.0), 0.0, args.message_bytes)),
+        ("policy", TransmissionScheduler(policies, default_policy, args.byte_budget, args.message_bytes)),
+    )
+    for label, scheduler in runs:
+        result = simulate(t, traces, scheduler)
+        total = sum(sent for sent, _, _ in result.values())
+        print(f"{label}: {total} messages, {total * args.message_bytes / duration:.1f} bytes/s over {duration:.1f} s")
+        print(f"  {'field':>12} {'messages':>9} {'rms error':>10} {'max error':>10}")
+        for name, (sent, rms, max_error) in result.items():
+            print(f"  {name:>12} {sent:>9} {rms:>10.3f} {max_error:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+Outlier rejecting moving averages of the sensor readings
+
+Buffer filters one sensor sample by sample, BufferArray the sensors of an array at once and
+filter_series a whole recorded series, all with the same median / MAD outlier rejection.
+"""
+import math
+from bisect import bisect_left, bisect_right, insort
+from typing import List, Optional, Tuple
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from instrumentation import METRICS, Counter
+
+
+def get_outlier_counters(name: str) -> Tuple[Counter, Counter]:
+    """Get the counters of the window values and outliers of a named filter
+
+    Their ratio is exported as the {name}_outlier_ratio gauge.
+
+    Returns:
+        Tuple[Counter, Counter]: values and outliers counters
+    """
+    values = METRICS.counter(f"{name}_values_total", f"{name} window values filtered")
+    outliers = METRICS.counter(f"{name}_outliers_total", f"{name} window values rejected as outliers")
+    METRICS.gauge(f"{name}_outlier_ratio", f"{name} outliers per filtered value",
+                  read=lambda: outliers.value / values.value if values.value else math.nan)
+    return values, outliers
+
+
+def _add_exact(partials: List[float], x: float) -> None:
+    """Add a finite value to an exact sum kept as non-overlapping partials, like math.fsum
+
+    Args:
+        partials (List[float]): partials of the sum, updated in place. Their math.fsum is the rounded sum
+        x (float): value to add
+    """
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+class Buffer:
+    """A circular buffer to store values and get the mean of the buffer without the nan values
+
+    Besides the ring of raw values, the buffer keeps the non-nan values of the window in a
+    sorted list together with the exact sum of its finite values. A new value only moves one
+    entry of the sorted window, so the median / MAD outlier-rejected mean is found with binary
+    searches instead of recomputing two full medians on every call. The sum is kept as the
+    non-overlapping partials of math.fsum, usually one or two floats, so subtracting an
+    outlier of any size neither cancels the inliers nor leaves an error once it is gone.
+    Infinite values are counted instead of summed.
+    """
+
+    def __init__(self, size: int, name: Optional[str] = None):
+        """Initialize the buffer
+
+        Args:
+            size (int): size of the buffer
+            name (Optional[str], optional): counts the values and outliers of each get as {name} metrics. Defaults to None.
+        """
+        self.size = size
+        self.counters = get_outlier_counters(name) if name else None
+        self.buffer = np.empty(size)
+        self.buffer[:] = np.nan
+        self.index = 0
+        self._sorted = []
+        self._partials: List[float] = []
+        self._infinite = 0
+        self._cached_m = None
+        self._cached_mean = np.nan
+
+    def add(self, value: float) -> None:
+        """Add a value to the buffer
+
+        Args:
+            value (float): value to add
+        """
+        value = float(value)
+        old = float(self.buffer[self.index])
+        self.buffer[self.index] = value
+        self.index = (self.index + 1) % self.size
+
+        window = self._sorted
+        if old == old:
+            del window[bisect_left(window, old)]
+            if math.isinf(old):
+                self._infinite -= 1
+            else:
+                _add_exact(self._partials, -old)
+        if value == value:
+            insort(window, value)
+            if math.isinf(value):
+                self._infinite += 1
+            else:
+                _add_exact(self._partials, value)
+
+        self._cached_m = None
+
+    def add_many(self, values) -> None:
+        """Add a block of values to the buffer
+
+        Args:
+            values (array_like): values to add, oldest first
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        if len(values) < self.size:
+            for value in values.tolist():
+                self.add(value)
+            return
+
+        # the block replaces the whole window, rebuild it in one pass
+        self.buffer[:] = values[-self.size:]
+        self.index = 0
+        data = self.buffer[~np.isnan(self.buffer)]
+        self._sorted = np.sort(data).tolist()
+        finite = np.isfinite(data)
+        self._infinite = len(data) - int(finite.sum())
+        self._partials = []
+        for value in data[finite].tolist():
+            _add_exact(self._partials, value)
+        self._cached_m = None
+
+    def _deviation(self, k: int, median: float, pivot: int) -> float:
+        """Get the k-th smallest absolute deviation from the median (1-based)
+
+        The values below the pivot and the values from the pivot onwards are two sorted
+        runs of deviations, so the k-th smallest is found by binary search on the split.
+        """
+        window = self._sorted
+        n_left = pivot
+        n_right = len(window) - pivot
+
+        lo = max(0, k - n_right)
+        hi = min(k, n_left)
+        while lo < hi:
+            i = (lo + hi) // 2
+            j = k - i
+            if median - window[pivot - 1 - i] < window[pivot + j - 1] - median:
+                lo = i + 1
+            else:
+                hi = i
+
+        i = lo
+        j = k - i
+        left = median - window[pivot - i] if i > 0 else -math.inf
+        right = window[pivot + j - 1] - median if j > 0 else -math.inf
+        return max(left, right)
+
+    def get(self, m = 6.0) -> float:
+        """Get the mean of the buffer without the nan values and remove outliers
+
+        Args:
+            m (float, optional): Outlier cutoff value. Defaults to 6.0.
+
+        Returns:
+            float: The mean, or nan if the buffer is empty
+        """
+        if self._cached_m == m:
+            return self._cached_mean
+
+        window = self._sorted
+        n = len(window)
+        if n == 0:
+            return np.nan
+
+        half = n // 2
+        if n % 2:
+            median = window[half]
+        else:
+            median = (window[half - 1] + window[half]) / 2.0
+
+        pivot = bisect_left(window, median)
+        if n % 2:
+            mdev = self._deviation(half + 1, median, pivot)
+        else:
+            mdev = (self._deviation(half, median, pivot) + self._deviation(half + 1, median, pivot)) / 2.0
+        scale = mdev if mdev else 1.
+        cutoff = m * scale
+
+        # inliers are a contiguous run of the sorted window around the median. Deviations
+        # are monotone on each side of the pivot, so each bound only moves on its own side
+        lo = min(bisect_right(window, median - cutoff), pivot)
+        hi = max(bisect_left(window, median + cutoff), pivot)
+        while lo < pivot and abs(window[lo] - median) / scale >= m:
+            lo += 1
+        while lo > 0 and abs(window[lo - 1] - median) / scale < m:
+            lo -= 1
+        while hi > pivot and abs(window[hi - 1] - median) / scale >= m:
+            hi -= 1
+        while hi < n and abs(window[hi] - median) / scale < m:
+            hi += 1
+
+        if self.counters is not None:
+            self.counters[0].inc(n)
+            self.counters[1].inc(n - (hi - lo))
+        self._cached_m = m
+        if hi <= lo:
+            self._cached_mean = np.nan
+        elif (self._infinite and (math.isinf(window[lo]) or math.isinf(window[hi - 1]))) or n - (hi - lo) > hi - lo:
+            # an infinite inlier, or fewer inliers than outliers to take out of the sum
+            self._cached_mean = math.fsum(window[lo:hi]) / (hi - lo)
+        elif hi - lo == n:
+            self._cached_mean = math.fsum(self._partials) / n
+        else:
+            # outliers are rare, so subtract the finite tails from the exact sum
+            partials = list(self._partials)
+            for i in range(lo):
+                if not math.isinf(window[i]):
+                    _add_exact(partials, -window[i])
+            for i in range(hi, n):
+                if not math.isinf(window[i]):
+                    _add_exact(partials, -window[i])
+            self._cached_mean = math.fsum(partials) / (hi - lo)
+        return self._cached_mean
+
+    def resize(self, size: int) -> None:
+        """Change the size of the buffer, keeping the newest values
+
+        Args:
+            size (int): new size of the buffer
+        """
+        if size == self.size:
+            return
+
+        # values oldest first
+        values = np.concatenate((self.buffer[self.index:], self.buffer[:self.index]))
+        self.size = size
+        self.reset()
+        self.add_many(values[-size:])
+
+    def reset(self) -> None:
+        """ Reset the buffer to nan values """
+        self.buffer = np.empty(self.size)
+        self.buffer[:] = np.nan
+        self.index = 0
+        self._sorted = []
+        self._partials = []
+        self._infinite = 0
+        self._cached_m = None
+        self._cached_mean = np.nan
+
+def _row_medians(rows: np.ndarray, count: np.ndarray) -> np.ndarray:
+    """Get the median of the first count values of each row, sorting the rows in place"""
+    rows.sort(axis=1)
+    lower = np.take_along_axis(rows, np.maximum(count - 1, 0)[:, None] // 2, axis=1)[:, 0]
+    upper = np.take_along_axis(rows, (count // 2)[:, None], axis=1)[:, 0]
+    return np.where(count > 0, (lower + upper) / 2.0, np.nan)
+
+
+def filter_series(values, size: int, m: float = 6.0, chunk: int = 65536) -> np.ndarray:
+    """Filter a whole series like a Buffer, vectorized over sliding windows
+
+    Args:
+        values (array_like): samples, oldest first
+        size (int): size of the buffer
+        m (float, optional): outlier cutoff value. Defaults to 6.0.
+        chunk (int, optional): windows evaluated at once, bounding the memory. Defaults to 65536.
+
+    Returns:
+        np.ndarray: the value of Buffer.get after each Buffer.add
+    """
+    values = np.asarray(values, dtype=float).ravel()
+    # the buffer starts empty
+    padded = np.concatenate((np.full(size - 1, np.nan), values))
+    out = np.empty(len(values))
+    for start in range(0, len(values), chunk):
+        end = min(start + chunk, len(values))
+        out[start:end] = _window_means(sliding_window_view(padded[start:end + size - 1], size), m)
+    return out
+
+
+def _window_inliers(windows: np.ndarray, m: float) -> np.ndarray:
+    """Get the values of each row that are neither nan nor outliers, like Buffer.get"""
+    # nan sort last, so the valid values of a row are its first count values
+    count = np.count_nonzero(~np.isnan(windows), axis=1)
+    center = _row_medians(windows.copy(), count)
+    deviation = np.abs(windows - center[:, None])
+    mdev = _row_medians(deviation.copy(), count)
+    scale = np.where(mdev == 0, 1., mdev)
+    with np.errstate(invalid='ignore'):
+        return deviation / scale[:, None] < m
+
+
+def _window_means(windows: np.ndarray, m: float, inliers: Optional[np.ndarray] = None) -> np.ndarray:
+    """Get the mean of each row without the nan values and the outliers, like Buffer.get"""
+    if inliers is None:
+        inliers = _window_inliers(windows, m)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(inliers, windows, 0.).sum(axis=1) / inliers.sum(axis=1)
+
+
+class BufferArray:
+    """Circular buffers of several sensors, filtered together
+
+    Each row is the window of one sensor. get() returns the same outlier-rejected means as one
+    Buffer per sensor, computed for every row in one vectorized pass.
+    """
+
+    def __init__(self, count: int, size: int, name: Optional[str] = None):
+        """Initialize the buffers
+
+        Args:
+            count (int): number of sensors
+            size (int): size of the buffer of each sensor
+            name (Optional[str], optional): counts the values and outliers of each get as {name} metrics, see Buffer. Defaults to None.
+        """
+        self.count = count
+        self.size = size
+        self.counters = get_outlier_counters(name) if name else None
+        self.reset()
+
+    def add(self, values) -> None:
+        """Add one value per sensor
+
+        Args:
+            values (array_like): value of each sensor
+        """
+        self.buffer[:, self.index] = values
+        self.index = (self.index + 1) % self.size
+
+    def get(self, m: float = 6.0) -> np.ndarray:
+        """Get the mean of each buffer without the nan values and the outliers
+
+        Args:
+            m (float, optional): outlier cutoff value. Defaults to 6.0.
+
+        Returns:
+            np.ndarray: the mean of each sensor, nan if its buffer is empty
+        """
+        inliers = _window_inliers(self.buffer, m)
+        if self.counters is not None:
+            values = int(np.count_nonzero(~np.isnan(self.buffer)))
+            self.counters[0].inc(values)
+            self.counters[1].inc(values - int(np.count_nonzero(inliers)))
+        return _window_means(self.buffer, m, inliers)
+
+    def resize(self, size: int) -> None:
+        """Change the size of the buffers, keeping the newest values
+
+        Args:
+            size (int): new size of each buffer
+        """
+        if size == self.size:
+            return
+
+        # values oldest first
+        values = np.roll(self.buffer, -self.index, axis=1)[:, -size:]
+        self.size = size
+        self.reset()
+        self.buffer[:, size - values.shape[1]:] = values
+
+    def reset(self) -> None:
+        """Reset the buffers to nan values"""
+        self.buffer = np.full((self.count, self.size), np.nan)
+        self.index = 0
@@ -1,30 +1,307 @@
-from mq135 import MQ135
-from utils import Buffer, init_sensor, get_temp_sensor_reading
-import adafruit_ads1x15.ads1115 as ADS
-from decouple import config
+import argparse
+import math
+import os
 import time
+from typing import Dict, List
+import numpy as np
+from decouple import config, Csv
 from tqdm import tqdm
+from mq135 import MQ135
+from utils import get_temp_sensor_reading
+from adc import ADCChannel, TEMPERATURE_PIN, get_sensor_voltage, init_sensor
+from sensors import parse_gas_sensors
+
+
+class RunningStats:
+    """Online mean and variance with Welford's algorithm
+
+    Blocks of values are merged with the parallel form of the update, so high rate samples
+    are added without a Python loop per value.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value: float) -> None:
+        """Add one value, nan values are ignored"""
+        if math.isnan(value):
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def add_many(self, values) -> None:
+        """Add a block of values, nan values are ignored"""
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        n = len(values)
+        if n == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+    @property
+    def variance(self) -> float:
+        """Sample variance, nan below two values"""
+        return self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def std(self) -> float:
+        """Sample standard deviation, nan below two values"""
+        return math.sqrt(self.variance)
+
+    def confidence_interval(self, z: float = 1.96) -> float:
+        """Half width of the confidence interval of the mean
+
+        Args:
+            z (float, optional): standard normal quantile of the confidence level. Defaults to 1.96 for 95%.
+
+        Returns:
+            float: half width, nan below two values
+        """
+        return z * self.std / math.sqrt(self.count) if self.count > 1 else float('nan')
+
+
+class SensorCalibration:
+    """Streaming rzero estimate of one MQ135
+
+    Every sample is converted to a corrected rzero and added to the sample statistics. The
+    confidence interval is taken on the means of consecutive batches instead: samples a few
+    milliseconds apart are correlated, so their own standard error would shrink far faster
+    than the estimate actually settles.
+    """
+
+    def __init__(self, name: str, channel: ADCChannel, mq135: MQ135, tolerance: float = 0.005,
+                 min_batches: int = 10, z: float = 1.96):
+        """Initialize the calibration
+
+        Args:
+            name (str): env variable the rzero is written to
+            channel (ADCChannel): scheduled channel of the sensor
+            mq135 (MQ135): converter of the sensor readings
+            tolerance (float, optional): converged when the confidence interval is within this fraction of the mean. Defaults to 0.005.
+            min_batches (int, optional): batches taken before checking convergence. Defaults to 10.
+            z (float, optional): standard normal quantile of the confidence level. Defaults to 1.96.
+        """
+        self.name = name
+        self.channel = channel
+        self.mq135 = mq135
+        self.tolerance = tolerance
+        self.min_batches = min_batches
+        self.z = z
+        self.samples = RunningStats()
+        self.batches = RunningStats()
+        self.cursor = channel.count
+
+    def skip(self) -> None:
+        """Drop the samples taken so far, e.g. during warm up"""
+        self.cursor = self.channel.count
+
+    def update(self, temperature: float, humidity: float) -> None:
+        """Add the samples taken since the last update as one batch
+
+        Args:
+            temperature (float): temperature of the correction
+            humidity (float): humidity of the correction
+        """
+        batch = RunningStats()
+        while True:
+            values, _, self.cursor = self.channel.read(self.cursor)
+            if len(values) == 0:
+                break
+            rzero = self.mq135.compute_many(values, temperature, humidity).corrected_rzero
+            # readings of 0 have no resistance
+            rzero = rzero[rzero > 0]
+            self.samples.add_many(rzero)
+            batch.add_many(rzero)
+        if batch.count:
+            self.batches.add(batch.mean)
+
+    @property
+    def rzero(self) -> float:
+        """Current rzero estimate"""
+        return self.batches.mean if self.batches.count else float('nan')
+
+    @property
+    def interval(self) -> float:
+        """Half width of the confidence interval of the rzero"""
+        return self.batches.confidence_interval(self.z)
+
+    @property
+    def converged(self) -> bool:
+        """Whether the confidence interval is within the tolerance"""
+        return self.batches.count >= self.min_batches and self.interval <= self.tolerance * abs(self.rzero)
+
+
+def update_env_file(path: str, values: Dict[str, str]) -> None:
+    """Set variables in an env file, keeping the other lines
+
+    Existing assignments are replaced in place, new ones appended. The file is replaced
+    atomically so services never read it half written.
+
+    Args:
+        path (str): env file, created if missing
+        values (Dict[str, str]): variables to set
+    """
+    lines: List[str] = []
+    if os.path.exists(path):
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+    remaining = dict(values)
+    for i, line in enumerate(lines):
+        key = line.split('=', 1)[0].strip()
+        if '=' in line and not line.lstrip().startswith('#') and key in remaining:
+            lines[i] = f"{key}={remaining.pop(key)}"
+    lines += [f"{key}={value}" for key, value in remaining.items()]
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
 
 def main():
-    average_size = 20
-    gas_sensor = init_sensor(pin=ADS.P0)
-    temp_sensor = init_sensor(pin=ADS.P3)
-    buffer = Buffer(average_size)
-    sensor_max_value = config('SENSOR_MAX_VALUE', default=65536, cast=int)
-    mq135 = MQ135(gas_sensor, sensor_max_value)
-    
-    print("Starting Calibration")
-    for _ in tqdm(range(average_size)):
-        temperature = get_temp_sensor_reading(temp_sensor.voltage)
-        buffer.add(mq135.get_corrected_rzero(temperature))
-        time.sleep(5)
-
-    print("Calibration done. Please update the RZERO value in the mq135.py file with the following value:")
-    print(buffer.get())
+    parser = argparse.ArgumentParser(description='Calibrate the rzero of MQ135 sensors until the estimate converges')
+    parser.add_argument('-S', '--sensor',
+                        type=str,
+                        action='append',
+                        help='MQ135 sensor to calibrate as NAME:ADDRESS:PIN. Can be repeated, all sensors are calibrated together, see sensors.py. '
+                             'Default to GAS_SENSORS env variable or the GAS sensor on input 0 of the ADS1115 at 0x48',
+                        default=None)
+    parser.add_argument('-T', '--temp-pin',
+                        type=int,
+                        help='ADS1115 input of the temperature sensor. Default to 3',
+                        default=TEMPERATURE_PIN)
+    parser.add_argument('-s', '--sensor-max-value',
+                        type=int,
+                        help='Sensor max value. Default to SENSOR_MAX_VALUE env variable or 65536',
+                        default=config('SENSOR_MAX_VALUE', default=65536, cast=int))
+    parser.add_argument('-C', '--atmoco2',
+                        type=float,
+                        help='CO2 concentration of the calibration environment in ppm. Default to ATMOCO2 env variable',
+                        default=config('ATMOCO2', default='nan', cast=float))
+    parser.add_argument('-H', '--humidity',
+                        type=float,
+                        help='Relative humidity of the calibration environment. Default to CALIBRATION_HUMIDITY env variable or 35',
+                        default=config('CALIBRATION_HUMIDITY', default=35.0, cast=float))
+    parser.add_argument('-a', '--sample-rate',
+                        type=float,
+                        help='Samples per second of each MQ135. Default to CALIBRATION_SAMPLE_RATE env variable or 200',
+                        default=config('CALIBRATION_SAMPLE_RATE', default=200.0, cast=float))
+    parser.add_argument('-p', '--batch-period',
+                        type=float,
+                        help='Seconds of samples averaged into one batch of the confidence interval. Default to 1.0',
+                        default=1.0)
+    parser.add_argument('-t', '--tolerance',
+                        type=float,
+                        help='Stop once the confidence interval is within this fraction of the rzero. Default to CALIBRATION_TOLERANCE env variable or 0.005',
+                        default=config('CALIBRATION_TOLERANCE', default=0.005, cast=float))
+    parser.add_argument('-z', '--z-value',
+                        type=float,
+                        help='Standard normal quantile of the confidence level. Default to 1.96 (95%%)',
+                        default=1.96)
+    parser.add_argument('-n', '--min-batches',
+                        type=int,
+                        help='Batches taken before checking convergence. Default to 10',
+                        default=10)
+    parser.add_argument('-w', '--warmup',
+                        type=float,
+                        help='Seconds of samples discarded at start while the sensors settle. Default to CALIBRATION_WARMUP env variable or 0',
+                        default=config('CALIBRATION_WARMUP', default=0.0, cast=float))
+    parser.add_argument('-m', '--max-duration',
+                        type=float,
+                        help='Give up on sensors not converged after this many seconds. Default to CALIBRATION_MAX_DURATION env variable or 300',
+                        default=config('CALIBRATION_MAX_DURATION', default=300.0, cast=float))
+    parser.add_argument('-e', '--env-file',
+                        type=str,
+                        help='Env file the converged rzero values and ATMOCO2 are written to. Default to .env',
+                        default='.env')
+    parser.add_argument('-W', '--write',
+                        action='store_true',
+                        help='Write the converged values to the env file instead of only printing them')
+    args = parser.parse_args()
+    # repeated options replace the env list rather than extend it
+    if args.sensor is None:
+        args.sensor = config('GAS_SENSORS', default='', cast=Csv())
+    if math.isnan(args.atmoco2):
+        parser.error("Set the CO2 concentration of the calibration environment with --atmoco2 or the ATMOCO2 env variable")
+    try:
+        sensors = parse_gas_sensors(args.sensor)
+    except ValueError as e:
+        parser.error(str(e))
+
+    temp_sensor = init_sensor(pin=args.temp_pin, rate=min(args.sample_rate, 10))
+    calibrations: List[SensorCalibration] = []
+    for sensor in sensors:
+        channel = init_sensor(pin=sensor.pin, rate=args.sample_rate, address=sensor.address)
+        mq135 = MQ135(channel, args.sensor_max_value)
+        mq135.ATMOCO2 = args.atmoco2
+        calibrations.append(SensorCalibration(sensor.rzero_name, channel, mq135, args.tolerance, args.min_batches, args.z_value))
+    temp_cursor = temp_sensor.count
+
+    print(f"Starting Calibration of {', '.join(c.name for c in calibrations)} at {args.atmoco2} ppm CO2")
+    if args.warmup > 0:
+        time.sleep(args.warmup)
+        for calibration in calibrations:
+            calibration.skip()
+        temp_cursor = temp_sensor.count
+
+    start = time.monotonic()
+    temperature = float('nan')
+    pending = list(calibrations)
+    with tqdm(total=int(args.max_duration / args.batch_period), unit='batch') as progress:
+        while pending and time.monotonic() - start < args.max_duration:
+            time.sleep(args.batch_period)
+
+            # mean temperature of the batch, or the last one if the channel had no new sample
+            values, _, temp_cursor = temp_sensor.read(temp_cursor)
+            if len(values):
+                temperature = float(get_temp_sensor_reading(get_sensor_voltage(temp_sensor, values.mean())))
+            if math.isnan(temperature):
+                continue
+
+            for calibration in pending:
+                calibration.update(temperature, args.humidity)
+            pending = [c for c in pending if not c.converged]
+            progress.update()
+            progress.set_postfix_str(' '.join(f"{c.name}={c.rzero:.3f}±{c.interval:.3f}" for c in calibrations) + f" T={temperature:.1f}")
+
+    for calibration in calibrations:
+        calibration.channel.manager.stop()
+    temp_sensor.manager.stop()
+    print(f"Calibration done in {time.monotonic() - start:.0f} s")
+    converged: Dict[str, str] = dict()
+    for calibration in calibrations:
+        status = 'converged' if calibration.converged else 'NOT converged'
+        print(f"  {calibration.name}={calibration.rzero:.6g} ± {calibration.interval:.3g} ({status}, {calibration.samples.count} samples, "
+              f"sample std {calibration.samples.std:.3g})")
+        if calibration.converged:
+            converged[calibration.name] = f"{calibration.rzero:.6g}"
+
+    if not converged:
+        print("No sensor converged, increase --max-duration or --tolerance")
+        exit(1)
+    converged['ATMOCO2'] = f"{args.atmoco2:g}"
+    if args.write:
+        update_env_file(args.env_file, converged)
+        print(f"Updated {', '.join(converged)} in {args.env_file}")
+    else:
+        print(f"Add to the {args.env_file} file, or run again with --write:")
+        for name, value in converged.items():
+            print(f"{name}={value}")
     print("Exiting...")
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
-        exit(0)
\ No newline at end of file
+        exit(0)
@@ -0,0 +1,82 @@
+import os
+# packed telemetry is only defined in MAVLink 2
+os.environ.setdefault('MAVLINK20', '1')
+
+import argparse
+import csv
+import sys
+from decouple import config, Csv
+from pymavlink import mavutil
+from sensors import parse_gas_sensors
+from telemetry import PACKED_ARRAY_NAME, PACKED_VERSIONS, get_field_order, unpack_fields
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode packed gas telemetry from a MAVLink log (tlog) into CSV')
+    parser.add_argument('log',
+                        type=str,
+                        help='MAVLink log file recorded on the ground station')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help='Output CSV file. Default to stdout',
+                        default=None)
+    parser.add_argument('-S', '--sensor',
+                        type=str,
+                        action='append',
+                        help='Gas sensor of the drone as NAME:ADDRESS:PIN, naming the fields of sensor array messages. Can be repeated. '
+                             'Default to GAS_SENSORS env variable',
+                        default=None)
+    parser.add_argument('-G', '--gas-model',
+                        type=str,
+                        action='append',
+                        help='Gas estimate of each gas sensor of the drone, naming the fields of sensor array messages. Can be repeated. Default to GAS_MODEL_GASES env variable',
+                        default=None)
+    args = parser.parse_args()
+    # repeated options replace the env list rather than extend it
+    if args.sensor is None:
+        args.sensor = config('GAS_SENSORS', default='', cast=Csv())
+    if args.gas_model is None:
+        args.gas_model = config('GAS_MODEL_GASES', default='', cast=Csv())
+    try:
+        sensors = parse_gas_sensors(args.sensor, args.gas_model)
+    except ValueError as e:
+        parser.error(str(e))
+
+    field_names = []
+    for version in PACKED_VERSIONS:
+        field_names.extend(name for name in get_field_order(version, sensors) if name not in field_names)
+
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(output, fieldnames=['timestamp', 'time_usec', 'sysid', 'compid', 'version'] + field_names, restval='')
+    writer.writeheader()
+
+    log = mavutil.mavlink_connection(args.log)
+    count = 0
+    while True:
+        msg = log.recv_match(type='DEBUG_FLOAT_ARRAY')
+        if msg is None:
+            break
+        if msg.name != PACKED_ARRAY_NAME or msg.array_id not in PACKED_VERSIONS:
+            continue
+
+        row = {
+            'timestamp': getattr(msg, '_timestamp', ''),
+            'time_usec': msg.time_usec,
+            'sysid': msg.get_srcSystem(),
+            'compid': msg.get_srcComponent(),
+            'version': msg.array_id,
+        }
+        row.update(unpack_fields(msg.array_id, msg.data, sensors))
+        writer.writerow(row)
+        count += 1
+
+    if output is not sys.stdout:
+        output.close()
+    print(f"Decoded {count} packed messages", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,452 @@
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from buffers import Buffer
+
+
+def _fill_nan(block: np.ndarray, last: float) -> Tuple[np.ndarray, float]:
+    """Replace nan samples with the previous valid sample
+
+    Args:
+        block (np.ndarray): samples
+        last (float): last valid sample of the previous block, nan if none
+
+    Returns:
+        Tuple[np.ndarray, float]: the filled samples and the last valid sample
+    """
+    missing = np.isnan(block)
+    if not missing.any():
+        return block, float(block[-1]) if len(block) else last
+
+    index = np.where(missing, -1, np.arange(len(block)))
+    np.maximum.accumulate(index, out=index)
+    filled = np.where(index >= 0, block[np.maximum(index, 0)], last)
+    return filled, float(filled[-1])
+
+
+def _sorted_median(values: np.ndarray) -> float:
+    """Get the median of sorted values"""
+    half = len(values) // 2
+    if len(values) % 2:
+        return float(values[half])
+    return (float(values[half - 1]) + float(values[half])) / 2.0
+
+
+class FilterStage:
+    """One stage of a FilterChain
+
+    A stage takes a block of samples, oldest first, and returns the block of its output
+    samples, which can be shorter for a decimating stage. State carried between blocks is
+    bounded and does not grow with the stream, so a block of any size can be processed.
+    """
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Filter a block of samples
+
+        Args:
+            block (np.ndarray): input samples, oldest first
+
+        Returns:
+            np.ndarray: output samples, oldest first
+        """
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        """Forget the state carried between blocks"""
+
+
+class OutlierFilter(FilterStage):
+    """Replaces samples far from the median by the median (Hampel filter)
+
+    A sample is an outlier when its deviation from the median is at least m times the median
+    absolute deviation, like Buffer.get. Blocks of at least min_block valid samples are judged
+    against their own median and MAD. Shorter blocks, e.g. one reading per tick, are judged
+    against the last known median and MAD, and move the median by an exponential average of
+    their inliers. Until a MAD is known, short blocks pass unchanged and their samples are
+    collected until there are min_block of them to take the first median and MAD from.
+    """
+
+    def __init__(self, m: float = 6.0, min_block: int = 5, alpha: float = 0.1):
+        """Initialize the filter
+
+        Args:
+            m (float, optional): outlier cutoff in median absolute deviations. Defaults to 6.0.
+            min_block (int, optional): valid samples of a block to take its own median. Defaults to 5.
+            alpha (float, optional): weight of a short block in the median. Defaults to 0.1.
+        """
+        self.m = m
+        self.min_block = int(min_block)
+        self.alpha = alpha
+        self.reset()
+
+    def reset(self) -> None:
+        self.center = math.nan
+        self.scale = math.nan
+        # valid samples of the short blocks seen before the first MAD, fewer than min_block
+        self.window = np.empty(0)
+
+    def estimate(self, valid: np.ndarray) -> None:
+        """Set the median and MAD of valid samples"""
+        # np.median costs more than a sort of a short block
+        self.center = _sorted_median(np.sort(valid))
+        mdev = _sorted_median(np.sort(np.abs(valid - self.center)))
+        self.scale = mdev if mdev else 1.
+        self.window = np.empty(0)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        valid = block[~np.isnan(block)]
+        if len(valid) >= self.min_block:
+            self.estimate(valid)
+        elif math.isnan(self.scale):
+            # nothing to judge against yet, collect the samples of the short blocks
+            window = np.concatenate((self.window, valid))
+            if len(window) < self.min_block:
+                self.window = window
+                return block
+            self.estimate(window)
+
+        with np.errstate(invalid='ignore'):
+            outliers = np.abs(block - self.center) >= self.m * self.scale
+        block = np.where(outliers, self.center, block)
+        if 0 < len(valid) < self.min_block:
+            inliers = block[~np.isnan(block)]
+            self.center += self.alpha * (float(inliers.mean()) - self.center)
+        return block
+
+
+class EMAFilter(FilterStage):
+    """Exponential moving average, y = y + alpha * (x - y) for every sample
+
+    The recursion is evaluated on whole blocks in closed form, in chunks short enough for the
+    powers of 1 - alpha to stay in range. nan samples repeat the previous sample.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        """Initialize the filter
+
+        Args:
+            alpha (float, optional): weight of a new sample, between 0 and 1. Defaults to 0.1.
+        """
+        if not 0 < alpha <= 1:
+            raise ValueError(f"EMA alpha must be in (0, 1], got {alpha}")
+        self.alpha = alpha
+        decay = 1. - alpha
+        # decay ** -chunk must stay far below the float max
+        self.chunk = int(600 / -math.log(decay)) if decay > 0 else 1 << 30
+        self.reset()
+
+    def reset(self) -> None:
+        self.value = math.nan
+        self.last = math.nan
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        block, self.last = _fill_nan(block, self.last)
+        decay = 1. - self.alpha
+        if decay == 0:
+            # each output is its sample, the closed form would divide by zero powers
+            self.value = self.last
+            return block.copy()
+        out = np.empty(len(block))
+        start = 0
+        if math.isnan(self.value):
+            # skip the leading nan and seed the average with the first sample
+            valid = np.flatnonzero(~np.isnan(block))
+            if len(valid) == 0:
+                out[:] = np.nan
+                return out
+            start = int(valid[0])
+            out[:start] = np.nan
+            self.value = float(block[start])
+
+        for i in range(start, len(block), self.chunk):
+            x = block[i:i + self.chunk]
+            powers = decay ** np.arange(len(x))
+            y = decay * powers * self.value + self.alpha * powers * np.cumsum(x / powers)
+            out[i:i + len(x)] = y
+            self.value = float(y[-1])
+        return out
+
+
+class KalmanFilter(FilterStage):
+    """Constant velocity Kalman filter estimating the level and the rate of change of a signal
+
+    The state is the level and its rate of change per second, driven by white acceleration
+    noise. The output is the level; the rate of change of the last block is in rates and its
+    last value in rate. The recursion runs sample by sample, so place it after a decimating
+    stage when the input rate is high. nan samples only advance the prediction.
+    """
+
+    def __init__(self, process_noise: float = 1.0, measurement_noise: float = 1.0, dt: float = 1.0):
+        """Initialize the filter
+
+        Args:
+            process_noise (float, optional): acceleration noise spectral density. Defaults to 1.0.
+            measurement_noise (float, optional): variance of a sample. Defaults to 1.0.
+            dt (float, optional): seconds between input samples. Defaults to 1.0.
+        """
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.dt = dt
+        self.reset()
+
+    def reset(self) -> None:
+        self.level = math.nan
+        self.rate = 0.0
+        self.rates = np.empty(0)
+        self.p = (0.0, 0.0, 0.0)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        dt = self.dt
+        q = self.process_noise
+        r = self.measurement_noise
+        q11, q12, q22 = q * dt ** 3 / 3, q * dt ** 2 / 2, q * dt
+        level, rate = self.level, self.rate
+        p11, p12, p22 = self.p
+        levels = np.empty(len(block))
+        rates = np.empty(len(block))
+        for i, z in enumerate(block.tolist()):
+            if math.isnan(level):
+                # first valid sample, unknown rate
+                if z == z:
+                    level, rate = z, 0.0
+                    p11, p12, p22 = r, 0.0, r
+                levels[i] = level
+                rates[i] = rate
+                continue
+
+            # predict
+            level += dt * rate
+            p11 += dt * (2 * p12 + dt * p22) + q11
+            p12 += dt * p22 + q12
+            p22 += q22
+            if z == z:
+                # update with the sample
+                s = p11 + r
+                k1, k2 = p11 / s, p12 / s
+                innovation = z - level
+                level += k1 * innovation
+                rate += k2 * innovation
+                p11, p12, p22 = (1 - k1) * p11, (1 - k1) * p12, p22 - k2 * p12
+            levels[i] = level
+            rates[i] = rate
+
+        self.level, self.rate = level, rate
+        self.p = (p11, p12, p22)
+        self.rates = rates
+        return levels
+
+
+class FIRDecimator(FilterStage):
+    """Low pass FIR filter keeping one output every factor samples
+
+    Only the kept outputs are computed, as dot products of the taps with strided windows of the
+    input. The last len(taps) - 1 samples carry over to the next block. The default taps are a
+    Hamming windowed sinc cut at the output Nyquist frequency, normalized to a unit DC gain.
+    nan samples repeat the previous sample.
+    """
+
+    def __init__(self, factor: int, taps: Optional[Iterable[float]] = None):
+        """Initialize the decimator
+
+        Args:
+            factor (int): input samples per output sample
+            taps (Optional[Iterable[float]], optional): filter taps. Defaults to 4 * factor + 1 windowed sinc taps.
+        """
+        self.factor = int(factor)
+        if self.factor < 1:
+            raise ValueError(f"Decimation factor must be at least 1, got {factor}")
+        if taps is None:
+            n = np.arange(4 * self.factor + 1) - 2 * self.factor
+            taps = np.sinc(n / self.factor) * np.hamming(len(n))
+        taps = np.asarray(taps, dtype=float)
+        # reversed for dot products with windows, oldest sample first
+        self.kernel = (taps / taps.sum())[::-1].copy()
+        self.reset()
+
+    def reset(self) -> None:
+        self.history: Optional[np.ndarray] = None
+        self.phase = self.factor - 1
+        self.last = math.nan
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        block, self.last = _fill_nan(block, self.last)
+        if len(block) == 0:
+            return block
+        n_taps = len(self.kernel)
+        if self.history is None:
+            # start as if the first sample had always been there, not from zero
+            self.history = np.full(n_taps - 1, block[0])
+
+        x = np.concatenate((self.history, block))
+        positions = range(self.phase, len(block), self.factor)
+        if len(positions) <= 4:
+            # a few dot products cost less than building the window view
+            out = np.array([x[p:p + n_taps] @ self.kernel for p in positions])
+        else:
+            out = as_strided(x, (len(block), n_taps), (x.strides[0], x.strides[0]), writeable=False)[positions] @ self.kernel
+        self.phase = positions[-1] + self.factor - len(block) if len(positions) else self.phase - len(block)
+        self.history = x[len(x) - (n_taps - 1):]
+        return out
+
+
+class CICDecimator(FIRDecimator):
+    """Cascaded integrator comb decimator
+
+    The response of order cascaded moving sums of factor samples, normalized to a unit DC gain.
+    It is computed as the equivalent FIR filter, so float samples do not accumulate in
+    integrators and only the kept outputs are computed.
+    """
+
+    def __init__(self, factor: int, order: int = 3):
+        """Initialize the decimator
+
+        Args:
+            factor (int): input samples per output sample, also the length of each moving sum
+            order (int, optional): number of cascaded moving sums. Defaults to 3.
+        """
+        boxcar = np.ones(int(factor))
+        taps = boxcar
+        for _ in range(int(order) - 1):
+            taps = np.convolve(taps, boxcar)
+        super().__init__(factor, taps)
+
+
+class Compensation(FilterStage):
+    """Multiplies the samples by a gain of the latest temperature and humidity
+
+    The gain is evaluated once per update instead of once per sample, so a linear correction
+    is cheaper after decimation than before.
+    """
+
+    def __init__(self, gain: Callable[[float, float], float]):
+        """Initialize the stage at 25 degrees and 35 % humidity
+
+        Args:
+            gain (Callable[[float, float], float]): gain of a temperature and a humidity
+        """
+        self.gain = gain
+        self.update(25, 35)
+
+    def update(self, temperature: float, humidity: float) -> None:
+        """Set the temperature and humidity of the next blocks"""
+        self.factor = self.gain(temperature, humidity)
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        return block * self.factor
+
+
+class BufferFilter(FilterStage):
+    """Median / MAD outlier-rejected mean of the last size samples, output once per block
+
+    The filter of the sensor loops without a filter chain, see Buffer.
+    """
+
+    def __init__(self, size: int = 10, m: float = 6.0):
+        """Initialize the filter
+
+        Args:
+            size (int, optional): samples in the window. Defaults to 10.
+            m (float, optional): outlier cutoff value. Defaults to 6.0.
+        """
+        self.buffer = Buffer(int(size))
+        self.m = m
+
+    def reset(self) -> None:
+        self.buffer.reset()
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        if len(block) == 0:
+            return block
+        self.buffer.add_many(block)
+        return np.array([self.buffer.get(m=self.m)])
+
+
+class FilterChain:
+    """Runs blocks of samples through filter stages in order"""
+
+    def __init__(self, stages: List[FilterStage]):
+        """Initialize the chain
+
+        Args:
+            stages (List[FilterStage]): stages, first applied first
+        """
+        self.stages = stages
+
+    @property
+    def compensates(self) -> bool:
+        """Check if a stage applies the temperature compensation"""
+        return any(isinstance(stage, Compensation) for stage in self.stages)
+
+    def update(self, temperature: float, humidity: float) -> None:
+        """Pass the latest temperature and humidity to the compensation stages"""
+        for stage in self.stages:
+            if isinstance(stage, Compensation):
+                stage.update(temperature, humidity)
+
+    def process(self, block) -> np.ndarray:
+        """Filter a block of samples through every stage
+
+        Args:
+            block (array_like): input samples, oldest first
+
+        Returns:
+            np.ndarray: output samples of the last stage, empty if a decimator has no output yet
+        """
+        block = np.asarray(block, dtype=float).ravel()
+        for stage in self.stages:
+            if len(block) == 0:
+                break
+            block = stage.process(block)
+        return block
+
+    def reset(self) -> None:
+        """Reset every stage"""
+        for stage in self.stages:
+            stage.reset()
+
+
+FILTER_STAGES: Dict[str, Callable[..., FilterStage]] = {
+    'outlier': OutlierFilter,
+    'ema': EMAFilter,
+    'kalman': KalmanFilter,
+    'fir': FIRDecimator,
+    'cic': CICDecimator,
+    'buffer': BufferFilter,
+}
+
+
+def parse_filter_chain(specs: Iterable[str], gain: Optional[Callable[[float, float], float]] = None) -> Optional[FilterChain]:
+    """Parse NAME:ARG:ARG stage specs into a filter chain
+
+    Stage names are the keys of FILTER_STAGES, taking the arguments of their constructor in
+    order, and compensate, applying gain.
+
+    Args:
+        specs (Iterable[str]): stage specs, first applied first, e.g. outlier:6, cic:16:3, ema:0.2
+        gain (Optional[Callable[[float, float], float]], optional): gain of the compensate stage. Defaults to None.
+
+    Raises:
+        ValueError: if a stage is unknown or its arguments are invalid
+
+    Returns:
+        Optional[FilterChain]: the chain, None if there are no stages
+    """
+    stages: List[FilterStage] = []
+    for spec in specs:
+        name, *args = [part.strip() for part in spec.split(':')]
+        if not name:
+            continue
+        if name == 'compensate':
+            if gain is None:
+                raise ValueError("The compensate stage is not available for this sensor")
+            stages.append(Compensation(gain))
+        elif name in FILTER_STAGES:
+            try:
+                stages.append(FILTER_STAGES[name](*[float(arg) for arg in args]))
+            except (TypeError, ValueError) as e:
+                # wrong number of arguments, not a number or out of range
+                raise ValueError(f"Invalid filter stage {spec}: {e}") from e
+        else:
+            raise ValueError(f"Unknown filter stage {name}, expected one of {list(FILTER_STAGES) + ['compensate']}")
+    return FilterChain(stages) if stages else None
@@ -1,35 +1,343 @@
-import board
-import busio
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-import time
-from decouple import config
-from utils import connect_redis, convert_to_float_or_default, print_if_debug, SensorReadingFieldNames, Buffer
-from mq135 import MQ135
+from decouple import config, Csv
+from utils import connect_redis, print_if_debug, SensorReadingFieldNames, FieldCache, RedisPublisher, GAS_HISTORY_STREAM, GAS_UPDATES_CHANNEL, TEMP_UPDATES_CHANNEL
+from buffers import Buffer, BufferArray
+from mq135 import MQ135, MQ135GasModel, MQ135LookupTable, MQ135Reading
+from filters import FilterChain, parse_filter_chain
+from recorder import FlightRecorder, create_flight_recorder
+from sampler import SampleRing
+from scheduler import DeadlineScheduler
+from adaptive import AdaptiveRate
+from adc import ADCChannel, PGA_RANGE, init_sensor
+from instrumentation import Logger, log_enabled, set_log_level, start_metrics_export
+from sensors import DEFAULT_SENSOR_NAME, GAS_FIELD_SUFFIXES, GasSensor, parse_gas_sensors
+from time import monotonic
+from typing import List, Optional, Union
 import argparse
-import adafruit_ads1x15.ads1115 as ADS
+import math
+import numpy as np
 
 
 DEBUG = False
-def init_sensor(pin = ADS.P0) -> AnalogIn:
-    """Initialize the analog gas sensor
+log = Logger("gas")
+
+
+class GasReader:
+    """Reads the MQ135 and sets the gas fields of one tick on a publisher
+
+    Shared by this service and the single process runtime, see runtime.py.
+    """
+
+    def __init__(self, mq135: MQ135, converter: Union[MQ135, MQ135LookupTable], buffer: Buffer, publisher: RedisPublisher,
+                 correction_factor: float = 6.0, sampler: Optional[SampleRing] = None, chain: Optional[FilterChain] = None,
+                 recorder: Optional[FlightRecorder] = None, model: Optional[MQ135GasModel] = None):
+        """Initialize the reader
+
+        Args:
+            mq135 (MQ135): the gas sensor
+            converter (Union[MQ135, MQ135LookupTable]): converts raw values to ppm
+            buffer (Buffer): outlier filter of the ppm
+            publisher (RedisPublisher): publisher the fields are set on, anything with its set method
+            correction_factor (float, optional): outlier cutoff of the buffer. Defaults to 6.0.
+            sampler (Optional[SampleRing], optional): background samples of the sensor, filtered in blocks. Defaults to one read per tick.
+            chain (Optional[FilterChain], optional): filters the ppm instead of the buffer. Defaults to None.
+            recorder (Optional[FlightRecorder], optional): records every reading. Defaults to None.
+            model (Optional[MQ135GasModel], optional): publishes a GAS_{GAS} estimate of each of its gases. Defaults to None.
+        """
+        self.mq135 = mq135
+        self.converter = converter
+        self.buffer = buffer
+        self.publisher = publisher
+        self.correction_factor = correction_factor
+        self.sampler = sampler
+        self.chain = chain
+        self.recorder = recorder
+        self.model = model
+        self.gas_fields = [f"{DEFAULT_SENSOR_NAME}_{gas}" for gas in model.gases] if model is not None else []
+        self.cursor = 0
+        # filter size and sample rate at the base period, see scale_rate
+        self.base_size = buffer.size
+        self.base_rate = getattr(sampler, 'rate', None)
+
+    def read(self, temperature: float = 25, humidity: float = 35) -> float:
+        """Read the sensor and set the gas fields of this tick
+
+        Args:
+            temperature (float, optional): ambient temperature for the ppm correction. Defaults to 25.
+            humidity (float, optional): ambient humidity for the ppm correction. Defaults to 35.
+
+        Returns:
+            float: the filtered ppm, nan if no valid reading
+        """
+        if self.sampler is not None:
+            return self.read_samples(temperature, humidity)
+
+        # read the ADC once, every published value is derived from this reading
+        value = self.mq135.adc.value
+
+        # send raw value
+        self.set_raw(value)
+        log.debug("Set Sensor Voltage and Value to redis")
+
+        # send calculated PPM value
+        try:
+            reading = self.converter.compute(value, temperature, humidity)
+            if self.recorder is not None:
+                self.record(np.array([monotonic()]), reading, temperature, humidity)
+
+            log.debug("MQ135 reading", rzero=reading.rzero, corrected_rzero=reading.corrected_rzero,
+                      resistance=reading.resistance, ppm=reading.ppm, corrected_ppm=reading.corrected_ppm)
+
+            # filter value and save to redis
+            filtered_ppm = self.filter(reading, temperature, humidity)
+            if not math.isnan(filtered_ppm):
+                self.publisher.set(SensorReadingFieldNames.GAS_PPM, filtered_ppm)
+                self.set_gases(filtered_ppm)
+            return filtered_ppm
+        except Exception as e:
+            log.debug("Error reading MQ135 sensor: %s", e)
+            return math.nan
+
+    def read_samples(self, temperature: float, humidity: float) -> float:
+        """Filter every sample taken since the last tick, in blocks straight from the ring"""
+        value = None
+        filtered_ppm = math.nan
+        while True:
+            values, timestamps, self.cursor = self.sampler.read(self.cursor)
+            if len(values) == 0:
+                break
+            block = self.converter.compute_many(values, temperature, humidity)
+            if self.recorder is not None:
+                self.record(timestamps, block, temperature, humidity)
+            block_ppm = self.filter(block, temperature, humidity)
+            if not math.isnan(block_ppm):
+                filtered_ppm = block_ppm
+            value = int(values[-1])
+
+        if value is None:
+            return math.nan
+
+        self.set_raw(value)
+        if not math.isnan(filtered_ppm):
+            self.publisher.set(SensorReadingFieldNames.GAS_PPM, filtered_ppm)
+            self.set_gases(filtered_ppm)
+        return filtered_ppm
+
+    def record(self, timestamps: np.ndarray, reading: MQ135Reading, temperature: float, humidity: float) -> None:
+        """Append a reading or a block of readings to the flight recorder"""
+        self.recorder.append_many(timestamps, reading.value, reading.voltage, temperature, humidity,
+                                  reading.rzero, reading.corrected_rzero, reading.ppm, reading.corrected_ppm)
+
+    def filter(self, reading: MQ135Reading, temperature: float, humidity: float) -> float:
+        """Filter the ppm of a reading or a block of readings
+
+        Without a filter chain, the corrected ppm goes through the buffer. A chain with a
+        compensate stage gets the uncorrected ppm and applies the correction itself.
+
+        Returns:
+            float: the latest filtered ppm, nan if the chain has no output yet
+        """
+        if self.chain is None:
+            self.buffer.add_many(reading.corrected_ppm)
+            return self.buffer.get(m=self.correction_factor)
+
+        self.chain.update(temperature, humidity)
+        out = self.chain.process(reading.ppm if self.chain.compensates else reading.corrected_ppm)
+        return float(out[-1]) if len(out) else math.nan
+
+    def scale_rate(self, factor: float) -> None:
+        """Scale the rate of the reader relative to its base period, keeping the filter window in seconds
+
+        The buffer holds factor times its base size, at least 3 values so outliers are still
+        rejected. With background sampling, the sample rate is scaled too.
+
+        Args:
+            factor (float): base period divided by the new period
+        """
+        self.buffer.resize(max(3, round(self.base_size * factor)))
+        if self.base_rate:
+            self.sampler.rate = self.base_rate * factor
+
+    def set_raw(self, value: int) -> None:
+        """Set the voltage, value and percent of a raw reading"""
+        self.publisher.set(SensorReadingFieldNames.GAS_SENSOR_VOLTAGE, self.mq135.get_voltage(value))
+        self.publisher.set(SensorReadingFieldNames.GAS_SENSOR_VALUE, value)
+        self.publisher.set(SensorReadingFieldNames.GAS_SENSOR_PERCENT, (value / self.mq135.sensor_max_value) * 100)
+
+    def set_gases(self, ppm: float) -> None:
+        """Set the gas estimates of the model at the ratio of a filtered ppm"""
+        if self.model is None:
+            return
+        estimates = self.model.compute_many(self.model.get_ppm_ratios(ppm))
+        for field, value in zip(self.gas_fields, estimates.tolist()):
+            self.publisher.set(field, value)
+
+
+class GasArrayReader:
+    """Reads several MQ-series sensors and sets the gas fields of all of them for one tick
+
+    Each tick takes one raw value per sensor, then converts, corrects and filters the values of
+    every sensor in one numpy pass. The rzero of each sensor is an array broadcast by the MQ135
+    conversion, and the buffers are the rows of a BufferArray. The gas estimates of every sensor
+    are one more pass of the multi-gas model. Every field goes to the publisher, so a tick is still
+    one redis transaction whatever the number of sensors.
+    """
+
+    def __init__(self, sensors: List[GasSensor], channels: List[ADCChannel], mq135: MQ135, buffer: BufferArray,
+                 publisher: RedisPublisher, correction_factor: float = 6.0, model: Optional[MQ135GasModel] = None):
+        """Initialize the reader
+
+        Args:
+            sensors (List[GasSensor]): the sensors, see sensors.py
+            channels (List[ADCChannel]): ADC channel of each sensor
+            mq135 (MQ135): converter of the raw values, its rzero is set to the rzero of each sensor
+            buffer (BufferArray): outlier filter of the ppm, one row per sensor
+            publisher (RedisPublisher): publisher the fields are set on, anything with its set method
+            correction_factor (float, optional): outlier cutoff of the buffer. Defaults to 6.0.
+            model (Optional[MQ135GasModel], optional): estimates the gases of the sensors, in the order of their gas fields. Defaults to None.
+        """
+        self.sensors = sensors
+        self.channels = channels
+        self.mq135 = mq135
+        self.mq135.RZERO = np.array([sensor.rzero for sensor in sensors])
+        self.buffer = buffer
+        self.publisher = publisher
+        self.correction_factor = correction_factor
+        self.model = model
+        self.recorder = None
+        # volts per code of each channel, at the gain of its ADC
+        self.volts_per_code = np.array([PGA_RANGE[channel._ads.gain] / 32767 for channel in channels])
+        self.fields = [sensor.fields[:len(GAS_FIELD_SUFFIXES)] for sensor in sensors]
+        self.gas_fields = [sensor.gas_fields if model is not None else [] for sensor in sensors]
+        # filter size and sample rates at the base period, see scale_rate
+        self.base_size = buffer.size
+        self.base_rates = [channel.rate for channel in channels]
+
+    def read(self, temperature: float = 25, humidity: float = 35) -> float:
+        """Read every sensor and set their gas fields of this tick
+
+        Args:
+            temperature (float, optional): ambient temperature for the ppm correction. Defaults to 25.
+            humidity (float, optional): ambient humidity for the ppm correction. Defaults to 35.
+
+        Returns:
+            float: the highest filtered ppm of the sensors, nan if no valid reading
+        """
+        values = np.empty(len(self.channels))
+        for i, channel in enumerate(self.channels):
+            try:
+                # latest sample of a scheduled channel, or a conversion
+                values[i] = channel.value
+            except OSError:
+                # I2C error, this sensor has no reading this tick
+                values[i] = np.nan
+
+        reading = self.mq135.compute_many(values, temperature, humidity)
+        self.buffer.add(reading.corrected_ppm)
+        filtered_ppm = self.buffer.get(m=self.correction_factor)
+        # one row of gas estimates per sensor
+        estimates = (self.model.compute_many(self.model.get_ppm_ratios(filtered_ppm)).tolist() if self.model is not None
+                     else [[]] * len(self.sensors))
+
+        rows = zip(values.tolist(), (values * self.volts_per_code).tolist(), reading.percent.tolist(), filtered_ppm.tolist(), estimates)
+        for (voltage_field, ppm_field, value_field, percent_field), gas_fields, (value, voltage, percent, ppm, gases) in zip(self.fields, self.gas_fields, rows):
+            if value == value:
+                self.publisher.set(voltage_field, voltage)
+                self.publisher.set(value_field, int(value))
+                self.publisher.set(percent_field, percent)
+            if ppm == ppm:
+                self.publisher.set(ppm_field, ppm)
+                for field, gas in zip(gas_fields, gases):
+                    self.publisher.set(field, gas)
+        if log_enabled('debug'):
+            log.debug("Gas sensors ppm", **dict(zip((sensor.name for sensor in self.sensors), filtered_ppm.tolist())))
+
+        valid = filtered_ppm[~np.isnan(filtered_ppm)]
+        return float(valid.max()) if len(valid) else math.nan
+
+    def scale_rate(self, factor: float) -> None:
+        """Scale the rate of the reader relative to its base period, keeping the filter window in seconds, see GasReader.scale_rate
+
+        Args:
+            factor (float): base period divided by the new period
+        """
+        self.buffer.resize(max(3, round(self.base_size * factor)))
+        for channel, rate in zip(self.channels, self.base_rates):
+            if rate:
+                channel.rate = rate * factor
+
+
+def create_gas_reader(publisher: RedisPublisher, buffer_size: int = 10, correction_factor: float = 6.0, sensor_max_value: int = 1023,
+                      sample_rate: int = 0, lookup_table: bool = False, filters: Optional[List[str]] = None,
+                      record_dir: str = '', record_capacity: int = 10_000_000, record_segment_rows: int = 4096,
+                      sensors: Optional[List[GasSensor]] = None) -> Union[GasReader, GasArrayReader]:
+    """Initialize the MQ135 sensors on their ADC channels and a reader setting their fields on a publisher
+
+    The default GAS sensor alone is read by a GasReader, any other registry by a GasArrayReader,
+    which only filters with the buffer. Gases of the registry are estimated by an MQ135GasModel.
 
     Args:
-        pin (ADS, optional): sensor pin of the plugged in sensor on the ADS1115. Defaults to ADS.P0.
+        publisher (RedisPublisher): publisher the fields are set on
+        buffer_size (int, optional): buffer size of the ppm filter. Defaults to 10.
+        correction_factor (float, optional): outlier cutoff of the ppm filter. Defaults to 6.0.
+        sensor_max_value (int, optional): sensor max value. Defaults to 1023.
+        sample_rate (int, optional): background samples per second, 0 reads one sample per tick. Defaults to 0.
+        lookup_table (bool, optional): convert readings with a cached MQ135LookupTable. Defaults to False.
+        filters (Optional[List[str]], optional): filter chain stage specs replacing the buffer, see parse_filter_chain. Defaults to None.
+        record_dir (str, optional): directory of a new flight recording of every reading, empty to not record. Defaults to ''.
+        record_capacity (int, optional): maximum rows of the recording. Defaults to 10_000_000.
+        record_segment_rows (int, optional): rows per committed segment of the recording. Defaults to 4096.
+        sensors (Optional[List[GasSensor]], optional): the sensors. Defaults to the GAS_SENSORS registry, see parse_gas_sensors.
+
+    Raises:
+        ValueError: if the registry is invalid, has an uncalibrated sensor or a gas without curve, or the options need a single sensor
 
     Returns:
-        AnalogIn: the analog sensor object
+        Union[GasReader, GasArrayReader]: the reader
     """
-    # Initialize the I2C bus
-    i2c = busio.I2C(board.SCL, board.SDA)
+    if sensors is None:
+        sensors = parse_gas_sensors()
+    uncalibrated = [sensor.rzero_name for sensor in sensors if math.isnan(sensor.rzero)]
+    if uncalibrated:
+        raise ValueError(f"Set the calibration of the gas sensors in {', '.join(uncalibrated)}, see calibrate.py")
+    if len(sensors) > 1 or sensors[0].name != DEFAULT_SENSOR_NAME:
+        if lookup_table or filters or record_dir:
+            raise ValueError("The lookup table, filter chains and flight recording need the single GAS sensor")
+        # the ADCs are shared with the other channels, conversions are scheduled by their ADC managers
+        mq135 = MQ135(None, sensor_max_value)
+        model = MQ135GasModel(mq135, sensors[0].gases) if sensors[0].gases else None
+        channels = [init_sensor(pin=sensor.pin, rate=sample_rate, address=sensor.address) for sensor in sensors]
+        print_if_debug(f"Gas sensors: {', '.join(f'{s.name} at {s.address:#x}:{s.pin} rzero {s.rzero}' for s in sensors)}", DEBUG)
+        return GasArrayReader(sensors, channels, mq135, BufferArray(len(sensors), buffer_size, "gas_buffer"),
+                              publisher, correction_factor, model)
 
-    # Create the ADC object using the I2C bus
-    ads = ADS.ADS1115(i2c)
+    # the ADC is shared with the other channels, conversions are scheduled by the ADC manager
+    sensor = init_sensor(pin=sensors[0].pin, rate=sample_rate, address=sensors[0].address)
+    sampler = sensor if sample_rate > 0 else None
+    if sampler is not None:
+        print_if_debug(f"Sampling MQ135 in the background at {sample_rate} SPS", DEBUG)
 
-    # Define the sensor (Analog input)
-    sensor = AnalogIn(ads, pin)
+    mq135 = MQ135(sensor, sensor_max_value)
+    mq135.RZERO = sensors[0].rzero
+    print_if_debug(f"MQ135 Sensor Initialized with max sensor value: {sensor_max_value}", DEBUG)
+    model = MQ135GasModel(mq135, sensors[0].gases) if sensors[0].gases else None
+    if model is not None:
+        print_if_debug(f"MQ135 gas model: {', '.join(model.gases)}", DEBUG)
+    converter = mq135
+    if lookup_table:
+        converter = MQ135LookupTable(mq135)
+        print_if_debug(f"MQ135 lookup table {'loaded from' if converter.loaded else 'built and cached in'} {converter.path}", DEBUG)
+
+    chain = parse_filter_chain(filters or [], mq135.get_ppm_correction)
+    if chain is not None:
+        print_if_debug(f"MQ135 filter chain: {', '.join(type(stage).__name__ for stage in chain.stages)}", DEBUG)
+
+    recorder = None
+    if record_dir:
+        recorder = create_flight_recorder(record_dir, record_capacity, record_segment_rows)
+        print_if_debug(f"Recording MQ135 readings to {recorder.path}", DEBUG)
+
+    return GasReader(mq135, converter, Buffer(buffer_size, "gas_buffer"), publisher, correction_factor, sampler, chain, recorder, model)
 
-    return sensor
 
 def main():
     parser = argparse.ArgumentParser(description='Read analog sensor data and send it to redis')
@@ -60,55 +368,157 @@ def main():
                         type=int,
                         help='Sensor max value. Default to SENSOR_ANALOG_VALUE_MAX env variable or 1023',
                         default=config('SENSOR_ANALOG_VALUE_MAX', default=1023, cast=int))
+    parser.add_argument('-t', '--batch-ticks',
+                        type=int,
+                        help='Number of ticks to batch into one redis transaction. Default to GAS_BATCH_TICKS env variable or 1',
+                        default=config('GAS_BATCH_TICKS', default=1, cast=int))
+    parser.add_argument('-a', '--sample-rate',
+                        type=int,
+                        help='Sample the ADC channel in the background at this rate through the shared ADC scheduler and filter every sample. '
+                             '0 reads one sample per refresh. Default to GAS_SAMPLE_RATE env variable or 0',
+                        default=config('GAS_SAMPLE_RATE', default=0, cast=int))
+    parser.add_argument('-l', '--lookup-table',
+                        action='store_true',
+                        help='Convert readings with a precomputed table cached in MQ135_LUT_DIR. Default to GAS_LOOKUP_TABLE env variable or False',
+                        default=config('GAS_LOOKUP_TABLE', default=False, cast=bool))
+    parser.add_argument('-o', '--overrun-policy',
+                        choices=['skip', 'catch-up'],
+                        help='When a tick overruns its deadline, skip the missed ticks or run them back to back. Default to LOOP_OVERRUN_POLICY env variable or skip',
+                        default=config('LOOP_OVERRUN_POLICY', default='skip'))
+    parser.add_argument('-F', '--filter',
+                        type=str,
+                        action='append',
+                        help='Filter chain stage as NAME:ARG:ARG, replacing the buffer. Can be repeated, applied in order. '
+                             'Stages: outlier, ema, kalman, fir, cic, buffer, compensate. Default to GAS_FILTERS env variable',
+                        default=None)
+    parser.add_argument('-R', '--record-dir',
+                        type=str,
+                        help='Record every reading to a new flight recording in this directory, see recorder.py. Default to RECORDER_DIR env variable or no recording',
+                        default=config('RECORDER_DIR', default=''))
+    parser.add_argument('--record-capacity',
+                        type=int,
+                        help='Maximum rows of a flight recording. Default to RECORDER_CAPACITY env variable or 10000000',
+                        default=config('RECORDER_CAPACITY', default=10_000_000, cast=int))
+    parser.add_argument('--record-segment-rows',
+                        type=int,
+                        help='Rows synced to the flight recording at once, lost at most on power loss. Default to RECORDER_SEGMENT_ROWS env variable or 4096',
+                        default=config('RECORDER_SEGMENT_ROWS', default=4096, cast=int))
+    parser.add_argument('-A', '--adaptive',
+                        action='store_true',
+                        help='Adapt the refresh rate to the gas dynamics between the min and max refresh rates. Default to GAS_ADAPTIVE env variable or False',
+                        default=config('GAS_ADAPTIVE', default=False, cast=bool))
+    parser.add_argument('--min-refresh-rate',
+                        type=float,
+                        help='Adaptive refresh rate in seconds while the gas moves. Default to GAS_MIN_REFRESH_RATE env variable or 0.05',
+                        default=config('GAS_MIN_REFRESH_RATE', default=0.05, cast=float))
+    parser.add_argument('--max-refresh-rate',
+                        type=float,
+                        help='Adaptive refresh rate in seconds while the gas is steady. Default to GAS_MAX_REFRESH_RATE env variable or 0.8',
+                        default=config('GAS_MAX_REFRESH_RATE', default=0.8, cast=float))
+    parser.add_argument('--adaptive-slope',
+                        type=float,
+                        help='Rate of change in ppm/s above which the gas moves. Default to GAS_ADAPTIVE_SLOPE env variable or 5.0',
+                        default=config('GAS_ADAPTIVE_SLOPE', default=5.0, cast=float))
+    parser.add_argument('--adaptive-std',
+                        type=float,
+                        help='Standard deviation in ppm above which the gas moves, 0 to ignore. Default to GAS_ADAPTIVE_STD env variable or 10.0',
+                        default=config('GAS_ADAPTIVE_STD', default=10.0, cast=float))
+    parser.add_argument('--adaptive-hold',
+                        type=float,
+                        help='Seconds the gas must stay steady before each slow down. Default to GAS_ADAPTIVE_HOLD env variable or 2.0',
+                        default=config('GAS_ADAPTIVE_HOLD', default=2.0, cast=float))
+    parser.add_argument('-S', '--sensor',
+                        type=str,
+                        action='append',
+                        help='Gas sensor as NAME:ADDRESS:PIN[:RZERO], e.g. GAS2:0x49:1. Can be repeated, see sensors.py. '
+                             'Default to GAS_SENSORS env variable or the GAS sensor on input 0 of the ADS1115 at 0x48',
+                        default=None)
+    parser.add_argument('-G', '--gas-model',
+                        type=str,
+                        action='append',
+                        help='Gas estimated from the MQ135 resistance and published as {NAME}_{GAS} besides the CO2 ppm. Can be repeated. '
+                             'Gases: CO2, CO, ALCOHOL, TOLUENE, NH4, ACETONE. Default to GAS_MODEL_GASES env variable or none',
+                        default=None)
+    parser.add_argument('-M', '--compensation-max-age',
+                        type=float,
+                        help='Seconds after which a temperature or humidity reading is too old and the default is used, 0 to only follow the key expire time. '
+                             'Default to GAS_COMPENSATION_MAX_AGE env variable or 0',
+                        default=config('GAS_COMPENSATION_MAX_AGE', default=0.0, cast=float))
+    parser.add_argument('-H', '--history-maxlen',
+                        type=int,
+                        help='Also append the values of every tick to the HISTORY_GAS redis stream, trimmed to about this many records, '
+                             '0 to keep no history. Default to GAS_HISTORY_MAXLEN env variable or 0',
+                        default=config('GAS_HISTORY_MAXLEN', default=0, cast=int))
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='Serve the metrics as Prometheus text on this HTTP port, 0 to not serve. Default to METRICS_PORT env variable or 0',
+                        default=config('METRICS_PORT', default=0, cast=int))
+    parser.add_argument('--metrics-redis',
+                        type=float,
+                        help='Write the metrics to the METRICS_GAS redis hash every this many seconds, 0 to not write. Default to METRICS_REDIS_SECOND env variable or 0',
+                        default=config('METRICS_REDIS_SECOND', default=0.0, cast=float))
 
     args = parser.parse_args()
+    # repeated options replace the env list rather than extend it
+    if args.filter is None:
+        args.filter = config('GAS_FILTERS', default='', cast=Csv())
+    if args.sensor is None:
+        args.sensor = config('GAS_SENSORS', default='', cast=Csv())
+    if args.gas_model is None:
+        args.gas_model = config('GAS_MODEL_GASES', default='', cast=Csv())
     # connect to redis
     global DEBUG
     DEBUG = args.debug
+    if DEBUG:
+        set_log_level('debug')
 
     r = connect_redis(args.password, DEBUG)
-    sensor = init_sensor(pin=ADS.P0)
-    sensor_max_value = args.sensor_max_value
+    start_metrics_export('gas', args.metrics_port, r, args.metrics_redis)
+    publisher = RedisPublisher(r, args.expire_time, args.batch_ticks, channel=GAS_UPDATES_CHANNEL,
+                               history=GAS_HISTORY_STREAM, history_maxlen=args.history_maxlen)
+    try:
+        reader = create_gas_reader(publisher, args.buffer_size, args.correction_factor, args.sensor_max_value, args.sample_rate,
+                                   args.lookup_table, args.filter, args.record_dir, args.record_capacity, args.record_segment_rows,
+                                   parse_gas_sensors(args.sensor, args.gas_model))
+    except ValueError as e:
+        parser.error(str(e))
+    adaptive = None
+    period = args.refresh_rate
+    if args.adaptive:
+        adaptive = AdaptiveRate(args.min_refresh_rate, args.max_refresh_rate, args.adaptive_slope, args.adaptive_std, hold_second=args.adaptive_hold)
+        period = adaptive.period
+        reader.scale_rate(args.refresh_rate / period)
+    scheduler = DeadlineScheduler(period, "Gas", args.overrun_policy, report_second=10 if DEBUG else 0)
+    # temperature and humidity are pushed by the temperature service, default to 25 and 35 when missing or stale
+    compensation = FieldCache(r, {SensorReadingFieldNames.TEMPERATURE: 25, SensorReadingFieldNames.HUMIDITY: 35},
+                              TEMP_UPDATES_CHANNEL, args.compensation_max_age or None)
+    try:
+        while True:
+            compensation.poll()
+            temperature = compensation.get(SensorReadingFieldNames.TEMPERATURE)
+            humidity = compensation.get(SensorReadingFieldNames.HUMIDITY)
+            log.debug("Compensation: temperature %s (%.1f s old), humidity %s (%.1f s old)",
+                      temperature, compensation.age(SensorReadingFieldNames.TEMPERATURE),
+                      humidity, compensation.age(SensorReadingFieldNames.HUMIDITY))
 
-    mq135 = MQ135(sensor, sensor_max_value)
-    print_if_debug(f"MQ135 Sensor Initialized with max sensor value: {sensor_max_value}", DEBUG)
+            ppm = reader.read(temperature, humidity)
 
-    buffer = Buffer(args.buffer_size)
-    while True:
-        # send raw value
-        r.set(SensorReadingFieldNames.GAS_SENSOR_VOLTAGE, sensor.voltage, ex=args.expire_time)
-        r.set(SensorReadingFieldNames.GAS_SENSOR_VALUE, sensor.value, ex=args.expire_time)
-        r.set(SensorReadingFieldNames.GAS_SENSOR_PERCENT, (sensor.value / sensor_max_value) * 100, ex=args.expire_time)
-        print_if_debug("Set Sensor Voltage and Value to redis", DEBUG)
+            # send all values of this tick in one transaction
+            publisher.tick()
 
-        # send calculated PPM value
-        # read temp from redis
-        temperature = r.get(SensorReadingFieldNames.TEMPERATURE)
-        humidity = r.get(SensorReadingFieldNames.HUMIDITY)
-
-        # assume temperature and humidity are always available. provide to 25 and 35 respectively if otherwise
-        temperature = convert_to_float_or_default(temperature, 25)
-        humidity = convert_to_float_or_default(humidity, 35)
-        
-        try:
-            rzero = mq135.get_rzero()
-            corrected_rzero = mq135.get_corrected_rzero(temperature, humidity)
-            resistance = mq135.get_resistance()
-            ppm = mq135.get_ppm()
-            corrected_ppm = mq135.get_corrected_ppm(temperature, humidity)
-
-            print_if_debug("MQ135 RZero: " + str(rzero) +"\t Corrected RZero: "+ str(corrected_rzero)+
-                "\t Resistance: "+ str(resistance) +"\t PPM: "+str(ppm)+
-                "\t Corrected PPM: "+str(corrected_ppm)+"ppm", DEBUG)
-            
-            # filter value and save to redis
-            buffer.add(corrected_ppm)
-            filtered_ppm = buffer.get(m=args.correction_factor)
-            r.set(SensorReadingFieldNames.GAS_PPM, filtered_ppm, ex=args.expire_time)
-        except Exception as e:
-            print_if_debug("Error reading MQ135 sensor: " + str(e), DEBUG)
+            if adaptive is not None:
+                new_period = adaptive.update(ppm, monotonic())
+                if new_period != period:
+                    log.info("Gas refresh rate %s -> %s s", period, new_period)
+                    period = new_period
+                    scheduler.set_period(period)
+                    reader.scale_rate(args.refresh_rate / period)
 
-        time.sleep(args.refresh_rate)
+            scheduler.wait()
+    finally:
+        # commit the rows of the last segment
+        if reader.recorder is not None:
+            reader.recorder.close()
 
 
 if __name__ == "__main__":
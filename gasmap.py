@@ -0,0 +1,368 @@
+import csv
+import math
+from collections import deque
+from time import time
+from typing import Deque, Dict, NamedTuple, Optional, Tuple
+import numpy as np
+
+# meters per degree of latitude, on the mean earth radius
+METERS_PER_DEGREE = 6371008.8 * math.pi / 180
+# statistics of each map cell
+GRID_STATS = ('count', 'mean', 'max', 'last_seen')
+
+
+class Hotspot(NamedTuple):
+    """Map cell with the highest concentration around a position"""
+    # center of the cell
+    lat: float
+    lon: float
+    # meters from the queried position to the center of the cell
+    north: float
+    east: float
+    # statistic of the query, mean or max
+    value: float
+    count: int
+    # timestamp of the latest reading in the cell
+    last_seen: float
+
+
+class PositionTrack:
+    """Ring of the latest position fixes of the drone, interpolated at sample timestamps"""
+
+    def __init__(self, capacity: int = 1024, max_gap: float = 1.0):
+        """Initialize an empty track
+
+        Args:
+            capacity (int, optional): fixes kept, the oldest are overwritten. Defaults to 1024.
+            max_gap (float, optional): seconds between two fixes above which samples between them have no position. Defaults to 1.0.
+        """
+        self.capacity = capacity
+        self.max_gap = max_gap
+        # columns time, lat, lon, alt
+        self.fixes = np.empty((4, capacity))
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    @property
+    def last_time(self) -> float:
+        """Timestamp of the latest fix, -inf without fix"""
+        return self.fixes[0, (self.count - 1) % self.capacity] if self.count else -math.inf
+
+    @property
+    def position(self) -> Optional[Tuple[float, float, float]]:
+        """Latitude, longitude and altitude of the latest fix"""
+        if not self.count:
+            return None
+        _, lat, lon, alt = self.fixes[:, (self.count - 1) % self.capacity]
+        return float(lat), float(lon), float(alt)
+
+    def add(self, timestamp: float, lat: float, lon: float, alt: float) -> None:
+        """Add a fix. Fixes older than the latest one are ignored"""
+        if timestamp <= self.last_time:
+            return
+        self.fixes[:, self.count % self.capacity] = (timestamp, lat, lon, alt)
+        self.count += 1
+
+    def clear(self) -> None:
+        """Drop every fix, e.g. when the flight controller reboots"""
+        self.count = 0
+
+    def ordered(self) -> np.ndarray:
+        """Fixes from the oldest to the latest"""
+        if self.count <= self.capacity:
+            return self.fixes[:, :self.count]
+        head = self.count % self.capacity
+        return np.concatenate((self.fixes[:, head:], self.fixes[:, :head]), axis=1)
+
+    def interpolate(self, timestamps) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Interpolate the position linearly between the fixes around each timestamp
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: latitude, longitude, altitude and whether
+                the timestamp is between two fixes at most max_gap apart
+        """
+        timestamps = np.asarray(timestamps, dtype=float)
+        if len(self) < 2:
+            nan = np.full(timestamps.shape, np.nan)
+            return nan, nan, nan, np.zeros(timestamps.shape, dtype=bool)
+
+        times, lat, lon, alt = self.ordered()
+        after = np.clip(np.searchsorted(times, timestamps), 1, len(times) - 1)
+        valid = (timestamps >= times[0]) & (timestamps <= times[-1]) & (times[after] - times[after - 1] <= self.max_gap)
+        return np.interp(timestamps, times, lat), np.interp(timestamps, times, lon), np.interp(timestamps, times, alt), valid
+
+
+class GasGrid:
+    """Running statistics of gas readings on a square grid around the first position
+
+    Positions are projected on a local equirectangular plane, in meters north and east of the
+    origin. The statistics are dense numpy arrays over the bounding box of the flight, grown by
+    doubling when a reading falls outside, so an update is an index computation and a query
+    around a position is a slice of the arrays, whatever the number of readings.
+    """
+
+    def __init__(self, cell_size: float = 5.0):
+        """Initialize an empty grid
+
+        Args:
+            cell_size (float, optional): side of a cell in meters. Defaults to 5.0.
+        """
+        self.cell_size = cell_size
+        self.origin: Optional[Tuple[float, float]] = None
+        self.meters_per_lon = METERS_PER_DEGREE
+        # cell index of the first row and column of the arrays
+        self.row0 = 0
+        self.col0 = 0
+        self.count = np.zeros((0, 0), dtype=np.int64)
+        self.total = np.zeros((0, 0))
+        self.maximum = np.zeros((0, 0))
+        self.last_seen = np.zeros((0, 0))
+        self.points = 0
+
+    def set_origin(self, lat: float, lon: float) -> None:
+        """Center the projection on a position"""
+        self.origin = (lat, lon)
+        self.meters_per_lon = METERS_PER_DEGREE * math.cos(math.radians(lat))
+
+    def project(self, lat, lon) -> Tuple[np.ndarray, np.ndarray]:
+        """Meters north and east of the origin"""
+        return ((np.asarray(lat, dtype=float) - self.origin[0]) * METERS_PER_DEGREE,
+                (np.asarray(lon, dtype=float) - self.origin[1]) * self.meters_per_lon)
+
+    def unproject(self, north, east) -> Tuple[np.ndarray, np.ndarray]:
+        """Latitude and longitude of positions north and east of the origin"""
+        return (self.origin[0] + np.asarray(north) / METERS_PER_DEGREE,
+                self.origin[1] + np.asarray(east) / self.meters_per_lon)
+
+    def grow(self, row_min: int, row_max: int, col_min: int, col_max: int) -> None:
+        """Grow the arrays to hold the cells from row_min to row_max and col_min to col_max"""
+        rows, cols = self.count.shape
+        if rows and self.row0 <= row_min and row_max < self.row0 + rows and self.col0 <= col_min and col_max < self.col0 + cols:
+            return
+        if rows:
+            # at least double each side that grows, so a straight flight reallocates log(n) times
+            row_min = min(row_min, self.row0 - rows) if row_min < self.row0 else self.row0
+            row_max = max(row_max, self.row0 + 2 * rows - 1) if row_max >= self.row0 + rows else self.row0 + rows - 1
+            col_min = min(col_min, self.col0 - cols) if col_min < self.col0 else self.col0
+            col_max = max(col_max, self.col0 + 2 * cols - 1) if col_max >= self.col0 + cols else self.col0 + cols - 1
+        else:
+            row_min, row_max, col_min, col_max = row_min - 16, row_max + 16, col_min - 16, col_max + 16
+
+        shape = (row_max - row_min + 1, col_max - col_min + 1)
+        window = (slice(self.row0 - row_min, self.row0 - row_min + rows), slice(self.col0 - col_min, self.col0 - col_min + cols))
+        for name, fill in (('count', 0), ('total', 0.), ('maximum', -np.inf), ('last_seen', -np.inf)):
+            array = np.full(shape, fill, dtype=getattr(self, name).dtype)
+            array[window] = getattr(self, name)
+            setattr(self, name, array)
+        self.row0 = row_min
+        self.col0 = col_min
+
+    def add_many(self, lat, lon, values, timestamps) -> None:
+        """Add readings at their positions. Readings without a value or position are ignored"""
+        lat, lon, values, timestamps = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (lat, lon, values, timestamps)))
+        valid = ~(np.isnan(lat) | np.isnan(lon) | np.isnan(values))
+        if not valid.any():
+            return
+        lat, lon, values, timestamps = lat[valid], lon[valid], values[valid], timestamps[valid]
+        if self.origin is None:
+            self.set_origin(float(lat[0]), float(lon[0]))
+
+        north, east = self.project(lat, lon)
+        rows = np.floor(north / self.cell_size).astype(np.intp)
+        cols = np.floor(east / self.cell_size).astype(np.intp)
+        self.grow(int(rows.min()), int(rows.max()), int(cols.min()), int(cols.max()))
+        index = (rows - self.row0, cols - self.col0)
+        np.add.at(self.count, index, 1)
+        np.add.at(self.total, index, values)
+        np.maximum.at(self.maximum, index, values)
+        np.maximum.at(self.last_seen, index, timestamps)
+        self.points += len(values)
+
+    def add(self, lat: float, lon: float, value: float, timestamp: float) -> None:
+        """Add one reading at its position, like add_many without the numpy overhead"""
+        if math.isnan(lat) or math.isnan(lon) or math.isnan(value):
+            return
+        if self.origin is None:
+            self.set_origin(lat, lon)
+        row = math.floor((lat - self.origin[0]) * METERS_PER_DEGREE / self.cell_size)
+        col = math.floor((lon - self.origin[1]) * self.meters_per_lon / self.cell_size)
+        self.grow(row, row, col, col)
+        index = (row - self.row0, col - self.col0)
+        self.count[index] += 1
+        self.total[index] += value
+        if value > self.maximum[index]:
+            self.maximum[index] = value
+        if timestamp > self.last_seen[index]:
+            self.last_seen[index] = timestamp
+        self.points += 1
+
+    def get(self, stat: str = 'mean') -> np.ndarray:
+        """Heatmap of a statistic, rows from south to north and columns from west to east, nan in empty cells
+
+        Args:
+            stat (str, optional): one of GRID_STATS. Defaults to 'mean'.
+
+        Raises:
+            ValueError: if the statistic is unknown
+        """
+        if stat == 'count':
+            return self.count.copy()
+        empty = self.count == 0
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(empty, np.nan, self.total / self.count)
+        if stat == 'max':
+            return np.where(empty, np.nan, self.maximum)
+        if stat == 'last_seen':
+            return np.where(empty, np.nan, self.last_seen)
+        raise ValueError(f"Unknown map statistic {stat}, expected one of {', '.join(GRID_STATS)}")
+
+    def query(self, lat: float, lon: float, radius: float, stat: str = 'mean') -> Optional[Hotspot]:
+        """Find the cell with the highest concentration within a radius
+
+        Args:
+            lat (float): latitude of the center
+            lon (float): longitude of the center
+            radius (float): radius in meters, cells whose center is within it are searched
+            stat (str, optional): mean or max concentration of the cells. Defaults to 'mean'.
+
+        Returns:
+            Optional[Hotspot]: the cell, None if no cell within the radius has readings
+        """
+        if self.origin is None:
+            return None
+        north, east = self.project(lat, lon)
+        reach = int(math.ceil(radius / self.cell_size))
+        center_row = int(math.floor(north / self.cell_size)) - self.row0
+        center_col = int(math.floor(east / self.cell_size)) - self.col0
+        rows, cols = self.count.shape
+        r0, r1 = max(center_row - reach, 0), min(center_row + reach + 1, rows)
+        c0, c1 = max(center_col - reach, 0), min(center_col + reach + 1, cols)
+        if r0 >= r1 or c0 >= c1:
+            return None
+
+        count = self.count[r0:r1, c0:c1]
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = self.total[r0:r1, c0:c1] / count
+        elif stat == 'max':
+            values = self.maximum[r0:r1, c0:c1]
+        else:
+            raise ValueError(f"Unknown map query statistic {stat}, expected mean or max")
+        # offsets of the cell centers from the queried position
+        cell_north = (np.arange(r0, r1) + self.row0 + 0.5) * self.cell_size - north
+        cell_east = (np.arange(c0, c1) + self.col0 + 0.5) * self.cell_size - east
+        inside = (cell_north[:, None] ** 2 + cell_east[None, :] ** 2 <= radius * radius) & (count > 0)
+        if not inside.any():
+            return None
+
+        best = np.unravel_index(np.argmax(np.where(inside, values, -np.inf)), values.shape)
+        hot_lat, hot_lon = self.unproject(cell_north[best[0]] + north, cell_east[best[1]] + east)
+        return Hotspot(float(hot_lat), float(hot_lon), float(cell_north[best[0]]), float(cell_east[best[1]]),
+                       float(values[best]), int(count[best]), float(self.last_seen[r0:r1, c0:c1][best]))
+
+    def save_csv(self, path: str) -> int:
+        """Write the statistics of every cell with readings, one row per cell at its center
+
+        Returns:
+            int: number of cells written
+        """
+        rows, cols = np.nonzero(self.count)
+        if self.origin is None:
+            rows = cols = np.zeros(0, dtype=np.intp)
+        else:
+            lat, lon = self.unproject((rows + self.row0 + 0.5) * self.cell_size, (cols + self.col0 + 0.5) * self.cell_size)
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('lat', 'lon') + GRID_STATS)
+            for i, (row, col) in enumerate(zip(rows.tolist(), cols.tolist())):
+                count = int(self.count[row, col])
+                writer.writerow((f"{lat[i]:.7f}", f"{lon[i]:.7f}", count, float(self.total[row, col]) / count,
+                                 float(self.maximum[row, col]), float(self.last_seen[row, col])))
+        return len(rows)
+
+
+class GasMapper:
+    """Joins the gas readings of a field with the position of the drone into a GasGrid
+
+    Fixes come from GLOBAL_POSITION_INT, whose time since boot of the flight controller is
+    mapped to the local clock of the sensor timestamps by the smallest offset seen, the fix
+    received with the least delay. Readings wait until a later fix arrives, then get the
+    position interpolated between the fixes around them. Readings still without a fix after
+    max_delay are dropped.
+    """
+
+    def __init__(self, field: str, grid: Optional[GasGrid] = None, track: Optional[PositionTrack] = None, max_delay: float = 5.0):
+        """Initialize the mapper
+
+        Args:
+            field (str): field name of the mapped readings, e.g. GAS_PPM
+            grid (Optional[GasGrid], optional): map of the readings. Defaults to a GasGrid of 5 m cells.
+            track (Optional[PositionTrack], optional): fixes of the drone. Defaults to a PositionTrack of 1024 fixes.
+            max_delay (float, optional): seconds a reading waits for a later fix. Defaults to 5.0.
+        """
+        self.field = field
+        self.grid = grid if grid is not None else GasGrid()
+        self.track = track if track is not None else PositionTrack()
+        self.max_delay = max_delay
+        self.pending: Deque[Tuple[float, float]] = deque()
+        self.clock_offset = math.inf
+        self.last_boot = -math.inf
+        self.dropped = 0
+
+    def handle_position(self, msg) -> None:
+        """Add a GLOBAL_POSITION_INT fix. Handler of MavlinkMultiplexer.add_message_handler"""
+        if msg.lat == 0 and msg.lon == 0:
+            # no GPS fix yet
+            return
+        boot = msg.time_boot_ms / 1000
+        if boot < self.last_boot:
+            # the flight controller rebooted, its clock restarted
+            self.track.clear()
+            self.clock_offset = math.inf
+        self.last_boot = boot
+        self.clock_offset = min(self.clock_offset, time() - boot)
+        self.track.add(boot + self.clock_offset, msg.lat / 1e7, msg.lon / 1e7, msg.relative_alt / 1000)
+
+    def add(self, value: float, timestamp: float) -> None:
+        """Queue a reading of the field until the fix after it arrives"""
+        if not math.isnan(value):
+            self.pending.append((timestamp, value))
+
+    def update(self, updates: Dict[str, Tuple[float, float]]) -> None:
+        """Queue the reading of the field in a sensor update, see decode_sensor_update"""
+        if self.field in updates:
+            self.add(*updates[self.field])
+
+    def process(self) -> int:
+        """Add the readings with a fix after them to the grid
+
+        Returns:
+            int: number of readings added
+        """
+        last_time = self.track.last_time
+        ready = []
+        while self.pending and self.pending[0][0] <= last_time:
+            ready.append(self.pending.popleft())
+        # readings that no fix will follow, e.g. while the GPS has no fix
+        stale = time() - self.max_delay
+        while self.pending and self.pending[0][0] < stale:
+            self.pending.popleft()
+            self.dropped += 1
+        if not ready:
+            return 0
+
+        timestamps, values = np.array(ready).T
+        lat, lon, _, valid = self.track.interpolate(timestamps)
+        self.dropped += int((~valid).sum())
+        self.grid.add_many(lat[valid], lon[valid], values[valid], timestamps[valid])
+        return int(valid.sum())
+
+    def get_hotspot(self, radius: float, stat: str = 'mean') -> Optional[Hotspot]:
+        """Highest concentration within a radius of the latest fix, see GasGrid.query"""
+        position = self.track.position
+        if position is None:
+            return None
+        return self.grid.query(position[0], position[1], radius, stat)
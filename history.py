@@ -0,0 +1,68 @@
+import argparse
+import csv
+import sys
+import time
+from decouple import config
+from utils import connect_redis, HistoryReader, GAS_HISTORY_STREAM, TEMP_HISTORY_STREAM
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the sensor history streams of redis to CSV, one row per field value, '
+                                                 'in the timestamp, name, value format reprocess.py reads')
+    parser.add_argument('-p', '--password',
+                        type=str,
+                        help='Redis password. Default to REDIS_PASSWORD env variable',
+                        default=config('REDIS_PASSWORD', default=''))
+    parser.add_argument('-s', '--stream',
+                        type=str,
+                        action='append',
+                        help=f'History stream to export. Can be repeated. Default to {GAS_HISTORY_STREAM} and {TEMP_HISTORY_STREAM}',
+                        default=None)
+    parser.add_argument('-S', '--since',
+                        type=float,
+                        help='Export the records of the last this many seconds, 0 for every record kept. Default to 0',
+                        default=0.0)
+    parser.add_argument('-f', '--follow',
+                        action='store_true',
+                        help='Keep exporting the records appended after the export until interrupted')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help='Output CSV file. Default to stdout',
+                        default=None)
+    args = parser.parse_args()
+    if args.since < 0:
+        parser.error("The export window cannot be negative")
+
+    streams = args.stream or [GAS_HISTORY_STREAM, TEMP_HISTORY_STREAM]
+    r = connect_redis(args.password)
+    reader = HistoryReader(r, streams)
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.writer(output)
+    writer.writerow(['timestamp', 'name', 'value'])
+
+    def write(records) -> int:
+        for record in records:
+            writer.writerows((record.timestamp, name, value) for name, value in record.values.items())
+        return len(records)
+
+    start = time.time() - args.since if args.since > 0 else None
+    exported = 0
+    try:
+        for stream in streams:
+            records = reader.range(stream, start)
+            exported += write(records)
+            # follow from the last exported record, so no record falls in between
+            reader.last_ids[stream] = records[-1].id if records else '$'
+        while args.follow:
+            exported += write(reader.read(block=1.0))
+            output.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        print(f"{exported} records of {', '.join(streams)}, {reader.skipped} skipped", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
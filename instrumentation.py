@@ -0,0 +1,367 @@
+"""
+Instrumentation shared by the services
+
+Logging is gated on its level before the message is built: format arguments and fields are
+passed separately and only formatted when the level is enabled, so a disabled debug log in a
+hot loop costs one comparison. Timers and counters record into the process wide METRICS
+registry, exported as Prometheus text on a local HTTP port and / or as a redis hash every few
+seconds, see start_metrics_export.
+"""
+import math
+import threading
+from bisect import bisect_left
+from time import perf_counter, sleep
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Union
+from decouple import config
+
+if TYPE_CHECKING:
+    # only needed by the exports, imported when they start
+    from http.server import ThreadingHTTPServer
+    import redis
+
+# histogram bin edges in milliseconds, 10 steps per decade (R10 series) from 10 us to 10 s
+HISTOGRAM_EDGES_MS: List[float] = [round(m * 10 ** e, 6) for e in range(-2, 4) for m in (1, 1.25, 1.6, 2, 2.5, 3.15, 4, 5, 6.3, 8)] + [10000.0]
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+_log_level = LOG_LEVELS.get(config('LOG_LEVEL', default='info').lower(), LOG_LEVELS['info'])
+
+
+class Histogram:
+    """Fixed bin histogram of durations in milliseconds"""
+
+    def __init__(self, edges: Optional[List[float]] = None):
+        """Initialize an empty histogram
+
+        Args:
+            edges (Optional[List[float]], optional): upper edges of the bins, the last bin is unbounded. Defaults to HISTOGRAM_EDGES_MS.
+        """
+        self.edges = edges or HISTOGRAM_EDGES_MS
+        self.reset()
+
+    def add(self, value: float) -> None:
+        """Count a value
+
+        Args:
+            value (float): duration in milliseconds
+        """
+        self.counts[bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        """Get the upper edge of the bin holding a percentile
+
+        Args:
+            q (float): percentile between 0 and 1
+
+        Returns:
+            float: upper bound of the percentile in milliseconds, at most the max, nan if empty
+        """
+        if self.count == 0:
+            return math.nan
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        """Mean of the counted values, nan if empty"""
+        return self.total / self.count if self.count else math.nan
+
+    def reset(self) -> None:
+        """Clear all bins"""
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+def set_log_level(level: str) -> None:
+    """Set the level of every logger of the process
+
+    Args:
+        level (str): one of LOG_LEVELS
+
+    Raises:
+        ValueError: if the level is unknown
+    """
+    global _log_level
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level {level}, expected one of {', '.join(LOG_LEVELS)}")
+    _log_level = LOG_LEVELS[level]
+
+
+def log_enabled(level: str) -> bool:
+    """Whether messages of a level are printed, to guard building costly arguments"""
+    return LOG_LEVELS[level] >= _log_level
+
+
+class Logger:
+    """Level gated logger of one component
+
+    Messages are %-format strings, formatted with their arguments only if the level is
+    enabled. Keyword fields are appended as key=value pairs.
+    """
+
+    def __init__(self, name: str):
+        """Initialize the logger
+
+        Args:
+            name (str): component name prefixed to the messages
+        """
+        self.name = name
+
+    def log(self, level: int, message: str, *args, **fields) -> None:
+        """Print a message if its level is enabled"""
+        if level < _log_level:
+            return
+        if args:
+            message = message % args
+        if fields:
+            message += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        print(f"[{self.name}] {message}")
+
+    def debug(self, message: str, *args, **fields) -> None:
+        """Print a debug message, see log"""
+        if _log_level <= 10:
+            self.log(10, message, *args, **fields)
+
+    def info(self, message: str, *args, **fields) -> None:
+        """Print an info message, see log"""
+        if _log_level <= 20:
+            self.log(20, message, *args, **fields)
+
+    def warning(self, message: str, *args, **fields) -> None:
+        """Print a warning message, see log"""
+        self.log(30, message, *args, **fields)
+
+    def error(self, message: str, *args, **fields) -> None:
+        """Print an error message, see log"""
+        self.log(40, message, *args, **fields)
+
+
+class Counter:
+    """Monotonic count of events"""
+
+    def __init__(self, name: str, help: str = ''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        """Count events"""
+        self.value += amount
+
+
+class Gauge:
+    """Current value, set or read from a function at export"""
+
+    def __init__(self, name: str, help: str = '', read: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self._value = math.nan
+
+    def set(self, value: float) -> None:
+        """Set the value"""
+        self._value = value
+
+    @property
+    def value(self) -> float:
+        """Current value"""
+        return self.read() if self.read is not None else self._value
+
+
+class Timer:
+    """Durations in milliseconds, kept in a Histogram since the start of the process"""
+
+    def __init__(self, name: str, help: str = ''):
+        self.name = name
+        self.help = help
+        self.histogram = Histogram()
+
+    @staticmethod
+    def start() -> float:
+        """Get the start time of a measure, see stop"""
+        return perf_counter()
+
+    def stop(self, start: float) -> None:
+        """Record the time since a start"""
+        self.histogram.add((perf_counter() - start) * 1000)
+
+    def observe(self, ms: float) -> None:
+        """Record a duration in milliseconds measured elsewhere"""
+        self.histogram.add(ms)
+
+
+Metric = Union[Counter, Gauge, Timer]
+
+
+class MetricsRegistry:
+    """Named metrics of the process
+
+    Metrics are created on first use and shared by name, so a component gets the same metric
+    however many times it asks for it.
+    """
+
+    # percentiles exported for each timer
+    QUANTILES = (0.5, 0.99)
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = dict()
+
+    def _get(self, cls, name: str, help: str, **kwargs) -> Metric:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is a {type(metric).__name__}, not a {cls.__name__}")
+        return metric
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        """Get or create a counter"""
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = '', read: Optional[Callable[[], float]] = None) -> Gauge:
+        """Get or create a gauge, read from a function at export if given"""
+        gauge = self._get(Gauge, name, help)
+        if read is not None:
+            gauge.read = read
+        return gauge
+
+    def timer(self, name: str, help: str = '') -> Timer:
+        """Get or create a timer"""
+        return self._get(Timer, name, help)
+
+    def collect(self) -> Dict[str, float]:
+        """Get the current value of every metric
+
+        Timers give their count, mean, percentiles and max in milliseconds as name_count,
+        name_mean, name_p50, name_p99 and name_max.
+
+        Returns:
+            Dict[str, float]: value of each metric
+        """
+        values: Dict[str, float] = dict()
+        for name, metric in list(self.metrics.items()):
+            if isinstance(metric, Timer):
+                histogram = metric.histogram
+                values[f"{name}_count"] = histogram.count
+                values[f"{name}_mean"] = histogram.mean
+                for q in self.QUANTILES:
+                    values[f"{name}_p{round(q * 100)}"] = histogram.percentile(q)
+                values[f"{name}_max"] = histogram.max
+            else:
+                values[name] = metric.value
+        return values
+
+    def render(self) -> str:
+        """Get every metric in the Prometheus text format, timers as summaries"""
+        lines = []
+        for name, metric in list(self.metrics.items()):
+            if metric.help:
+                lines.append(f"# HELP {name} {metric.help}")
+            if isinstance(metric, Timer):
+                histogram = metric.histogram
+                lines.append(f"# TYPE {name} summary")
+                for q in self.QUANTILES:
+                    lines.append(f'{name}{{quantile="{q}"}} {histogram.percentile(q)}')
+                lines.append(f"{name}_sum {histogram.total}")
+                lines.append(f"{name}_count {histogram.count}")
+            else:
+                lines.append(f"# TYPE {name} {'counter' if isinstance(metric, Counter) else 'gauge'}")
+                lines.append(f"{name} {metric.value}")
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+def start_metrics_server(port: int, registry: MetricsRegistry = METRICS, host: str = '0.0.0.0') -> "ThreadingHTTPServer":
+    """Serve the metrics as Prometheus text on /metrics from a background thread
+
+    Args:
+        port (int): HTTP port
+        registry (MetricsRegistry, optional): metrics served. Defaults to METRICS.
+        host (str, optional): address to listen on. Defaults to '0.0.0.0'.
+
+    Returns:
+        ThreadingHTTPServer: the server
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are not worth a line each
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
+
+
+def start_redis_export(r: "redis.Redis", key: str, period: float, registry: MetricsRegistry = METRICS) -> threading.Thread:
+    """Write the metrics to a redis hash every period from a background thread
+
+    The hash expires after three periods, so the metrics of a stopped service disappear.
+
+    Args:
+        r (redis.Redis): redis connection
+        key (str): key of the hash
+        period (float): seconds between writes
+        registry (MetricsRegistry, optional): metrics written. Defaults to METRICS.
+
+    Returns:
+        threading.Thread: the export thread
+    """
+    from redis.exceptions import RedisError
+
+    def export():
+        while True:
+            sleep(period)
+            # nan is not a valid redis float, export it as a string
+            values = {name: value if value == value else 'nan' for name, value in registry.collect().items()}
+            try:
+                pipe = r.pipeline(transaction=True)
+                pipe.hset(key, mapping=values)
+                pipe.expire(key, max(1, math.ceil(3 * period)))
+                pipe.execute()
+            except RedisError:
+                # metrics are best effort, try again on the next period
+                pass
+
+    thread = threading.Thread(target=export, name="MetricsExport", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_metrics_export(service: str, port: int = 0, r: Optional["redis.Redis"] = None, redis_second: float = 0.0) -> None:
+    """Export the metrics of a service as configured on its command line
+
+    Args:
+        service (str): service name, the redis hash is METRICS_{SERVICE}
+        port (int, optional): HTTP port of the Prometheus endpoint, 0 to not serve. Defaults to 0.
+        r (Optional[redis.Redis], optional): redis connection of the hash. Defaults to None.
+        redis_second (float, optional): seconds between writes of the hash, 0 to not write. Defaults to 0.0.
+    """
+    if port:
+        start_metrics_server(port)
+    if r is not None and redis_second > 0:
+        start_redis_export(r, f"METRICS_{service.upper()}", redis_second)
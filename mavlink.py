@@ -1,12 +1,156 @@
 from pymavlink import mavutil
-import redis
-from decouple import config
+from pymavlink.dialects.v20 import ardupilotmega as mavlink2
+from decouple import config, Csv
 import argparse
-from time import sleep, time
-from utils import connect_redis, convert_to_float_or_default, is_none_or_whitespace, SensorReadingFieldNames, print_if_debug
-from typing import Dict, Tuple
+from time import time, monotonic
+from scheduler import DeadlineScheduler
+from transmission import FieldPolicy, TransmissionScheduler, parse_policies
+from telemetry import PACKED_ARRAY_NAME, get_field_order, get_packed_version, pack_fields
+from sensors import GasSensor, get_field_names, parse_gas_sensors
+from instrumentation import METRICS, Logger, set_log_level, start_metrics_export
+from utils import connect_redis, convert_to_float_or_default, is_none_or_whitespace, get_fields, decode_sensor_update, print_if_debug, HistoryReader, \
+    GAS_HISTORY_STREAM, SENSOR_UPDATES_CHANNELS, TEMP_HISTORY_STREAM
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import redis
+    from gasmap import GasMapper
 
 DEBUG = False
+log = Logger("mavlink")
+# plume sent by PlumeForwarder: meters north and east of the drone, and its concentration
+PLUME_FIELDS = ("PLUME_N", "PLUME_E", "PLUME_PPM")
+
+class MavlinkMultiplexer:
+    """
+    One mavlink connection shared by several source components
+
+    Outgoing messages of every component are queued and written to the socket in one write per
+    flush. Incoming traffic on the same socket is drained without blocking after each flush.
+    """
+
+    def __init__(self, host: str, port: int, fc_sysid: int, queue_size: int = 64) -> None:
+        """
+        Initialize the shared mavlink connection
+
+        Args:
+            host (str): hostname of the mavlink router
+            port (int): port number of the mavlink router
+            fc_sysid (int): flight controller system id
+            queue_size (int, optional): maximum number of queued messages, the oldest is dropped when full. Defaults to 64.
+        """
+        self.fc_sysid = fc_sysid
+        self.connection: mavutil.mavfile = mavutil.mavlink_connection(f'tcp:{host}:{port}', source_system=fc_sysid)
+        self.queue: Deque[Tuple[float, bytes]] = deque(maxlen=queue_size)
+        self.handlers: Dict[str, List[Callable]] = dict()
+        self.write_timer = METRICS.timer("mavlink_write_ms", "mavlink socket write of a flush")
+        self.sent_counter = METRICS.counter("mavlink_sent_total", "mavlink messages written")
+        self.dropped_counter = METRICS.counter("mavlink_dropped_total", "mavlink messages dropped from the full send queue")
+        self.reset_stats()
+
+    @property
+    def start_time(self) -> float:
+        """
+        Time the connection was opened
+        """
+        return self.connection.start_time
+
+    def create_sender(self, component_id: int, force_mavlink2: bool = False):
+        """
+        Create a message encoder for a source component that queues on this connection
+
+        Args:
+            component_id (int): source component id
+            force_mavlink2 (bool, optional): encode MAVLink 2 frames regardless of the connection dialect. Defaults to False.
+
+        Returns:
+            mavutil.mavlink.MAVLink: the message encoder
+        """
+        dialect = mavlink2 if force_mavlink2 else mavutil.mavlink
+        return dialect.MAVLink(self, srcSystem=self.fc_sysid, srcComponent=component_id)
+
+    def write(self, buf: bytes) -> None:
+        """
+        Queue a packed message. Called by the encoders of create_sender
+
+        Args:
+            buf (bytes): packed message
+        """
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            self.dropped_counter.inc()
+        self.queue.append((monotonic(), buf))
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+
+    def flush(self) -> None:
+        """
+        Write all queued messages in one write, then read the incoming messages
+        """
+        if self.queue:
+            start = self.write_timer.start()
+            self.connection.write(b''.join(buf for _, buf in self.queue))
+            self.write_timer.stop(start)
+            now = monotonic()
+            for queued_time, _ in self.queue:
+                latency = now - queued_time
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            self.sent_messages += len(self.queue)
+            self.sent_counter.inc(len(self.queue))
+            self.queue.clear()
+
+        self.read_incoming()
+
+    def read_incoming(self) -> None:
+        """
+        Read all messages waiting on the socket and pass them to their handlers
+        """
+        while True:
+            msg = self.connection.recv_msg()
+            if msg is None:
+                return
+            self.received_messages += 1
+            for handler in self.handlers.get(msg.get_type(), ()):
+                handler(msg)
+
+    def add_message_handler(self, message_type: str, handler: Callable) -> None:
+        """
+        Call a handler for every incoming message of a type
+
+        Args:
+            message_type (str): mavlink message type, e.g. GLOBAL_POSITION_INT
+            handler (Callable): function taking the message
+        """
+        self.handlers.setdefault(message_type, []).append(handler)
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Get the send queue statistics since the last reset
+
+        Returns:
+            Dict[str, float]: sent, received and dropped messages, max queue depth and queue latency in seconds
+        """
+        return {
+            "sent": self.sent_messages,
+            "received": self.received_messages,
+            "dropped": self.dropped,
+            "max_queue_depth": self.max_queue_depth,
+            "mean_latency": self.total_latency / self.sent_messages if self.sent_messages else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+    def reset_stats(self) -> None:
+        """
+        Reset the send queue statistics
+        """
+        self.sent_messages = 0
+        self.received_messages = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
 
 class SensorMavlinkConnection:
     """
@@ -18,73 +162,522 @@ class SensorMavlinkConnection:
     """
     __component_id = 10
 
-    def __init__(self, sensor_name: SensorReadingFieldNames, host: str, port: int, fc_sysid: int) -> None:
+    def __init__(self, sensor_name: str, multiplexer: MavlinkMultiplexer) -> None:
         """
         Initialize sensor mavlink connection
 
         Args:
-            sensor_name (SensorReadingFieldNames): name of the sensor
-            host (str): hostname of the mavlink router
-            port (int): port number of the mavlink router
-            fc_sysid (int): flight controller system id
+            sensor_name (str): field name of the sensor
+            multiplexer (MavlinkMultiplexer): shared connection to the mavlink router
         """
         self.sensor_name = sensor_name
         self.encoded_name = self.sensor_name.encode('ascii').ljust(10, b'\0')
-        self.mavsender: mavutil.mavfile = mavutil.mavlink_connection(f'tcp:{host}:{port}', source_system=fc_sysid, source_component=SensorMavlinkConnection.__component_id)
+        self.multiplexer = multiplexer
+        self.mav = multiplexer.create_sender(SensorMavlinkConnection.__component_id)
         SensorMavlinkConnection.__component_id += 1
 
 
     def send(self, value: float) -> None:
         """
-        Send sensor reading to drone
+        Queue sensor reading to drone. Sent on the next flush of the multiplexer
 
         Args:
             value (float): sensor reading value
         """
-        time_boot_ms = int((time() - self.mavsender.start_time) * 1000)
-        self.mavsender.mav.named_value_float_send(time_boot_ms, self.encoded_name, value)
-        print_if_debug(f"Sent {self.sensor_name} to drone: {value}", DEBUG)
+        time_boot_ms = int((time() - self.multiplexer.start_time) * 1000)
+        self.mav.named_value_float_send(time_boot_ms, self.encoded_name, value)
+        log.debug("Sent %s to drone: %s", self.sensor_name, value)
     
 
-def read_and_send(r: redis.Redis, port: int, fc_sysid: int, refresh_second: float = 1) -> None:
-    """Read gas sensor data from redis and send it to the drone
+class PackedSensorMavlinkConnection:
+    """
+    Class to send all sensor readings of a tick to drone in one packed mavlink message. See telemetry.py for the format
+    """
+
+    def __init__(self, multiplexer: MavlinkMultiplexer, component_id: int = 10, sensors: Optional[List[GasSensor]] = None) -> None:
+        """
+        Initialize packed sensor mavlink connection
+
+        Args:
+            multiplexer (MavlinkMultiplexer): shared connection to the mavlink router
+            component_id (int, optional): source component id. Defaults to 10.
+            sensors (Optional[List[GasSensor]], optional): gas sensor registry, selecting the format version. Defaults to parse_gas_sensors().
+        """
+        self.encoded_name = PACKED_ARRAY_NAME.encode('ascii').ljust(10, b'\0')
+        self.multiplexer = multiplexer
+        sensors = parse_gas_sensors() if sensors is None else sensors
+        self.version = get_packed_version(sensors)
+        self.order = get_field_order(self.version, sensors)
+        # DEBUG_FLOAT_ARRAY only exists in MAVLink 2
+        self.mav = multiplexer.create_sender(component_id, force_mavlink2=True)
+
+    def send(self, values: Dict[str, float]) -> None:
+        """
+        Queue sensor readings to drone. Sent on the next flush of the multiplexer
+
+        Args:
+            values (Dict[str, float]): sensor reading value of each field name
+        """
+        time_usec = int((time() - self.multiplexer.start_time) * 1e6)
+        self.mav.debug_float_array_send(time_usec, self.encoded_name, self.version, pack_fields(values, self.version, self.order))
+        log.debug("Sent packed readings to drone: %s", values)
+
+
+class LatencyStats:
+    """
+    Collects the latency from sensor timestamp to MAVLink send and prints percentiles periodically
+    """
+
+    def __init__(self, report_second: float = 10.0) -> None:
+        """
+        Initialize latency statistics
+
+        Args:
+            report_second (float, optional): seconds between reports. Defaults to 10.0.
+        """
+        self.report_second = report_second
+        self.latencies: List[float] = []
+        self.last_report = monotonic()
+
+    def record(self, sensor_timestamp: float, send_timestamp: float) -> None:
+        """
+        Record the latency of one value and report if the report interval has passed
+
+        Args:
+            sensor_timestamp (float): time the value was set at the sensor
+            send_timestamp (float): time the value was sent to the drone
+        """
+        self.latencies.append(send_timestamp - sensor_timestamp)
+        if monotonic() - self.last_report >= self.report_second:
+            self.report()
+
+    def report(self) -> None:
+        """
+        Print count, p50, p99 and max latency in milliseconds and start a new period
+        """
+        self.last_report = monotonic()
+        if not self.latencies:
+            return
+
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        p50 = latencies[int(0.50 * (count - 1))] * 1000
+        p99 = latencies[int(0.99 * (count - 1))] * 1000
+        print(f"Latency over {count} values: p50 {p50:.2f} ms, p99 {p99:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+        self.latencies.clear()
+
+
+class PlumeForwarder:
+    """
+    Maps a gas field along the position of the drone and sends the highest concentration around it
+
+    Fixes are read from the GLOBAL_POSITION_INT messages of the mavlink connection, see GasMapper.
+    Every plume_second, the hotspot of the map within radius of the drone goes out as the
+    NAMED_VALUE_FLOAT of PLUME_FIELDS, nan when no cell within the radius has readings. The map
+    is written as CSV to save_path every save_second and on close.
+    """
+
+    def __init__(self, mapper: "GasMapper", radius: float = 100.0, plume_second: float = 1.0, save_path: str = '',
+                 save_second: float = 60.0) -> None:
+        """
+        Initialize the forwarder
+
+        Args:
+            mapper (GasMapper): map of the gas field
+            radius (float, optional): meters around the drone searched for the plume. Defaults to 100.0.
+            plume_second (float, optional): seconds between two plume sends. Defaults to 1.0.
+            save_path (str, optional): CSV file of the map, empty to not save. Defaults to ''.
+            save_second (float, optional): seconds between two saves of the map. Defaults to 60.0.
+        """
+        self.mapper = mapper
+        self.radius = radius
+        self.plume_second = plume_second
+        self.save_path = save_path
+        self.save_second = save_second
+        self.senders: Dict[str, SensorMavlinkConnection] = dict()
+        self.last_plume = float('-inf')
+        self.last_save = monotonic()
+
+    def attach(self, multiplexer: MavlinkMultiplexer) -> None:
+        """
+        Read the fixes of a connection and send the plume on it
+        """
+        multiplexer.add_message_handler('GLOBAL_POSITION_INT', self.mapper.handle_position)
+        self.senders = create_sensor_connections(multiplexer, list(PLUME_FIELDS))
+
+    def update(self, updates: Dict[str, Tuple[float, float]]) -> None:
+        """
+        Take the readings of the mapped field in sensor updates
+        """
+        self.mapper.update(updates)
+
+    def send_due(self) -> None:
+        """
+        Map the readings with a position, then queue the plume and save the map when due
+        """
+        self.mapper.process()
+        now = monotonic()
+        if now - self.last_plume >= self.plume_second:
+            self.last_plume = now
+            hotspot = self.mapper.get_hotspot(self.radius)
+            plume = (hotspot.north, hotspot.east, hotspot.value) if hotspot is not None else (float('nan'),) * 3
+            for name, value in zip(PLUME_FIELDS, plume):
+                self.senders[name].send(round(value, 2))
+        if self.save_path and now - self.last_save >= self.save_second:
+            self.save()
+
+    def save(self) -> None:
+        """
+        Write the map to the CSV file, if any
+        """
+        self.last_save = monotonic()
+        if self.save_path:
+            cells = self.mapper.grid.save_csv(self.save_path)
+            print_if_debug(f"Saved {cells} map cells of {self.mapper.grid.points} readings to {self.save_path}, "
+                           f"{self.mapper.dropped} readings without position", DEBUG)
+
+
+def create_plume_forwarder(field: str, cell_size: float = 5.0, radius: float = 100.0, save_path: str = '') -> Optional[PlumeForwarder]:
+    """Create the gas map of a field and its plume forwarder
 
     Args:
-        r (redis.Redis): redis connection to db.
-        port (int): port number of mavlink broadcast.
-        fc_sysid (int): flight controller system id.
-        refresh_second (float, optional): Refresh rate in seconds. Defaults to 1.
+        field (str): mapped field name, empty to not map
+        cell_size (float, optional): side of a map cell in meters. Defaults to 5.0.
+        radius (float, optional): meters around the drone searched for the plume. Defaults to 100.0.
+        save_path (str, optional): CSV file of the map, empty to not save. Defaults to ''.
+
+    Returns:
+        Optional[PlumeForwarder]: the forwarder, None without field
     """
-    name_enums: Tuple[SensorReadingFieldNames] = SensorReadingFieldNames.get_all_field_names()
-    host = config('MAVLINK_ROUTER_HOST', default='127.0.0.1')
+    if not field:
+        return None
+    # the map needs numpy, only loaded when a field is mapped
+    from gasmap import GasGrid, GasMapper, PositionTrack
+    return PlumeForwarder(GasMapper(field, GasGrid(cell_size), PositionTrack()), radius, save_path=save_path)
+
+
+def create_sensor_connections(multiplexer: MavlinkMultiplexer, field_names: List[str]) -> Dict[str, SensorMavlinkConnection]:
+    """Create a mavlink sender for every sensor field on the shared connection
 
-    sensor_mavlink: Dict[SensorReadingFieldNames, SensorMavlinkConnection] = dict()
+    Args:
+        multiplexer (MavlinkMultiplexer): shared connection to the mavlink router
+        field_names (List[str]): field names of the sensor registry, see sensors.get_field_names
+
+    Returns:
+        Dict[str, SensorMavlinkConnection]: sender of each field
+    """
+    sensor_mavlink: Dict[str, SensorMavlinkConnection] = dict()
 
-    for n in name_enums:
-        if is_none_or_whitespace(n.value):
+    for n in field_names:
+        if is_none_or_whitespace(n):
             print("Gas field name cannot be None or whitespace")
             exit(1)
 
-        mavsender = SensorMavlinkConnection(n.value, host, port, fc_sysid)
+        mavsender = SensorMavlinkConnection(n, multiplexer)
         sensor_mavlink[n] = mavsender
+
+    return sensor_mavlink
+
+
+def create_multiplexer(port: int, fc_sysid: int, queue_size: int = 64) -> MavlinkMultiplexer:
+    """Open the shared connection to the mavlink router
+
+    Args:
+        port (int): port number of mavlink broadcast.
+        fc_sysid (int): flight controller system id.
+        queue_size (int, optional): maximum number of queued messages. Defaults to 64.
+
+    Returns:
+        MavlinkMultiplexer: the shared connection
+    """
+    host = config('MAVLINK_ROUTER_HOST', default='127.0.0.1')
+    return MavlinkMultiplexer(host, port, fc_sysid, queue_size)
+
+
+def get_message_bytes(packed: bool, sensors: Optional[List[GasSensor]] = None) -> int:
+    """Get the bytes one sensor message takes on the link
+
+    Args:
+        packed (bool): packed message instead of one named value
+        sensors (Optional[List[GasSensor]], optional): gas sensor registry of the packed message. Defaults to parse_gas_sensors().
+
+    Returns:
+        int: length of the encoded message
+    """
+    if packed:
+        sensors = parse_gas_sensors() if sensors is None else sensors
+        version = get_packed_version(sensors)
+        mav = mavlink2.MAVLink(None)
+        values = {n: 0.5 for n in get_field_names(sensors)}
+        msg = mav.debug_float_array_encode(0, PACKED_ARRAY_NAME.encode('ascii'), version, pack_fields(values, version, get_field_order(version, sensors)))
+    else:
+        mav = mavutil.mavlink.MAVLink(None)
+        msg = mav.named_value_float_encode(0, b'GAS_PPM', 0.5)
+    return len(msg.pack(mav))
+
+
+def print_stats_if_debug(multiplexer: MavlinkMultiplexer) -> None:
+    """Print and reset the send queue statistics if debug is enabled
+
+    Args:
+        multiplexer (MavlinkMultiplexer): shared connection to the mavlink router
+    """
+    if DEBUG:
+        print(f"Mavlink queue stats: {multiplexer.get_stats()}")
+        multiplexer.reset_stats()
+
+
+def read_and_send(r: "redis.Redis", port: int, fc_sysid: int, refresh_second: float = 1, queue_size: int = 64, packed: bool = False,
+                  scheduler: Optional[TransmissionScheduler] = None, overrun_policy: str = 'skip',
+                  sensors: Optional[List[GasSensor]] = None, plume: Optional[PlumeForwarder] = None) -> None:
+    """Read gas sensor data from redis and send it to the drone
+
+    Args:
+        r (redis.Redis): redis connection to db.
+        port (int): port number of mavlink broadcast.
+        fc_sysid (int): flight controller system id.
+        refresh_second (float, optional): Refresh rate in seconds. Defaults to 1.
+        queue_size (int, optional): maximum number of queued mavlink messages. Defaults to 64.
+        packed (bool, optional): send all fields in one packed message. Defaults to False.
+        scheduler (Optional[TransmissionScheduler], optional): send only the fields it selects. Defaults to sending every field.
+        overrun_policy (str, optional): skip or catch-up refreshes that overrun their deadline, see DeadlineScheduler. Defaults to 'skip'.
+        sensors (Optional[List[GasSensor]], optional): gas sensor registry. Defaults to parse_gas_sensors().
+        plume (Optional[PlumeForwarder], optional): maps the readings and sends the plume. Defaults to None.
+    """
+    sensors = parse_gas_sensors() if sensors is None else sensors
+    field_names = get_field_names(sensors)
+    multiplexer = create_multiplexer(port, fc_sysid, queue_size)
+    if plume is not None:
+        plume.attach(multiplexer)
+    if packed:
+        packed_mavlink = PackedSensorMavlinkConnection(multiplexer, sensors=sensors)
+    else:
+        sensor_mavlink = create_sensor_connections(multiplexer, field_names)
+    ticker = DeadlineScheduler(refresh_second, "Mavlink", overrun_policy, report_second=10 if DEBUG else 0)
+    read_timer = METRICS.timer("redis_read_ms", "redis round trip of the fields read each refresh")
     
     while True:
-        print_if_debug("Sending sensor data to drone", DEBUG)
-        for n in name_enums:
-            # read value from redis
-            gas_reading = r.get(n.value)
-            print_if_debug(f"Got value from redis: {gas_reading}", DEBUG)
+        log.debug("Sending sensor data to drone")
+        # read all values from redis in one round trip
+        start = read_timer.start()
+        readings = get_fields(r, field_names)
+        read_timer.stop(start)
+        values: Dict[str, float] = dict()
+        for n in field_names:
+            gas_reading = readings[n]
+            log.debug("Got value from redis: %s", gas_reading)
             # convert gas reading to float
             gas_reading = convert_to_float_or_default(gas_reading)
             # round to 2 decimal places
-            gas_reading = round(gas_reading, 2)
+            values[n] = round(gas_reading, 2)
+        if plume is not None:
+            # polled values have no sensor timestamp, they are mapped at the time they were read
+            read_time = time()
+            plume.update({n: (value, read_time) for n, value in values.items()})
+
+        names = field_names
+        if scheduler is not None:
+            names = scheduler.select(values, monotonic())
+            log.debug("Transmission policy selected %s", names)
+
+        if packed:
+            if names:
+                packed_mavlink.send(values)
+        else:
+            for n in names:
+                # send gas reading via mavsender
+                mavsender = sensor_mavlink[n]
+                mavsender.send(values[n])
+        if plume is not None:
+            plume.send_due()
+
+        # write every field of this refresh at once
+        multiplexer.flush()
+        print_stats_if_debug(multiplexer)
+
+        ticker.wait()
+
+
+class EventForwarder:
+    """
+    Sends sensor updates to the drone as they arrive
+
+    A field is sent at most once per its minimum interval, newer updates replace a value that is
+    still waiting. Fields that have not been sent for heartbeat_second are read back from their
+    source and resent, so an expired value goes out as nan like in polling mode.
+    """
+
+    def __init__(self, multiplexer: MavlinkMultiplexer, min_interval: float = 0.05, heartbeat_second: float = 1,
+                 field_intervals: Optional[Dict[str, float]] = None, measure_latency: bool = False, packed: bool = False,
+                 sensors: Optional[List[GasSensor]] = None, plume: Optional[PlumeForwarder] = None) -> None:
+        """
+        Initialize the forwarder
+
+        Args:
+            multiplexer (MavlinkMultiplexer): shared connection to the mavlink router
+            min_interval (float, optional): minimum seconds between two sends of a field. Defaults to 0.05.
+            heartbeat_second (float, optional): seconds after which an unchanged field is resent. Defaults to 1.
+            field_intervals (Optional[Dict[str, float]], optional): minimum interval overrides by field name. Defaults to None.
+            measure_latency (bool, optional): report latency from sensor to send. Defaults to False.
+            packed (bool, optional): send the latest value of all fields in one packed message whenever a field is due. Defaults to False.
+            sensors (Optional[List[GasSensor]], optional): gas sensor registry. Defaults to parse_gas_sensors().
+            plume (Optional[PlumeForwarder], optional): maps the updates and sends the plume on the connection. Defaults to None.
+        """
+        sensors = parse_gas_sensors() if sensors is None else sensors
+        self.field_names: List[str] = get_field_names(sensors)
+        self.multiplexer = multiplexer
+        self.plume = plume
+        if plume is not None:
+            plume.attach(multiplexer)
+        self.packed = packed
+        if packed:
+            self.packed_mavlink = PackedSensorMavlinkConnection(multiplexer, sensors=sensors)
+            self.packed_values = {n: float('nan') for n in self.field_names}
+        else:
+            self.sensor_mavlink = create_sensor_connections(multiplexer, self.field_names)
+
+        field_intervals = field_intervals or dict()
+        self.heartbeat_second = heartbeat_second
+        self.intervals = {n: field_intervals.get(n, min_interval) for n in self.field_names}
+        self.fields = set(self.field_names)
+        self.latency = LatencyStats() if measure_latency else None
+
+        self.latest: Dict[str, Tuple[float, float]] = dict()
+        self.pending = set()
+        # nothing has been sent yet, so the first heartbeat sends every field
+        self.last_sent = {n: float('-inf') for n in self.field_names}
+
+    def get_timeout(self) -> float:
+        """
+        Seconds until a waiting value or a heartbeat is due
+        """
+        deadline = min(self.last_sent.values()) + self.heartbeat_second
+        for n in self.pending:
+            deadline = min(deadline, self.last_sent[n] + self.intervals[n])
+        if self.plume is not None:
+            deadline = min(deadline, self.plume.last_plume + self.plume.plume_second)
+        return max(0.0, deadline - monotonic())
 
-            # send gas reading via mavsender
-            mavsender = sensor_mavlink[n]
-            mavsender.send(gas_reading)
-            print_if_debug(f"Sent {n.value} to drone: {gas_reading}", DEBUG)
+    def update(self, updates: Dict[str, Tuple[float, float]]) -> None:
+        """
+        Take the latest values of updated fields
 
-        sleep(refresh_second)
+        Args:
+            updates (Dict[str, Tuple[float, float]]): value and sensor timestamp of each updated field name
+        """
+        for key, update in updates.items():
+            if key in self.fields:
+                self.latest[key] = update
+                self.pending.add(key)
+        if self.plume is not None:
+            self.plume.update(updates)
+
+    def send(self, n: str, value: float) -> None:
+        """
+        Queue the value of a field
+        """
+        if self.packed:
+            self.packed_values[n] = round(value, 2)
+        else:
+            mavsender = self.sensor_mavlink[n]
+            mavsender.send(round(value, 2))
+        self.last_sent[n] = monotonic()
+
+    def send_due(self, read_stale: Callable[[List[str]], Dict[str, float]]) -> None:
+        """
+        Send the waiting values whose interval has passed and the heartbeat of unchanged fields
+
+        Args:
+            read_stale (Callable): reads the current value of fields due for a heartbeat, nan if expired
+        """
+        now = monotonic()
+        due = [n for n in self.pending if now - self.last_sent[n] >= self.intervals[n]]
+        for n in due:
+            self.send(n, self.latest[n][0])
+            self.pending.discard(n)
+
+        stale = [n for n in self.field_names if n not in self.pending and now - self.last_sent[n] >= self.heartbeat_second]
+        if stale:
+            log.debug("Heartbeat for %d unchanged fields", len(stale))
+            for n, value in read_stale(stale).items():
+                self.send(n, value)
+
+        if self.packed and (due or stale):
+            self.packed_mavlink.send(self.packed_values)
+        if self.plume is not None:
+            self.plume.send_due()
+        self.multiplexer.flush()
+        if self.latency is not None:
+            send_timestamp = time()
+            for n in due:
+                self.latency.record(self.latest[n][1], send_timestamp)
+
+
+def listen_and_send(r: "redis.Redis", port: int, fc_sysid: int, min_interval: float = 0.05, heartbeat_second: float = 1,
+                    field_intervals: Optional[Dict[str, float]] = None, measure_latency: bool = False, queue_size: int = 64,
+                    packed: bool = False, sensors: Optional[List[GasSensor]] = None, plume: Optional[PlumeForwarder] = None,
+                    streams: Optional[List[str]] = None) -> None:
+    """Wait for sensor updates on the redis channel and send each one to the drone as soon as it arrives
+
+    See EventForwarder, unchanged fields are read back from redis for the heartbeat. With history
+    streams, the updates are read from the streams instead, see utils.HistoryReader: every tick of
+    the services reaches the forwarder and the gas map, including the ticks published while the
+    forwarder was busy.
+
+    Args:
+        r (redis.Redis): redis connection to db.
+        port (int): port number of mavlink broadcast.
+        fc_sysid (int): flight controller system id.
+        min_interval (float, optional): minimum seconds between two sends of a field. Defaults to 0.05.
+        heartbeat_second (float, optional): seconds after which an unchanged field is resent. Defaults to 1.
+        field_intervals (Optional[Dict[str, float]], optional): minimum interval overrides by field name. Defaults to None.
+        measure_latency (bool, optional): report latency from sensor to send. Defaults to False.
+        queue_size (int, optional): maximum number of queued mavlink messages. Defaults to 64.
+        packed (bool, optional): send the latest value of all fields in one packed message whenever a field is due. Defaults to False.
+        sensors (Optional[List[GasSensor]], optional): gas sensor registry. Defaults to parse_gas_sensors().
+        plume (Optional[PlumeForwarder], optional): maps the updates and sends the plume. Defaults to None.
+        streams (Optional[List[str]], optional): history streams to read the updates from instead of the channel. Defaults to None.
+    """
+    multiplexer = create_multiplexer(port, fc_sysid, queue_size)
+    forwarder = EventForwarder(multiplexer, min_interval, heartbeat_second, field_intervals, measure_latency, packed, sensors, plume)
+
+    history = HistoryReader(r, streams) if streams else None
+    pubsub = None
+    if history is None:
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*SENSOR_UPDATES_CHANNELS)
+
+    def read_stale(stale: List[str]) -> Dict[str, float]:
+        return {n: convert_to_float_or_default(reading) for n, reading in get_fields(r, stale).items()}
+
+    while True:
+        # block until the next update, or until a waiting value or a heartbeat is due
+        timeout = forwarder.get_timeout()
+        if history is not None:
+            for record in history.read(block=timeout or None):
+                forwarder.update({n: (value, record.timestamp) for n, value in record.values.items()})
+        else:
+            message = pubsub.get_message(timeout=timeout)
+            if message is not None:
+                forwarder.update(decode_sensor_update(message['data']))
+
+        forwarder.send_due(read_stale)
+
+
+def parse_field_intervals(values: Iterable[str]) -> Dict[str, float]:
+    """Parse FIELD=SECONDS pairs into a dictionary of minimum intervals
+
+    Args:
+        values (Iterable[str]): FIELD=SECONDS pairs
+
+    Returns:
+        Dict[str, float]: minimum interval of each field name
+    """
+    intervals = dict()
+    for value in values:
+        name, _, seconds = value.partition('=')
+        intervals[name.strip()] = float(seconds)
+    return intervals
 
 
 def main():
@@ -105,19 +698,143 @@ def main():
                         type=float,
                         help='Refresh rate in seconds. Default to 0.2 or MV_REFRESH_RATE env variable',
                         default=config('MAVLINK_REFRESH_RATE', default=0.2, cast=float))
+    parser.add_argument('-m', '--mode',
+                        choices=['poll', 'event', 'stream'],
+                        help='Poll redis every refresh, send sensor updates as they arrive, or send them from the history streams of the services. '
+                             'Default to poll or MAVLINK_MODE env variable',
+                        default=config('MAVLINK_MODE', default='poll'))
+    parser.add_argument('-i', '--min-interval',
+                        type=float,
+                        help='Event and stream mode minimum seconds between sends of a field. Default to 0.05 or MAVLINK_MIN_INTERVAL env variable',
+                        default=config('MAVLINK_MIN_INTERVAL', default=0.05, cast=float))
+    parser.add_argument('-I', '--field-interval',
+                        type=str,
+                        action='append',
+                        help='Event and stream mode minimum interval of one field as FIELD=SECONDS. Can be repeated. Default to MAVLINK_FIELD_INTERVALS env variable',
+                        default=None)
+    parser.add_argument('-b', '--heartbeat',
+                        type=float,
+                        help='Event and stream mode seconds after which an unchanged field is resent. Default to 1.0 or MAVLINK_HEARTBEAT env variable',
+                        default=config('MAVLINK_HEARTBEAT', default=1.0, cast=float))
+    parser.add_argument('-l', '--latency',
+                        action='store_true',
+                        help='Event and stream mode: report latency from sensor timestamp to mavlink send')
+    parser.add_argument('-q', '--queue-size',
+                        type=int,
+                        help='Maximum number of queued mavlink messages. Default to 64 or MAVLINK_QUEUE_SIZE env variable',
+                        default=config('MAVLINK_QUEUE_SIZE', default=64, cast=int))
+    parser.add_argument('-e', '--encoding',
+                        choices=['named', 'packed'],
+                        help='Send one NAMED_VALUE_FLOAT per field or all fields in one packed DEBUG_FLOAT_ARRAY. Default to named or MAVLINK_ENCODING env variable',
+                        default=config('MAVLINK_ENCODING', default='named'))
+    parser.add_argument('-t', '--transmission',
+                        choices=['all', 'policy'],
+                        help='Poll mode: send every field each refresh or only the fields selected by the transmission policy. Default to all or MAVLINK_TRANSMISSION env variable',
+                        default=config('MAVLINK_TRANSMISSION', default='all'))
+    parser.add_argument('-F', '--field-policy',
+                        type=str,
+                        action='append',
+                        help='Transmission policy of one field as FIELD=ABSOLUTE_DEADBAND:RELATIVE_DEADBAND:MAX_SILENCE:PRIORITY. Can be repeated. Default to MAVLINK_FIELD_POLICIES env variable',
+                        default=None)
+    parser.add_argument('-s', '--max-silence',
+                        type=float,
+                        help='Transmission policy max silence in seconds of fields without a policy. Default to 1.0 or MAVLINK_MAX_SILENCE env variable',
+                        default=config('MAVLINK_MAX_SILENCE', default=1.0, cast=float))
+    parser.add_argument('-B', '--byte-budget',
+                        type=float,
+                        help='Transmission policy bytes per second for sensor messages, 0 for unlimited. Default to 0 or MAVLINK_BYTE_BUDGET env variable',
+                        default=config('MAVLINK_BYTE_BUDGET', default=0.0, cast=float))
+    parser.add_argument('-o', '--overrun-policy',
+                        choices=['skip', 'catch-up'],
+                        help='Poll mode: when a refresh overruns its deadline, skip the missed refreshes or run them back to back. Default to LOOP_OVERRUN_POLICY env variable or skip',
+                        default=config('LOOP_OVERRUN_POLICY', default='skip'))
+    parser.add_argument('-S', '--sensor',
+                        type=str,
+                        action='append',
+                        help='Gas sensor as NAME:ADDRESS:PIN[:RZERO] whose fields are sent. Can be repeated, see sensors.py. Default to GAS_SENSORS env variable',
+                        default=None)
+    parser.add_argument('-G', '--gas-model',
+                        type=str,
+                        action='append',
+                        help='Gas estimate of each gas sensor whose {NAME}_{GAS} field is sent. Can be repeated. Default to GAS_MODEL_GASES env variable',
+                        default=None)
+    parser.add_argument('--map-field',
+                        type=str,
+                        help='Map this field along the GLOBAL_POSITION_INT track of the drone and send the plume around it, e.g. GAS_PPM. '
+                             'Default to MAP_FIELD env variable or no map',
+                        default=config('MAP_FIELD', default=''))
+    parser.add_argument('--map-cell-size',
+                        type=float,
+                        help='Side of a map cell in meters. Default to MAP_CELL_SIZE env variable or 5.0',
+                        default=config('MAP_CELL_SIZE', default=5.0, cast=float))
+    parser.add_argument('--map-radius',
+                        type=float,
+                        help='Meters around the drone searched for the plume. Default to MAP_RADIUS env variable or 100.0',
+                        default=config('MAP_RADIUS', default=100.0, cast=float))
+    parser.add_argument('--map-file',
+                        type=str,
+                        help='CSV heatmap of the map cells, written every minute and on exit. Default to MAP_FILE env variable or not saved',
+                        default=config('MAP_FILE', default=''))
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='Serve the metrics as Prometheus text on this HTTP port, 0 to not serve. Default to METRICS_PORT env variable or 0',
+                        default=config('METRICS_PORT', default=0, cast=int))
+    parser.add_argument('--metrics-redis',
+                        type=float,
+                        help='Write the metrics to the METRICS_MAVLINK redis hash every this many seconds, 0 to not write. Default to METRICS_REDIS_SECOND env variable or 0',
+                        default=config('METRICS_REDIS_SECOND', default=0.0, cast=float))
     parser.add_argument('-d', '--debug',
                         action='store_true',
                         help='Enable debug mode')
     args = parser.parse_args()
+    # repeated options replace the env list rather than extend it
+    if args.sensor is None:
+        args.sensor = config('GAS_SENSORS', default='', cast=Csv())
+    if args.gas_model is None:
+        args.gas_model = config('GAS_MODEL_GASES', default='', cast=Csv())
+    if args.field_interval is None:
+        args.field_interval = config('MAVLINK_FIELD_INTERVALS', default='', cast=Csv())
+    if args.field_policy is None:
+        args.field_policy = config('MAVLINK_FIELD_POLICIES', default='', cast=Csv())
+    try:
+        sensors = parse_gas_sensors(args.sensor, args.gas_model)
+    except ValueError as e:
+        parser.error(str(e))
 
     r = connect_redis(args.password)
 
     global DEBUG
     DEBUG = args.debug
+    if DEBUG:
+        set_log_level('debug')
+    start_metrics_export('mavlink', args.metrics_port, r, args.metrics_redis)
+    plume = create_plume_forwarder(args.map_field, args.map_cell_size, args.map_radius, args.map_file)
+    try:
+        if args.mode in ('event', 'stream'):
+            print_if_debug(f"Starting mavlink {args.mode} forwarding. Heartbeat time: {args.heartbeat}", DEBUG)
+            listen_and_send(r, args.port, args.fc_sysid, args.min_interval, args.heartbeat,
+                            parse_field_intervals(args.field_interval), args.latency, args.queue_size,
+                            args.encoding == 'packed', sensors, plume,
+                            [GAS_HISTORY_STREAM, TEMP_HISTORY_STREAM] if args.mode == 'stream' else None)
+            return
+
+        scheduler = None
+        if args.transmission == 'policy':
+            default_policy = FieldPolicy(max_silence=args.max_silence)
+            scheduler = TransmissionScheduler(parse_policies(args.field_policy, default_policy),
+                                              default_policy,
+                                              args.byte_budget,
+                                              get_message_bytes(args.encoding == 'packed', sensors),
+                                              args.encoding == 'packed')
 
-    # start read and send thread
-    print_if_debug(f"Starting mavlink thread. Refresh time: {args.refresh_rate}", DEBUG)
-    read_and_send(r, args.port, args.fc_sysid, args.refresh_rate)
+        # start read and send thread
+        print_if_debug(f"Starting mavlink thread. Refresh time: {args.refresh_rate}", DEBUG)
+        read_and_send(r, args.port, args.fc_sysid, args.refresh_rate, args.queue_size, args.encoding == 'packed', scheduler,
+                      args.overrun_policy, sensors, plume)
+    finally:
+        # keep the map of the flight
+        if plume is not None:
+            plume.save()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,28 @@
+import hashlib
 import math
-from adafruit_ads1x15.analog_in import AnalogIn
+import os
+import tempfile
+import numpy as np
+from typing import TYPE_CHECKING, Dict, Iterable, NamedTuple, Optional, Tuple, Union
 from decouple import config
+from adc import PGA_RANGE
+
+if TYPE_CHECKING:
+    from adc import ADCChannel
+
+
+class MQ135Reading(NamedTuple):
+    """All values derived from one ADC read of the MQ135. Fields are floats for a single
+    reading or numpy arrays for a block of readings"""
+    value: Union[float, np.ndarray]
+    voltage: Union[float, np.ndarray]
+    percent: Union[float, np.ndarray]
+    resistance: Union[float, np.ndarray]
+    rzero: Union[float, np.ndarray]
+    corrected_rzero: Union[float, np.ndarray]
+    ppm: Union[float, np.ndarray]
+    corrected_ppm: Union[float, np.ndarray]
+
 
 # Modified from the following repository: https://github.com/rubfi/MQ135
 class MQ135(object):
@@ -8,7 +30,7 @@ class MQ135(object):
     # The load resistance on the board
     RLOAD = 1.0
     # Calibration resistance at atmospheric CO2 level
-    RZERO = config('RZERO', cast=float)
+    RZERO = config('RZERO', default='nan', cast=float)
     # Parameters for calculating ppm of CO2 from sensor resistance
     PARA = 116.6020682
     PARB = 2.769034857
@@ -23,10 +45,10 @@ class MQ135(object):
     CORG = 1.130128205
 
     # Atmospheric CO2 level for calibration purposes
-    ATMOCO2 = config('ATMOCO2', cast=float)
+    ATMOCO2 = config('ATMOCO2', default='nan', cast=float)
 
 
-    def __init__(self, adc: AnalogIn, sensor_max_value: int):
+    def __init__(self, adc: Optional["ADCChannel"], sensor_max_value: int):
         self.adc = adc
         self.sensor_max_value = float(sensor_max_value)
 
@@ -43,6 +65,13 @@ class MQ135(object):
 
         return self.CORE * temperature + self.CORF * humidity + self.CORG
 
+    def get_ppm_correction(self, temperature: float = 25, humidity: float = 35) -> float:
+        """Calculates the factor from the ppm to the corrected ppm
+
+        The correction divides the resistance, so it multiplies the ppm by its power PARB.
+        """
+        return math.pow(self.get_correction_factor(temperature, humidity), self.PARB)
+
     def get_resistance(self) -> float:
         """Returns the resistance of the sensor in kOhms // -1 if not value got in pin"""
         value = self.adc.value
@@ -72,3 +101,301 @@ class MQ135(object):
         """Returns the resistance RZero of the sensor (in kOhms) for calibration purposes
         corrected for temperature/humidity"""
         return self.get_corrected_resistance(temperature, humidity) * math.pow((self.ATMOCO2/self.PARA), (1./self.PARB))
+
+    def get_voltage(self, raw_value):
+        """Returns the voltage of a raw ADC value at the current gain of the ADC, like AnalogIn.voltage"""
+        if self.adc is None:
+            # offline instances, e.g. reprocess.py, have no ADC gain
+            return raw_value * math.nan
+        return raw_value * PGA_RANGE[self.adc._ads.gain] / 32767
+
+    def sample(self, temperature: float = 25, humidity: float = 35) -> MQ135Reading:
+        """Reads the ADC once and returns every derived value of that reading
+
+        Raises:
+            ValueError: if the reading has no valid resistance (ADC value of 0)
+        """
+        return self.compute(self.adc.value, temperature, humidity)
+
+    def compute(self, raw_value: int, temperature: float = 25, humidity: float = 35) -> MQ135Reading:
+        """Returns every derived value of a raw ADC reading without touching the ADC
+
+        Raises:
+            ValueError: if the reading has no valid resistance (ADC value of 0)
+        """
+        resistance = -1. if raw_value == 0 else (self.sensor_max_value / raw_value - 1.) * self.RLOAD
+        corrected_resistance = resistance / self.get_correction_factor(temperature, humidity)
+        rzero_factor = math.pow((self.ATMOCO2/self.PARA), (1./self.PARB))
+
+        return MQ135Reading(
+            value=raw_value,
+            voltage=self.get_voltage(raw_value),
+            percent=(raw_value / self.sensor_max_value) * 100,
+            resistance=resistance,
+            rzero=resistance * rzero_factor,
+            corrected_rzero=corrected_resistance * rzero_factor,
+            ppm=self.PARA * math.pow((resistance / self.RZERO), -self.PARB),
+            corrected_ppm=self.PARA * math.pow((corrected_resistance / self.RZERO), -self.PARB),
+        )
+
+    def compute_many(self, raw_values, temperature = 25, humidity = 35) -> MQ135Reading:
+        """Returns every derived value of a block of raw ADC readings as numpy arrays
+
+        Temperature and humidity can be scalars or arrays matching raw_values. Readings
+        without a valid resistance give nan instead of raising.
+        """
+        raw_values = np.asarray(raw_values, dtype=float)
+        temperature = np.asarray(temperature, dtype=float)
+        humidity = np.asarray(humidity, dtype=float)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resistance = np.where(raw_values == 0, -1., (self.sensor_max_value / raw_values - 1.) * self.RLOAD)
+            correction = np.where(
+                temperature < 20,
+                self.CORA * temperature * temperature - self.CORB * temperature + self.CORC - (humidity - 33.) * self.CORD,
+                self.CORE * temperature + self.CORF * humidity + self.CORG)
+            corrected_resistance = resistance / correction
+            rzero_factor = math.pow((self.ATMOCO2/self.PARA), (1./self.PARB))
+
+            return MQ135Reading(
+                value=raw_values,
+                voltage=self.get_voltage(raw_values),
+                percent=(raw_values / self.sensor_max_value) * 100,
+                resistance=resistance,
+                rzero=resistance * rzero_factor,
+                corrected_rzero=corrected_resistance * rzero_factor,
+                ppm=self.PARA * np.power(resistance / self.RZERO, -self.PARB),
+                corrected_ppm=self.PARA * np.power(corrected_resistance / self.RZERO, -self.PARB),
+            )
+
+
+class MQ135LookupTable(object):
+    """Precomputed MQ135 conversion of every raw ADC code
+
+    The temperature / humidity correction only scales the resistance, so the corrected values
+    split into a table over the 65536 raw codes (resistance, rzero and ppm) and a grid of the
+    correction over temperature and humidity bins, interpolated bilinearly. Each branch of the
+    piecewise correction has its own grid so interpolation never crosses the 20 degrees break.
+    A lookup is then an index and a multiply instead of a pow per reading.
+
+    Tables are cached on disk, keyed by every constant they are built from.
+    """
+    # raw codes of the signed 16-bit ADS1115 result
+    RAW_MIN = -32768
+    RAW_MAX = 32767
+    # correction grid, in degrees Celsius and % relative humidity
+    TEMPERATURE_BINS = np.arange(-40., 85.5, 0.5)
+    HUMIDITY_BINS = np.arange(0., 101., 1.)
+    # bump when the table layout changes
+    VERSION = 1
+
+    def __init__(self, mq135: MQ135, cache_dir: Optional[str] = None):
+        """Load the tables of a sensor from the disk cache, or build and cache them
+
+        Args:
+            mq135 (MQ135): sensor the tables are built for
+            cache_dir (Optional[str], optional): cache directory. Defaults to MQ135_LUT_DIR env variable or a mq135_lut temp directory.
+        """
+        self.mq135 = mq135
+        self.cache_dir = cache_dir or config('MQ135_LUT_DIR', default=os.path.join(tempfile.gettempdir(), 'mq135_lut'))
+        self.path = os.path.join(self.cache_dir, f"mq135_{self.get_key()}.npz")
+        self.loaded = self.load()
+        if not self.loaded:
+            self.build()
+            self.save()
+
+    def get_key(self) -> str:
+        """Hash of every constant the tables depend on"""
+        m = self.mq135
+        constants = (self.VERSION, m.sensor_max_value, m.RLOAD, m.RZERO, m.ATMOCO2, m.PARA, m.PARB,
+                     m.CORA, m.CORB, m.CORC, m.CORD, m.CORE, m.CORF, m.CORG,
+                     self.TEMPERATURE_BINS.tolist(), self.HUMIDITY_BINS.tolist())
+        return hashlib.sha1(repr(constants).encode()).hexdigest()[:16]
+
+    def build(self) -> None:
+        """Compute the tables with the closed form conversion"""
+        m = self.mq135
+        codes = np.arange(self.RAW_MIN, self.RAW_MAX + 1)
+        with np.errstate(invalid='ignore'):
+            reading = m.compute_many(codes)
+        self.resistance = reading.resistance
+        self.rzero = reading.rzero
+        self.ppm = reading.ppm
+
+        t, h = np.meshgrid(self.TEMPERATURE_BINS, self.HUMIDITY_BINS, indexing='ij')
+        low = m.CORA * t * t - m.CORB * t + m.CORC - (h - 33.) * m.CORD
+        high = m.CORE * t + m.CORF * h + m.CORG
+        # correction of each branch of get_correction_factor, and its power applied to the ppm
+        self.correction = np.stack((low, high))
+        with np.errstate(invalid='ignore'):
+            self.ppm_correction = np.power(self.correction, m.PARB)
+
+    def load(self) -> bool:
+        """Load the tables from the cache
+
+        Returns:
+            bool: True if the tables were found
+        """
+        try:
+            with np.load(self.path) as data:
+                self.resistance = data['resistance']
+                self.rzero = data['rzero']
+                self.ppm = data['ppm']
+                self.correction = data['correction']
+                self.ppm_correction = data['ppm_correction']
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+
+    def save(self) -> None:
+        """Write the tables to the cache. A cache that cannot be written is skipped"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write then rename so a concurrent reader never sees a partial file
+            tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp, resistance=self.resistance, rzero=self.rzero, ppm=self.ppm,
+                     correction=self.correction, ppm_correction=self.ppm_correction)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def get_corrections(self, temperature, humidity):
+        """Interpolate the correction factor and its ppm power at temperatures and humidities
+
+        Values outside the grid are clamped to its edges.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: correction factor and correction factor to the power PARB
+        """
+        temperature = np.asarray(temperature, dtype=float)
+        humidity = np.asarray(humidity, dtype=float)
+        branch = (temperature >= 20).astype(np.intp)
+
+        t = np.clip((temperature - self.TEMPERATURE_BINS[0]) / (self.TEMPERATURE_BINS[1] - self.TEMPERATURE_BINS[0]), 0, len(self.TEMPERATURE_BINS) - 1)
+        h = np.clip((humidity - self.HUMIDITY_BINS[0]) / (self.HUMIDITY_BINS[1] - self.HUMIDITY_BINS[0]), 0, len(self.HUMIDITY_BINS) - 1)
+        t0 = np.minimum(t.astype(np.intp), len(self.TEMPERATURE_BINS) - 2)
+        h0 = np.minimum(h.astype(np.intp), len(self.HUMIDITY_BINS) - 2)
+        dt = t - t0
+        dh = h - h0
+        # flat index of the lower corner of each cell, in both grids
+        _, nt, nh = self.correction.shape
+        corner = (branch * nt + t0) * nh + h0
+
+        def interpolate(grid):
+            flat = grid.ravel()
+            return ((flat.take(corner) * (1 - dh) + flat.take(corner + 1) * dh) * (1 - dt)
+                    + (flat.take(corner + nh) * (1 - dh) + flat.take(corner + nh + 1) * dh) * dt)
+
+        return interpolate(self.correction), interpolate(self.ppm_correction)
+
+    def compute_many(self, raw_values, temperature = 25, humidity = 35) -> MQ135Reading:
+        """Returns every derived value of a block of raw ADC readings, like MQ135.compute_many
+
+        Raw values must be integer ADC codes. Temperature and humidity can be scalars or arrays matching raw_values.
+        """
+        raw_values = np.asarray(raw_values)
+        index = raw_values.astype(np.intp) - self.RAW_MIN
+        correction, ppm_correction = self.get_corrections(temperature, humidity)
+
+        resistance = self.resistance[index]
+        rzero = self.rzero[index]
+        ppm = self.ppm[index]
+        return MQ135Reading(
+            value=raw_values,
+            voltage=self.mq135.get_voltage(raw_values),
+            percent=(raw_values / self.mq135.sensor_max_value) * 100,
+            resistance=resistance,
+            rzero=rzero,
+            corrected_rzero=rzero / correction,
+            ppm=ppm,
+            corrected_ppm=ppm * ppm_correction,
+        )
+
+    def compute(self, raw_value: int, temperature: float = 25, humidity: float = 35) -> MQ135Reading:
+        """Returns every derived value of a raw ADC reading, like MQ135.compute
+
+        Raises:
+            ValueError: if the reading has no valid resistance (ADC value of 0)
+        """
+        reading = self.compute_many(raw_value, temperature, humidity)
+        if not reading.resistance > 0:
+            raise ValueError("math domain error")
+        return MQ135Reading(*(np.asarray(v).item() for v in reading))
+
+
+class MQ135GasModel(object):
+    """Estimates of several gases from the corrected resistance of the MQ135
+
+    Every gas the MQ135 senses follows a power law of the same resistance ratio, ppm = a * (Rs / R0) ^ b,
+    so a block of ratios converts to every gas at once: the log of each ratio times the exponents of
+    all curves plus the logs of their coefficients, then one exp. The result has one row per sample
+    and one column per gas, so a gas adds a column to that pass, not another ADC read and conversion.
+    """
+    # coefficient a, exponent b and clean air Rs / R0 of each curve. CO2 is the curve of MQ135, on the
+    # calibrated RZERO. The others are the MQSensorsLib regressions of the datasheet curves, whose R0
+    # is the clean air resistance divided by 3.6, rescaled to RZERO by the clean air ratio
+    CURVES: Dict[str, Tuple[float, float, Optional[float]]] = {
+        'CO2': (MQ135.PARA, -MQ135.PARB, None),
+        'CO': (605.18, -3.937, 3.6),
+        'ALCOHOL': (77.255, -3.18, 3.6),
+        'TOLUENE': (44.947, -3.445, 3.6),
+        'NH4': (102.2, -2.473, 3.6),
+        'ACETONE': (34.668, -3.369, 3.6),
+    }
+
+    def __init__(self, mq135: MQ135, gases: Optional[Iterable[str]] = None):
+        """Initialize the curves of the gases
+
+        Args:
+            mq135 (MQ135): sensor the ratios are measured on, giving the CO2 curve and calibration
+            gases (Optional[Iterable[str]], optional): names of the gases in CURVES, in the order of the columns. Defaults to every gas.
+
+        Raises:
+            ValueError: if a gas has no curve
+        """
+        self.mq135 = mq135
+        self.gases = list(self.CURVES) if gases is None else [gas.upper() for gas in gases]
+        unknown = [gas for gas in self.gases if gas not in self.CURVES]
+        if unknown:
+            raise ValueError(f"Unknown gas {', '.join(unknown)}, expected one of {', '.join(self.CURVES)}")
+
+        # Rs / RZERO in clean air, the calibration of RZERO
+        clean_air_ratio = math.pow(mq135.PARA / mq135.ATMOCO2, 1. / mq135.PARB)
+        log_coefficients = []
+        exponents = []
+        for gas in self.gases:
+            coefficient, exponent, ratio = self.CURVES[gas]
+            if ratio is not None:
+                # Rs / R0 of the curve is ratio / clean_air_ratio times Rs / RZERO
+                coefficient *= math.pow(ratio / clean_air_ratio, exponent)
+            log_coefficients.append(math.log(coefficient))
+            exponents.append(exponent)
+        self.log_coefficients = np.array(log_coefficients)
+        self.exponents = np.array(exponents)
+
+    def compute_many(self, ratios) -> np.ndarray:
+        """Returns the ppm of every gas at a block of corrected resistance ratios Rs / RZERO
+
+        Args:
+            ratios: a ratio or an array of ratios, see get_ratios
+
+        Returns:
+            np.ndarray: ppm with one more axis than ratios, one column per gas. nan where the ratio is not positive
+        """
+        ratios = np.asarray(ratios, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_ratios = np.log(np.where(ratios > 0, ratios, np.nan))
+        return np.exp(log_ratios[..., None] * self.exponents + self.log_coefficients)
+
+    def get_ratios(self, reading: MQ135Reading):
+        """Returns the corrected resistance ratios Rs / RZERO of a reading or a block of readings"""
+        rzero_factor = math.pow((self.mq135.ATMOCO2/self.mq135.PARA), (1./self.mq135.PARB))
+        return reading.corrected_rzero / (rzero_factor * self.mq135.RZERO)
+
+    def get_ppm_ratios(self, ppm):
+        """Returns the corrected resistance ratios of CO2 ppm, inverting the MQ135 curve
+
+        Every gas is a monotonic function of the ratio, so the gases of a filtered ppm are
+        filtered like it without a filter per gas.
+        """
+        return np.power(np.asarray(ppm, dtype=float) / self.mq135.PARA, -1. / self.mq135.PARB)
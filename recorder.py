@@ -0,0 +1,283 @@
+import argparse
+import csv
+import mmap
+import os
+import struct
+import sys
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+
+RECORDER_MAGIC = b'GASREC01'
+RECORDER_VERSION = 1
+
+# fixed schema of a recording: column name and numpy dtype, little endian
+RECORDER_COLUMNS: List[Tuple[str, str]] = [
+    ('timestamp', '<f8'),
+    ('value', '<i2'),
+    ('voltage', '<f4'),
+    ('temperature', '<f4'),
+    ('humidity', '<f4'),
+    ('rzero', '<f4'),
+    ('corrected_rzero', '<f4'),
+    ('ppm', '<f4'),
+    ('corrected_ppm', '<f4'),
+]
+
+# magic, version, column count, capacity, segment rows, committed rows, monotonic to unix time offset
+_HEADER = struct.Struct('<8sIIQQQd')
+_COLUMN = struct.Struct('<16s8s')
+_COMMITTED_OFFSET = 8 + 4 + 4 + 8 + 8
+PAGE_SIZE = mmap.PAGESIZE
+
+
+def _layout(columns: List[Tuple[str, str]], capacity: int) -> Tuple[Dict[str, int], int]:
+    """Get the offset of each column and the file size
+
+    The header takes the first page. Each column is one contiguous array of capacity values,
+    starting on a page boundary.
+
+    Returns:
+        Tuple[Dict[str, int], int]: byte offset of each column and the file size
+    """
+    offsets = dict()
+    offset = PAGE_SIZE
+    for name, dtype in columns:
+        offsets[name] = offset
+        size = capacity * np.dtype(dtype).itemsize
+        offset += -(-size // PAGE_SIZE) * PAGE_SIZE
+    return offsets, offset
+
+
+class FlightRecorder:
+    """Appends sensor samples to a columnar memory-mapped recording
+
+    The file is created at its full size for capacity rows, sparse until written. Every column
+    is one contiguous array, so a reader maps it without copying, see FlightRecording. Rows are
+    written into the mapping and committed by segments of segment_rows: disk space of a segment
+    is allocated when the recorder enters it, and when it is full its data is synced before the
+    committed row count in the header. After a power loss, rows past the committed count are
+    ignored, so at most the segment being written is lost.
+    """
+
+    def __init__(self, path: str, capacity: int = 10_000_000, segment_rows: int = 4096):
+        """Create the recording
+
+        Args:
+            path (str): recording file, created or overwritten
+            capacity (int, optional): maximum number of rows. Defaults to 10_000_000.
+            segment_rows (int, optional): rows per allocated and committed segment. Defaults to 4096.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.segment_rows = segment_rows
+        self.offsets, size = _layout(RECORDER_COLUMNS, capacity)
+        # timestamps are recorded as unix time from time.monotonic() readings
+        self.time_offset = time.time() - time.monotonic()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        header = _HEADER.pack(RECORDER_MAGIC, RECORDER_VERSION, len(RECORDER_COLUMNS), capacity, segment_rows, 0, self.time_offset)
+        header += b''.join(_COLUMN.pack(name.encode(), dtype.encode()) for name, dtype in RECORDER_COLUMNS)
+        self.mm[:len(header)] = header
+        self.mm.flush(0, PAGE_SIZE)
+
+        self.columns = {name: np.frombuffer(self.mm, dtype, capacity, self.offsets[name]) for name, dtype in RECORDER_COLUMNS}
+        self.count = 0
+        self.committed = 0
+        self.dropped = 0
+        self.allocate(0)
+
+    def allocate(self, segment: int) -> None:
+        """Allocate the disk space of a segment in every column, so writes do not fail or fragment"""
+        start = segment * self.segment_rows
+        rows = min(self.segment_rows, self.capacity - start)
+        if rows <= 0 or not hasattr(os, 'posix_fallocate'):
+            return
+        for name, dtype in RECORDER_COLUMNS:
+            itemsize = np.dtype(dtype).itemsize
+            os.posix_fallocate(self.fd, self.offsets[name] + start * itemsize, rows * itemsize)
+
+    def commit(self) -> None:
+        """Sync the rows written since the last commit, then the committed row count"""
+        if self.count == self.committed:
+            return
+        for name, dtype in RECORDER_COLUMNS:
+            itemsize = np.dtype(dtype).itemsize
+            # msync ranges start on a page boundary
+            start = self.offsets[name] + self.committed * itemsize
+            aligned = start - start % PAGE_SIZE
+            self.mm.flush(aligned, self.offsets[name] + self.count * itemsize - aligned)
+        struct.pack_into('<Q', self.mm, _COMMITTED_OFFSET, self.count)
+        self.mm.flush(0, PAGE_SIZE)
+        self.committed = self.count
+
+    def append(self, timestamp: float, value: int, voltage: float, temperature: float, humidity: float,
+               rzero: float, corrected_rzero: float, ppm: float, corrected_ppm: float) -> None:
+        """Record one sample
+
+        Args:
+            timestamp (float): time.monotonic() of the sample
+            value (int): raw ADC code
+            voltage (float): voltage of the code
+            temperature (float): temperature of the correction
+            humidity (float): humidity of the correction
+            rzero (float): MQ135 rzero
+            corrected_rzero (float): MQ135 corrected rzero
+            ppm (float): MQ135 ppm
+            corrected_ppm (float): MQ135 corrected ppm
+        """
+        self.append_many(np.array([timestamp]), np.array([value]), voltage, temperature, humidity,
+                         rzero, corrected_rzero, ppm, corrected_ppm)
+
+    def append_many(self, timestamps: np.ndarray, values, voltages, temperature, humidity,
+                    rzero, corrected_rzero, ppm, corrected_ppm) -> None:
+        """Record a block of samples. Arguments are arrays of the length of timestamps or scalars
+
+        Rows past the capacity are dropped and counted in dropped.
+        """
+        n = min(len(timestamps), self.capacity - self.count)
+        self.dropped += len(timestamps) - n
+        row = 0
+        while row < n:
+            # fill up to the end of the current segment, then commit it
+            start = self.count
+            end = min(start + n - row, (start // self.segment_rows + 1) * self.segment_rows)
+            size = end - start
+            block = slice(row, row + size)
+            columns = self.columns
+            columns['timestamp'][start:end] = np.asarray(timestamps)[block] + self.time_offset
+            for name, data in (('value', values), ('voltage', voltages), ('temperature', temperature), ('humidity', humidity),
+                               ('rzero', rzero), ('corrected_rzero', corrected_rzero), ('ppm', ppm), ('corrected_ppm', corrected_ppm)):
+                columns[name][start:end] = data[block] if np.ndim(data) else data
+            self.count = end
+            row += size
+            if end % self.segment_rows == 0:
+                self.commit()
+                self.allocate(end // self.segment_rows)
+
+    def close(self) -> None:
+        """Commit the last rows and close the file"""
+        if self.mm.closed:
+            return
+        self.commit()
+        # drop the views before unmapping
+        self.columns = dict()
+        self.mm.close()
+        os.close(self.fd)
+
+
+def create_flight_recorder(directory: str, capacity: int = 10_000_000, segment_rows: int = 4096) -> FlightRecorder:
+    """Create a recording named after the current time in a directory
+
+    Args:
+        directory (str): directory of the recordings, created if missing
+        capacity (int, optional): maximum number of rows. Defaults to 10_000_000.
+        segment_rows (int, optional): rows per allocated and committed segment. Defaults to 4096.
+
+    Returns:
+        FlightRecorder: the recorder
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, time.strftime('flight-%Y%m%d-%H%M%S.rec'))
+    return FlightRecorder(path, capacity, segment_rows)
+
+
+class FlightRecording:
+    """Read only view of a recording, each column a numpy array mapped without copy
+
+    Only committed rows are visible. A recording still being written can be reopened or
+    refreshed to see the rows committed since.
+    """
+
+    def __init__(self, path: str):
+        """Open a recording
+
+        Args:
+            path (str): recording file
+
+        Raises:
+            ValueError: if the file is not a recording
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_columns, self.capacity, self.segment_rows, _, self.time_offset = _HEADER.unpack_from(self.mm, 0)
+        if magic != RECORDER_MAGIC:
+            raise ValueError(f"{path} is not a flight recording")
+        if version != RECORDER_VERSION:
+            raise ValueError(f"Unsupported flight recording version {version}")
+
+        self.schema: List[Tuple[str, str]] = []
+        for i in range(n_columns):
+            name, dtype = _COLUMN.unpack_from(self.mm, _HEADER.size + i * _COLUMN.size)
+            self.schema.append((name.rstrip(b'\0').decode(), dtype.rstrip(b'\0').decode()))
+        self.offsets, _ = _layout(self.schema, self.capacity)
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Read the committed row count again"""
+        self.count, = struct.unpack_from('<Q', self.mm, _COMMITTED_OFFSET)
+
+    @property
+    def names(self) -> List[str]:
+        """Column names"""
+        return [name for name, _ in self.schema]
+
+    def column(self, name: str) -> np.ndarray:
+        """Get the committed values of a column
+
+        Args:
+            name (str): column name
+
+        Returns:
+            np.ndarray: read only array backed by the file
+        """
+        dtype = dict(self.schema)[name]
+        return np.frombuffer(self.mm, dtype, self.count, self.offsets[name])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.column(name)
+
+    def __len__(self) -> int:
+        return self.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a flight recording or export it to CSV')
+    parser.add_argument('recording',
+                        type=str,
+                        help='Flight recording file')
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help='Export every row to this CSV file, - for stdout',
+                        default=None)
+    args = parser.parse_args()
+
+    recording = FlightRecording(args.recording)
+    columns = [recording[name] for name in recording.names]
+    if args.output:
+        output = open(args.output, 'w', newline='') if args.output != '-' else sys.stdout
+        writer = csv.writer(output)
+        writer.writerow(recording.names)
+        for start in range(0, len(recording), 65536):
+            writer.writerows(zip(*(column[start:start + 65536].tolist() for column in columns)))
+        if output is not sys.stdout:
+            output.close()
+
+    timestamps = recording['timestamp']
+    duration = float(timestamps[-1] - timestamps[0]) if len(recording) else 0.0
+    print(f"{len(recording)} rows over {duration:.1f} s, capacity {recording.capacity} in segments of {recording.segment_rows}",
+          file=sys.stderr)
+    for name, column in zip(recording.names, columns):
+        if name != 'timestamp' and len(column):
+            print(f"  {name:>16} min {np.nanmin(column):.6g} mean {np.nanmean(column):.6g} max {np.nanmax(column):.6g}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,276 @@
+import argparse
+import csv
+import itertools
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import numpy as np
+from decouple import config
+from mq135 import MQ135
+from recorder import RECORDER_MAGIC, FlightRecording
+from utils import SensorReadingFieldNames
+from buffers import filter_series
+
+# MQ135 constants that can be set or swept. RZERO has its own option
+MQ135_PARAMETERS = ('RLOAD', 'PARA', 'PARB', 'CORA', 'CORB', 'CORC', 'CORD', 'CORE', 'CORF', 'CORG', 'ATMOCO2')
+
+# NAMED_VALUE_FLOAT names are truncated to 10 characters
+NVAL_VALUE = SensorReadingFieldNames.GAS_SENSOR_VALUE.value[:10]
+NVAL_TEMPERATURE = SensorReadingFieldNames.TEMPERATURE.value[:10]
+NVAL_HUMIDITY = SensorReadingFieldNames.HUMIDITY.value[:10]
+
+
+class Series(NamedTuple):
+    """Raw gas readings with the temperature and humidity of each reading"""
+    timestamps: np.ndarray
+    values: np.ndarray
+    temperature: np.ndarray
+    humidity: np.ndarray
+
+
+class ReprocessJob(NamedTuple):
+    """One file converted with one set of MQ135 constants, for every RZERO candidate"""
+    path: str
+    parameters: Dict[str, float]
+    rzeros: Tuple[float, ...]
+    sensor_max_value: int
+    buffer_size: int
+    correction_factor: float
+    output_dir: Optional[str]
+
+
+def load_recording(path: str) -> Series:
+    """Load a flight recording of recorder.py"""
+    recording = FlightRecording(path)
+    return Series(recording['timestamp'], recording['value'], recording['temperature'], recording['humidity'])
+
+
+def _latest(times: np.ndarray, values: np.ndarray, at: np.ndarray, default: float) -> np.ndarray:
+    """Get the latest value at or before each time, default before the first"""
+    if len(times) == 0:
+        return np.full(len(at), default)
+    order = np.argsort(times, kind='stable')
+    index = np.searchsorted(times[order], at, side='right') - 1
+    return np.where(index >= 0, values[order][np.maximum(index, 0)], default)
+
+
+def load_nval(path: str) -> Series:
+    """Load NAMED_VALUE_FLOAT telemetry exported to CSV
+
+    Either one row per message with timestamp, name and value columns, e.g. from
+    mavlogdump.py --format csv --types NAMED_VALUE_FLOAT, or one column per name with a
+    timestamp column. The gas readings are the GAS_VALUE series; temperature and humidity are
+    the latest before each reading, 25 and 35 before the first, like the gas loop.
+    """
+    series: Dict[str, Tuple[List[float], List[float]]] = {name: ([], []) for name in (NVAL_VALUE, NVAL_TEMPERATURE, NVAL_HUMIDITY)}
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        long_format = 'name' in reader.fieldnames and 'value' in reader.fieldnames
+        for row in reader:
+            if long_format:
+                items = [(row['name'].strip(), row['value'])]
+            else:
+                items = [(name, row.get(name)) for name in series]
+            for name, value in items:
+                if name in series and value not in (None, ''):
+                    series[name][0].append(float(row['timestamp']))
+                    series[name][1].append(float(value))
+
+    timestamps, values = (np.array(column) for column in series[NVAL_VALUE])
+    temperature = _latest(*(np.array(column) for column in series[NVAL_TEMPERATURE]), timestamps, 25.0)
+    humidity = _latest(*(np.array(column) for column in series[NVAL_HUMIDITY]), timestamps, 35.0)
+    return Series(timestamps, values, temperature, humidity)
+
+
+def load_series(path: str) -> Series:
+    """Load a flight recording or a NAMED_VALUE_FLOAT CSV export"""
+    with open(path, 'rb') as f:
+        magic = f.read(len(RECORDER_MAGIC))
+    return load_recording(path) if magic == RECORDER_MAGIC else load_nval(path)
+
+
+def reprocess(job: ReprocessJob) -> List[Dict[str, float]]:
+    """Convert and filter the readings of a file with new MQ135 constants
+
+    The ppm is proportional to RZERO ** PARB and the buffer filter is scale equivariant, so the
+    readings are converted and filtered once at RZERO = 1 and scaled for each candidate.
+
+    Returns:
+        List[Dict[str, float]]: summary of each RZERO candidate
+    """
+    series = load_series(job.path)
+    mq135 = MQ135(None, job.sensor_max_value)
+    for name, value in job.parameters.items():
+        setattr(mq135, name, value)
+    mq135.RZERO = 1.0
+    reading = mq135.compute_many(series.values, series.temperature, series.humidity)
+    ppm = reading.corrected_ppm
+    filtered = filter_series(ppm, job.buffer_size, job.correction_factor)
+
+    # statistics at RZERO = 1, scaled like the ppm
+    stats = dict()
+    if len(ppm) and not np.isnan(filtered).all():
+        p50, p95 = np.nanpercentile(filtered, [50, 95])
+        stats = {'mean_ppm': float(np.nanmean(filtered)), 'p50_ppm': float(p50), 'p95_ppm': float(p95), 'max_ppm': float(np.nanmax(filtered))}
+    # rzero does not depend on RZERO, only on ATMOCO2
+    mean_rzero = float(np.nanmean(reading.corrected_rzero)) if len(ppm) and not math.isnan(mq135.ATMOCO2) else math.nan
+
+    summaries = []
+    duration = float(series.timestamps[-1] - series.timestamps[0]) if len(series.timestamps) else 0.0
+    for rzero in job.rzeros:
+        scale = rzero ** mq135.PARB
+        summary = {'file': job.path, 'rzero': rzero, **job.parameters, 'samples': len(ppm), 'duration_s': duration}
+        summary.update({name: value * scale for name, value in stats.items()})
+        if not math.isnan(mean_rzero):
+            summary['mean_corrected_rzero'] = mean_rzero
+        summaries.append(summary)
+
+        if job.output_dir:
+            write_series(job, rzero, series, ppm * scale, filtered * scale)
+    return summaries
+
+
+def write_series(job: ReprocessJob, rzero: float, series: Series, ppm: np.ndarray, filtered: np.ndarray) -> None:
+    """Write the reprocessed readings of one RZERO candidate to a CSV in the output directory"""
+    stem = os.path.splitext(os.path.basename(job.path))[0]
+    suffix = ''.join(f"-{name}={value:g}" for name, value in job.parameters.items())
+    path = os.path.join(job.output_dir, f"{stem}-RZERO={rzero:g}{suffix}.csv")
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['timestamp', 'value', 'temperature', 'humidity', 'corrected_ppm', 'filtered_ppm'])
+        for start in range(0, len(ppm), 65536):
+            block = slice(start, start + 65536)
+            writer.writerows(zip(series.timestamps[block].tolist(), series.values[block].tolist(), series.temperature[block].tolist(),
+                                 series.humidity[block].tolist(), ppm[block].tolist(), filtered[block].tolist()))
+
+
+def parse_parameter_grid(values: Iterable[str]) -> List[Dict[str, float]]:
+    """Parse NAME=V1,V2 sweeps of MQ135 constants into every combination
+
+    Args:
+        values (Iterable[str]): NAME=V1,V2 items
+
+    Raises:
+        ValueError: if a name is not an MQ135 constant
+
+    Returns:
+        List[Dict[str, float]]: the constants of each combination
+    """
+    grid: Dict[str, List[float]] = dict()
+    for value in values:
+        name, _, candidates = value.partition('=')
+        name = name.strip().upper()
+        if name not in MQ135_PARAMETERS:
+            raise ValueError(f"Unknown MQ135 constant {name}, expected one of {MQ135_PARAMETERS}")
+        grid[name] = [float(candidate) for candidate in candidates.split(',')]
+    return [dict(zip(grid, combination)) for combination in itertools.product(*grid.values())]
+
+
+def find_files(paths: Iterable[str]) -> List[str]:
+    """Expand directories into their recordings and CSV files"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(('.rec', '.csv'))))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recompute the gas ppm of recorded flights with new calibration values, in parallel')
+    parser.add_argument('paths',
+                        type=str,
+                        nargs='+',
+                        help='Flight recordings, NAMED_VALUE_FLOAT CSV exports or directories of them')
+    parser.add_argument('-z', '--rzero',
+                        type=float,
+                        nargs='+',
+                        help='RZERO candidates. Default to the RZERO env variable',
+                        default=[])
+    parser.add_argument('-Z', '--rzero-range',
+                        type=float,
+                        nargs=3,
+                        metavar=('START', 'STOP', 'COUNT'),
+                        help='Add COUNT evenly spaced RZERO candidates from START to STOP',
+                        default=None)
+    parser.add_argument('-S', '--set',
+                        type=str,
+                        action='append',
+                        help=f"MQ135 constant as NAME=VALUE, or NAME=V1,V2 to sweep. Can be repeated. Names: {', '.join(MQ135_PARAMETERS)}",
+                        default=[])
+    parser.add_argument('-s', '--sensor-max-value',
+                        type=int,
+                        help='Sensor max value. Default to SENSOR_ANALOG_VALUE_MAX env variable or 1023',
+                        default=config('SENSOR_ANALOG_VALUE_MAX', default=1023, cast=int))
+    parser.add_argument('-b', '--buffer-size',
+                        type=int,
+                        help='Buffer size for the mean value. Default to GAS_BUFFER_SIZE env variable or 10',
+                        default=config('GAS_BUFFER_SIZE', default=10, cast=int))
+    parser.add_argument('-c', '--correction-factor',
+                        type=float,
+                        help='Correction factor for the mean value. Default to GAS_CORRECTION_FACTOR env variable or 6.0',
+                        default=config('GAS_CORRECTION_FACTOR', default=6.0, cast=float))
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        help='Worker processes. Default to the number of CPUs',
+                        default=os.cpu_count())
+    parser.add_argument('-o', '--output',
+                        type=str,
+                        help='Summary CSV file. Default to stdout',
+                        default=None)
+    parser.add_argument('-O', '--output-dir',
+                        type=str,
+                        help='Also write every reprocessed reading to one CSV per file and parameters in this directory',
+                        default=None)
+    args = parser.parse_args()
+
+    rzeros = list(args.rzero)
+    if args.rzero_range:
+        start, stop, count = args.rzero_range
+        rzeros.extend(np.linspace(start, stop, int(count)).tolist())
+    if not rzeros:
+        if math.isnan(MQ135.RZERO):
+            parser.error("Give RZERO candidates with --rzero or --rzero-range, or set the RZERO env variable")
+        rzeros = [MQ135.RZERO]
+    try:
+        grid = parse_parameter_grid(args.set)
+    except ValueError as e:
+        parser.error(str(e))
+    files = find_files(args.paths)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = [ReprocessJob(path, parameters, tuple(rzeros), args.sensor_max_value, args.buffer_size, args.correction_factor, args.output_dir)
+            for path in files for parameters in grid]
+    start = time.perf_counter()
+    if args.jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(reprocess, jobs))
+    else:
+        results = [reprocess(job) for job in jobs]
+    elapsed = time.perf_counter() - start
+
+    summaries = [summary for result in results for summary in result]
+    field_names = ['file', 'rzero', *sorted({name for parameters in grid for name in parameters}), 'samples', 'duration_s',
+                   'mean_ppm', 'p50_ppm', 'p95_ppm', 'max_ppm', 'mean_corrected_rzero']
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(output, fieldnames=field_names, restval='')
+    writer.writeheader()
+    writer.writerows(summaries)
+    if output is not sys.stdout:
+        output.close()
+
+    samples = sum(summary['samples'] for summary in summaries[::len(rzeros)])
+    print(f"Reprocessed {len(files)} files, {samples} readings with {len(grid)} parameter sets x {len(rzeros)} RZERO "
+          f"in {elapsed:.2f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,511 @@
+import argparse
+import asyncio
+import math
+import time
+from decouple import config, Csv
+from typing import Dict, List, Optional, Tuple, Union
+import gas_sensors
+import mavlink
+import temp_sensors
+from gas_sensors import GasArrayReader, GasReader, create_gas_reader
+from scheduler import DeadlineScheduler
+from adaptive import AdaptiveRate
+from instrumentation import set_log_level, start_metrics_export
+from mavlink import EventForwarder, create_multiplexer, create_plume_forwarder, parse_field_intervals
+from temp_sensors import TemperatureReader, create_temperature_reader
+from sensors import parse_gas_sensors
+from utils import connect_redis, print_if_debug, SensorReadingFieldNames, RedisPublisher, GAS_UPDATES_CHANNEL, TEMP_UPDATES_CHANNEL
+
+DEBUG = False
+# fields of the temperature loop, announced on its own updates channel by the redis mirror
+TEMP_FIELDS = frozenset((SensorReadingFieldNames.TEMPERATURE.value, SensorReadingFieldNames.HUMIDITY.value))
+
+
+class SensorHub:
+    """In process store of the latest sensor values, shared by the tasks of the runtime
+
+    Values keep their expire time like redis keys, an expired value reads as missing. Every
+    subscriber gets the updates of each tick on its own bounded queue, as the same dictionary
+    of (value, timestamp) a RedisPublisher announces, without serialization. When a queue is
+    full its oldest update is dropped, the latest values stay readable with get.
+    """
+
+    def __init__(self) -> None:
+        """Initialize an empty hub"""
+        self.latest: Dict[str, Tuple[float, float]] = dict()
+        self.expire_time: Dict[str, Optional[int]] = dict()
+        self.queues: List[asyncio.Queue] = []
+        self.dropped = 0
+
+    def subscribe(self, maxsize: int = 64) -> asyncio.Queue:
+        """Get a queue receiving every update from now on
+
+        Args:
+            maxsize (int, optional): maximum number of waiting updates. Defaults to 64.
+
+        Returns:
+            asyncio.Queue: queue of Dict[str, Tuple[float, float]] updates
+        """
+        queue = asyncio.Queue(maxsize)
+        self.queues.append(queue)
+        return queue
+
+    def publish(self, updates: Dict[str, Tuple[float, Optional[int], float]]) -> None:
+        """Store the values of a tick and pass them to every subscriber
+
+        Args:
+            updates (Dict[str, Tuple[float, Optional[int], float]]): value, expire time and timestamp of each key
+        """
+        update = dict()
+        for key, (value, ex, timestamp) in updates.items():
+            update[key] = (value, timestamp)
+            self.expire_time[key] = ex
+        self.latest.update(update)
+
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(update)
+
+    def get(self, key: str, default: float = math.nan) -> float:
+        """Get the latest value of a key
+
+        Args:
+            key (str): field name
+            default (float, optional): value of a missing or expired key. Defaults to nan.
+
+        Returns:
+            float: the value
+        """
+        if key not in self.latest:
+            return default
+
+        value, timestamp = self.latest[key]
+        ex = self.expire_time.get(key)
+        if ex is not None and time.time() - timestamp >= ex:
+            return default
+        return value
+
+
+class HubPublisher:
+    """Publisher of the runtime readers, hands the values of each tick to the hub instead of redis
+
+    Same set and tick interface as RedisPublisher, so the service readers run unchanged.
+    """
+
+    def __init__(self, hub: SensorHub, expire_time: Optional[int] = None) -> None:
+        """Initialize the publisher
+
+        Args:
+            hub (SensorHub): hub receiving the values
+            expire_time (Optional[int], optional): default expire time for the values in seconds. Defaults to None.
+        """
+        self.hub = hub
+        self.expire_time = expire_time
+        self.pending: Dict[str, Tuple[float, Optional[int], float]] = dict()
+
+    def set(self, key: str, value: float, ex: Optional[int] = None) -> None:
+        """Queue a value to be published on the next tick
+
+        Args:
+            key (str): field name
+            value (float): value to publish
+            ex (Optional[int], optional): expire time in seconds. Defaults to the publisher expire time.
+        """
+        self.pending[getattr(key, 'value', key)] = (value, self.expire_time if ex is None else ex, time.time())
+
+    def tick(self) -> bool:
+        """Publish the values of this tick
+
+        Returns:
+            bool: True if the pending values were published
+        """
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        """Publish all pending values to the hub"""
+        if not self.pending:
+            return
+
+        self.hub.publish(self.pending)
+        self.pending = dict()
+
+
+async def run_gas(reader: Union[GasReader, GasArrayReader], publisher: HubPublisher, scheduler: DeadlineScheduler,
+                  adaptive: Optional[AdaptiveRate] = None) -> None:
+    """Read the gas sensor every tick, compensated with the latest temperature of the hub
+
+    Args:
+        reader (Union[GasReader, GasArrayReader]): gas reader setting its fields on the publisher
+        publisher (HubPublisher): publisher of the reader
+        scheduler (DeadlineScheduler): paces the reads, its period is the base period of the reader
+        adaptive (Optional[AdaptiveRate], optional): adapts the period to the gas dynamics. Defaults to a fixed period.
+    """
+    hub = publisher.hub
+    base_period = period = scheduler.period
+    if adaptive is not None:
+        period = adaptive.period
+        scheduler.set_period(period)
+        reader.scale_rate(base_period / period)
+    while True:
+        # assume temperature and humidity are always available. provide to 25 and 35 respectively if otherwise
+        temperature = hub.get(SensorReadingFieldNames.TEMPERATURE.value, 25)
+        humidity = hub.get(SensorReadingFieldNames.HUMIDITY.value, 35)
+
+        # ADC conversions block, keep them off the event loop
+        ppm = await asyncio.to_thread(reader.read, temperature, humidity)
+        publisher.tick()
+
+        if adaptive is not None:
+            new_period = adaptive.update(ppm, time.monotonic())
+            if new_period != period:
+                period = new_period
+                scheduler.set_period(period)
+                reader.scale_rate(base_period / period)
+
+        await scheduler.wait_async()
+
+
+async def run_temperature(reader: TemperatureReader, publisher: HubPublisher, scheduler: DeadlineScheduler) -> None:
+    """Read the temperature sensor every tick
+
+    Args:
+        reader (TemperatureReader): temperature reader setting its fields on the publisher
+        publisher (HubPublisher): publisher of the reader
+        scheduler (DeadlineScheduler): paces the reads
+    """
+    while True:
+        try:
+            await asyncio.to_thread(reader.read)
+            publisher.tick()
+        except RuntimeError as error:
+            print(error.args[0])
+        except Exception as error:
+            reader.buffer.reset()
+            raise error
+
+        await scheduler.wait_async()
+
+
+async def run_forwarder(forwarder: EventForwarder, hub: SensorHub, queue: asyncio.Queue) -> None:
+    """Send the updates of the hub to the drone as they arrive, see EventForwarder
+
+    Args:
+        forwarder (EventForwarder): forwarder on the mavlink connection
+        hub (SensorHub): hub the heartbeat values are read from
+        queue (asyncio.Queue): updates subscribed from the hub
+    """
+    def read_stale(stale: List[str]) -> Dict[str, float]:
+        return {n: hub.get(n) for n in stale}
+
+    while True:
+        # wait for the next update, or until a waiting value or a heartbeat is due
+        try:
+            forwarder.update(await asyncio.wait_for(queue.get(), forwarder.get_timeout()))
+        except asyncio.TimeoutError:
+            pass
+        while not queue.empty():
+            forwarder.update(queue.get_nowait())
+
+        forwarder.send_due(read_stale)
+
+
+async def run_redis_mirror(gas_publisher: RedisPublisher, temp_publisher: RedisPublisher, hub: SensorHub, queue: asyncio.Queue) -> None:
+    """Copy the updates of the hub to redis for other consumers, off the sensor to drone path
+
+    Updates waiting while a write is in flight are coalesced into the next transaction. A failed
+    write is skipped, the runtime keeps forwarding without redis.
+
+    Args:
+        gas_publisher (RedisPublisher): publisher writing the gas keys and announcing them on the gas channel
+        temp_publisher (RedisPublisher): publisher writing the temperature and humidity keys and announcing them on the temperature channel
+        hub (SensorHub): hub holding the expire time of each key
+        queue (asyncio.Queue): updates subscribed from the hub
+    """
+    from redis.exceptions import RedisError
+
+    publishers = (gas_publisher, temp_publisher)
+
+    def flush() -> None:
+        for publisher in publishers:
+            publisher.flush()
+
+    while True:
+        updates = [await queue.get()]
+        while not queue.empty():
+            updates.append(queue.get_nowait())
+
+        for update in updates:
+            for key, (value, timestamp) in update.items():
+                # same channels as the services, see gas_sensors.py and temp_sensors.py
+                publisher = temp_publisher if key in TEMP_FIELDS else gas_publisher
+                publisher.set(key, value, ex=hub.expire_time.get(key), timestamp=timestamp)
+        try:
+            await asyncio.to_thread(flush)
+        except RedisError as error:
+            for publisher in publishers:
+                publisher.pending.clear()
+            print_if_debug(f"Redis mirror failed: {error}", DEBUG)
+
+
+async def run(tasks: List) -> None:
+    """Run the tasks until one of them fails
+
+    Args:
+        tasks (List): coroutines of the runtime
+    """
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read the gas and temperature sensors and send them to the drone from one process')
+    parser.add_argument('-p', '--password',
+                        type=str,
+                        help='Redis password. Default to REDIS_PASSWORD env variable',
+                        default=config('REDIS_PASSWORD', default=''))
+    parser.add_argument('-R', '--redis-mirror',
+                        action='store_true',
+                        help='Also write every value to redis and announce it on the updates channel. Default to RUNTIME_REDIS_MIRROR env variable or False',
+                        default=config('RUNTIME_REDIS_MIRROR', default=False, cast=bool))
+    parser.add_argument('-P', '--port',
+                        type=int,
+                        help='Mavlink router port. Default to 5760 or MAVLINK_ROUTER_PORT env variable',
+                        default=config('MAVLINK_ROUTER_PORT', default=5760, cast=int))
+    parser.add_argument('-f', '--fc-sysid',
+                        type=int,
+                        help='Flight controller system id. Default to 1 or FC_SYSID env variable',
+                        default=config('FC_SYSID', default=1, cast=int))
+    parser.add_argument('--gas-refresh-rate',
+                        type=float,
+                        help='Gas refresh rate in seconds. Default to 0.1',
+                        default=0.1)
+    parser.add_argument('--gas-expire-time',
+                        type=int,
+                        help='Expire time of the gas values in seconds. Default to GAS_EXPIRE_TIME env variable or 10 seconds',
+                        default=config('GAS_EXPIRE_TIME', default=10, cast=int))
+    parser.add_argument('--gas-buffer-size',
+                        type=int,
+                        help='Buffer size for the mean gas value. Default to GAS_BUFFER_SIZE env variable or 10',
+                        default=config('GAS_BUFFER_SIZE', default=10, cast=int))
+    parser.add_argument('--gas-correction-factor',
+                        type=float,
+                        help='Correction factor for the mean gas value. Default to GAS_CORRECTION_FACTOR env variable or 6.0',
+                        default=config('GAS_CORRECTION_FACTOR', default=6.0, cast=float))
+    parser.add_argument('--gas-sample-rate',
+                        type=int,
+                        help='Background samples per second of the gas sensor, 0 reads one sample per refresh. Default to GAS_SAMPLE_RATE env variable or 0',
+                        default=config('GAS_SAMPLE_RATE', default=0, cast=int))
+    parser.add_argument('--gas-lookup-table',
+                        action='store_true',
+                        help='Convert gas readings with a precomputed table. Default to GAS_LOOKUP_TABLE env variable or False',
+                        default=config('GAS_LOOKUP_TABLE', default=False, cast=bool))
+    parser.add_argument('--gas-filter',
+                        type=str,
+                        action='append',
+                        help='Gas filter chain stage as NAME:ARG:ARG, replacing the buffer. Can be repeated. Default to GAS_FILTERS env variable',
+                        default=None)
+    parser.add_argument('--gas-sensor',
+                        type=str,
+                        action='append',
+                        help='Gas sensor as NAME:ADDRESS:PIN[:RZERO]. Can be repeated, see sensors.py. Default to GAS_SENSORS env variable or the single GAS sensor',
+                        default=None)
+    parser.add_argument('--gas-model',
+                        type=str,
+                        action='append',
+                        help='Gas estimated from the MQ135 resistance and published as {NAME}_{GAS}. Can be repeated. Default to GAS_MODEL_GASES env variable or none',
+                        default=None)
+    parser.add_argument('--record-dir',
+                        type=str,
+                        help='Record every gas reading to a new flight recording in this directory. Default to RECORDER_DIR env variable or no recording',
+                        default=config('RECORDER_DIR', default=''))
+    parser.add_argument('--record-capacity',
+                        type=int,
+                        help='Maximum rows of a flight recording. Default to RECORDER_CAPACITY env variable or 10000000',
+                        default=config('RECORDER_CAPACITY', default=10_000_000, cast=int))
+    parser.add_argument('--record-segment-rows',
+                        type=int,
+                        help='Rows synced to the flight recording at once. Default to RECORDER_SEGMENT_ROWS env variable or 4096',
+                        default=config('RECORDER_SEGMENT_ROWS', default=4096, cast=int))
+    parser.add_argument('--gas-adaptive',
+                        action='store_true',
+                        help='Adapt the gas refresh rate to the gas dynamics. Default to GAS_ADAPTIVE env variable or False',
+                        default=config('GAS_ADAPTIVE', default=False, cast=bool))
+    parser.add_argument('--gas-min-refresh-rate',
+                        type=float,
+                        help='Adaptive gas refresh rate in seconds while the gas moves. Default to GAS_MIN_REFRESH_RATE env variable or 0.05',
+                        default=config('GAS_MIN_REFRESH_RATE', default=0.05, cast=float))
+    parser.add_argument('--gas-max-refresh-rate',
+                        type=float,
+                        help='Adaptive gas refresh rate in seconds while the gas is steady. Default to GAS_MAX_REFRESH_RATE env variable or 0.8',
+                        default=config('GAS_MAX_REFRESH_RATE', default=0.8, cast=float))
+    parser.add_argument('--gas-adaptive-slope',
+                        type=float,
+                        help='Rate of change in ppm/s above which the gas moves. Default to GAS_ADAPTIVE_SLOPE env variable or 5.0',
+                        default=config('GAS_ADAPTIVE_SLOPE', default=5.0, cast=float))
+    parser.add_argument('--gas-adaptive-std',
+                        type=float,
+                        help='Standard deviation in ppm above which the gas moves, 0 to ignore. Default to GAS_ADAPTIVE_STD env variable or 10.0',
+                        default=config('GAS_ADAPTIVE_STD', default=10.0, cast=float))
+    parser.add_argument('--gas-adaptive-hold',
+                        type=float,
+                        help='Seconds the gas must stay steady before each slow down. Default to GAS_ADAPTIVE_HOLD env variable or 2.0',
+                        default=config('GAS_ADAPTIVE_HOLD', default=2.0, cast=float))
+    parser.add_argument('-s', '--sensor-max-value',
+                        type=int,
+                        help='Sensor max value. Default to SENSOR_ANALOG_VALUE_MAX env variable or 1023',
+                        default=config('SENSOR_ANALOG_VALUE_MAX', default=1023, cast=int))
+    parser.add_argument('--temp-refresh-rate',
+                        type=float,
+                        help='Temperature refresh rate in seconds. Default to TEMP_REFRESH_RATE env variable or 5.0. Cannot be lower than 5.0',
+                        default=config('TEMP_REFRESH_RATE', default=5.0, cast=float))
+    parser.add_argument('--temp-expire-time',
+                        type=int,
+                        help='Expire time of the temperature in seconds. Default to TEMP_EXPIRE env variable or 10 seconds',
+                        default=config('TEMP_EXPIRE', default=10, cast=int))
+    parser.add_argument('--temp-buffer-size',
+                        type=int,
+                        help='Buffer size for the temperature. Default to TEMP_BUFFER_SIZE env variable or 4',
+                        default=config('TEMP_BUFFER_SIZE', default=4, cast=int))
+    parser.add_argument('--temp-cutoff-value',
+                        type=float,
+                        help='Temperature outlier cutoff value. Default to TEMP_OUTLIER_CUTOFF env variable or 6.0',
+                        default=config('TEMP_OUTLIER_CUTOFF', default=6.0, cast=float))
+    parser.add_argument('--temp-sample-rate',
+                        type=int,
+                        help='Background samples per second of the temperature sensor, 0 reads one sample per refresh. Default to TEMP_SAMPLE_RATE env variable or 0',
+                        default=config('TEMP_SAMPLE_RATE', default=0, cast=int))
+    parser.add_argument('--temp-filter',
+                        type=str,
+                        action='append',
+                        help='Temperature filter chain stage as NAME:ARG:ARG, replacing the buffer. Can be repeated. Default to TEMP_FILTERS env variable',
+                        default=None)
+    parser.add_argument('-i', '--min-interval',
+                        type=float,
+                        help='Minimum seconds between sends of a field. Default to 0.05 or MAVLINK_MIN_INTERVAL env variable',
+                        default=config('MAVLINK_MIN_INTERVAL', default=0.05, cast=float))
+    parser.add_argument('-I', '--field-interval',
+                        type=str,
+                        action='append',
+                        help='Minimum interval of one field as FIELD=SECONDS. Can be repeated. Default to MAVLINK_FIELD_INTERVALS env variable',
+                        default=None)
+    parser.add_argument('-b', '--heartbeat',
+                        type=float,
+                        help='Seconds after which an unchanged field is resent. Default to 1.0 or MAVLINK_HEARTBEAT env variable',
+                        default=config('MAVLINK_HEARTBEAT', default=1.0, cast=float))
+    parser.add_argument('-q', '--queue-size',
+                        type=int,
+                        help='Maximum number of queued mavlink messages. Default to 64 or MAVLINK_QUEUE_SIZE env variable',
+                        default=config('MAVLINK_QUEUE_SIZE', default=64, cast=int))
+    parser.add_argument('-e', '--encoding',
+                        choices=['named', 'packed'],
+                        help='Send one NAMED_VALUE_FLOAT per field or all fields in one packed DEBUG_FLOAT_ARRAY. Default to named or MAVLINK_ENCODING env variable',
+                        default=config('MAVLINK_ENCODING', default='named'))
+    parser.add_argument('-o', '--overrun-policy',
+                        choices=['skip', 'catch-up'],
+                        help='When a sensor tick overruns its deadline, skip the missed ticks or run them back to back. Default to LOOP_OVERRUN_POLICY env variable or skip',
+                        default=config('LOOP_OVERRUN_POLICY', default='skip'))
+    parser.add_argument('-l', '--latency',
+                        action='store_true',
+                        help='Report latency from sensor timestamp to mavlink send')
+    parser.add_argument('--map-field',
+                        type=str,
+                        help='Map this field along the GLOBAL_POSITION_INT track of the drone and send the plume around it, e.g. GAS_PPM. '
+                             'Default to MAP_FIELD env variable or no map',
+                        default=config('MAP_FIELD', default=''))
+    parser.add_argument('--map-cell-size',
+                        type=float,
+                        help='Side of a map cell in meters. Default to MAP_CELL_SIZE env variable or 5.0',
+                        default=config('MAP_CELL_SIZE', default=5.0, cast=float))
+    parser.add_argument('--map-radius',
+                        type=float,
+                        help='Meters around the drone searched for the plume. Default to MAP_RADIUS env variable or 100.0',
+                        default=config('MAP_RADIUS', default=100.0, cast=float))
+    parser.add_argument('--map-file',
+                        type=str,
+                        help='CSV heatmap of the map cells, written every minute and on exit. Default to MAP_FILE env variable or not saved',
+                        default=config('MAP_FILE', default=''))
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='Serve the metrics as Prometheus text on this HTTP port, 0 to not serve. Default to METRICS_PORT env variable or 0',
+                        default=config('METRICS_PORT', default=0, cast=int))
+    parser.add_argument('--metrics-redis',
+                        type=float,
+                        help='Write the metrics to the METRICS_RUNTIME redis hash every this many seconds, 0 to not write. Default to METRICS_REDIS_SECOND env variable or 0',
+                        default=config('METRICS_REDIS_SECOND', default=0.0, cast=float))
+    parser.add_argument('-d', '--debug',
+                        action='store_true',
+                        help='Enable debug mode')
+    args = parser.parse_args()
+    # repeated options replace the env list rather than extend it
+    if args.gas_filter is None:
+        args.gas_filter = config('GAS_FILTERS', default='', cast=Csv())
+    if args.temp_filter is None:
+        args.temp_filter = config('TEMP_FILTERS', default='', cast=Csv())
+    if args.gas_sensor is None:
+        args.gas_sensor = config('GAS_SENSORS', default='', cast=Csv())
+    if args.gas_model is None:
+        args.gas_model = config('GAS_MODEL_GASES', default='', cast=Csv())
+    if args.field_interval is None:
+        args.field_interval = config('MAVLINK_FIELD_INTERVALS', default='', cast=Csv())
+    # same bound as temp_sensors.py
+    if args.temp_refresh_rate < 5.0:
+        parser.error("Temperature refresh rate cannot be lower than 5.0")
+
+    global DEBUG
+    DEBUG = args.debug
+    gas_sensors.DEBUG = temp_sensors.DEBUG = mavlink.DEBUG = DEBUG
+    if DEBUG:
+        set_log_level('debug')
+
+    hub = SensorHub()
+    gas_publisher = HubPublisher(hub, args.gas_expire_time)
+    temp_publisher = HubPublisher(hub, args.temp_expire_time)
+    try:
+        sensors = parse_gas_sensors(args.gas_sensor, args.gas_model)
+        gas_reader = create_gas_reader(gas_publisher, args.gas_buffer_size, args.gas_correction_factor, args.sensor_max_value,
+                                       args.gas_sample_rate, args.gas_lookup_table, args.gas_filter,
+                                       args.record_dir, args.record_capacity, args.record_segment_rows, sensors)
+        temp_reader = create_temperature_reader(temp_publisher, args.temp_buffer_size, args.temp_cutoff_value, args.temp_sample_rate,
+                                                args.temp_filter)
+    except ValueError as e:
+        parser.error(str(e))
+
+    multiplexer = create_multiplexer(args.port, args.fc_sysid, args.queue_size)
+    plume = create_plume_forwarder(args.map_field, args.map_cell_size, args.map_radius, args.map_file)
+    forwarder = EventForwarder(multiplexer, args.min_interval, args.heartbeat, parse_field_intervals(args.field_interval),
+                               args.latency, args.encoding == 'packed', sensors, plume)
+
+    gas_adaptive = None
+    if args.gas_adaptive:
+        gas_adaptive = AdaptiveRate(args.gas_min_refresh_rate, args.gas_max_refresh_rate, args.gas_adaptive_slope,
+                                    args.gas_adaptive_std, hold_second=args.gas_adaptive_hold)
+
+    tasks = [
+        run_gas(gas_reader, gas_publisher, DeadlineScheduler(args.gas_refresh_rate, "Gas", args.overrun_policy, 10 if DEBUG else 0), gas_adaptive),
+        run_temperature(temp_reader, temp_publisher, DeadlineScheduler(args.temp_refresh_rate, "Temperature", args.overrun_policy, 60 if DEBUG else 0)),
+        run_forwarder(forwarder, hub, hub.subscribe()),
+    ]
+    r = connect_redis(args.password, DEBUG) if args.redis_mirror or args.metrics_redis > 0 else None
+    if args.redis_mirror:
+        tasks.append(run_redis_mirror(RedisPublisher(r, channel=GAS_UPDATES_CHANNEL), RedisPublisher(r, channel=TEMP_UPDATES_CHANNEL),
+                                      hub, hub.subscribe()))
+    start_metrics_export('runtime', args.metrics_port, r, args.metrics_redis)
+
+    print_if_debug(f"Starting runtime. Redis mirror: {args.redis_mirror}", DEBUG)
+    try:
+        asyncio.run(run(tasks))
+    finally:
+        if gas_reader.recorder is not None:
+            gas_reader.recorder.close()
+        if plume is not None:
+            plume.save()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("Exiting...")
+        exit(0)
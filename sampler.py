@@ -0,0 +1,60 @@
+from typing import Optional, Tuple
+import numpy as np
+
+
+class SampleRing:
+    """Preallocated numpy ring of timestamped samples with a single writer
+
+    Consumers keep a cursor and pull the samples written since then as numpy views of the ring,
+    so a block is not copied. A view stays valid until the writer wraps around the ring.
+    """
+
+    def __init__(self, capacity: int = 8192):
+        """Initialize the ring
+
+        Args:
+            capacity (int, optional): number of samples kept in the ring. Defaults to 8192.
+        """
+        self.capacity = capacity
+        self.values = np.zeros(capacity)
+        self.timestamps = np.zeros(capacity)
+        self.count = 0
+        self.lost = 0
+
+    def append(self, value: float, timestamp: float) -> None:
+        """Write a sample
+
+        Args:
+            value (float): sample value
+            timestamp (float): sample time from time.monotonic()
+        """
+        index = self.count % self.capacity
+        self.values[index] = value
+        self.timestamps[index] = timestamp
+        # publish the sample only after it is written
+        self.count += 1
+
+    def read(self, cursor: int, max_samples: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Get the samples written since the cursor, up to the end of the ring
+
+        A wrapped range is returned over two calls, call again until the block is empty.
+        If the consumer fell more than capacity samples behind, the oldest are skipped and counted as lost.
+
+        Args:
+            cursor (int): number of samples already consumed, 0 at start
+            max_samples (Optional[int], optional): maximum number of samples to return. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, int]: views of the values and timestamps, and the new cursor
+        """
+        count = self.count
+        if count - cursor > self.capacity:
+            self.lost += count - cursor - self.capacity
+            cursor = count - self.capacity
+
+        start = cursor % self.capacity
+        n = min(count - cursor, self.capacity - start)
+        if max_samples is not None:
+            n = min(n, max_samples)
+        return self.values[start:start + n], self.timestamps[start:start + n], cursor + n
+
@@ -0,0 +1,136 @@
+import asyncio
+from time import monotonic, sleep
+from typing import Dict
+from instrumentation import METRICS, Histogram
+
+OVERRUN_POLICIES = ('skip', 'catch-up')
+
+
+class DeadlineScheduler:
+    """Paces a loop at absolute deadlines on the monotonic clock
+
+    Deadlines are start + k * period, so the time spent working does not add to the period and
+    the loop does not drift. A tick that starts after its deadline is an overrun. With the skip
+    policy, deadlines missed entirely are dropped and the loop runs one late tick then returns
+    to the grid. With the catch-up policy, every missed tick runs back to back until the loop is
+    on schedule again.
+
+    The period between tick starts and the jitter of each start after its deadline are kept in
+    histograms, see report. They also go to the {name}_loop metrics since the start of the process.
+    """
+
+    def __init__(self, period: float, name: str = "loop", policy: str = 'skip', report_second: float = 0.0):
+        """Initialize the scheduler. The current time is the start of the first tick
+
+        Args:
+            period (float): seconds between tick starts
+            name (str, optional): loop name in reports. Defaults to "loop".
+            policy (str, optional): overrun policy, skip or catch-up. Defaults to 'skip'.
+            report_second (float, optional): seconds between printed reports, 0 to not print. Defaults to 0.0.
+        """
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy {policy}, expected one of {OVERRUN_POLICIES}")
+
+        self.period = period
+        self.name = name
+        self.policy = policy
+        self.report_second = report_second
+        self.deadline = monotonic()
+        self.last_start = self.deadline
+        self.last_report = self.deadline
+        self.periods = Histogram()
+        self.jitter = Histogram()
+        prefix = f"{name.lower().replace(' ', '_')}_loop"
+        self.period_timer = METRICS.timer(f"{prefix}_period_ms", f"{name} loop time between tick starts")
+        self.jitter_timer = METRICS.timer(f"{prefix}_jitter_ms", f"{name} loop tick start after its deadline")
+        self.overrun_counter = METRICS.counter(f"{prefix}_overruns_total", f"{name} loop ticks started after their deadline")
+        self.skipped_counter = METRICS.counter(f"{prefix}_skipped_total", f"{name} loop ticks skipped by the overrun policy")
+        self.reset_stats()
+
+    def next_delay(self) -> float:
+        """Move to the next deadline and get the seconds to wait for it
+
+        Returns:
+            float: seconds until the next tick, 0 if it is already due
+        """
+        now = monotonic()
+        self.deadline += self.period
+        if now > self.deadline:
+            self.overruns += 1
+            self.overrun_counter.inc()
+            if self.policy == 'skip' and now - self.deadline >= self.period:
+                missed = int((now - self.deadline) // self.period)
+                self.deadline += missed * self.period
+                self.skipped += missed
+                self.skipped_counter.inc(missed)
+        return max(0.0, self.deadline - now)
+
+    def set_period(self, period: float) -> None:
+        """Change the period from the next tick on, counted from the deadline of the current tick
+
+        Args:
+            period (float): seconds between tick starts
+        """
+        self.period = period
+
+    def start_tick(self) -> None:
+        """Record the start of a tick"""
+        now = monotonic()
+        period = (now - self.last_start) * 1000
+        jitter = max(0.0, now - self.deadline) * 1000
+        self.periods.add(period)
+        self.jitter.add(jitter)
+        self.period_timer.observe(period)
+        self.jitter_timer.observe(jitter)
+        self.last_start = now
+        self.ticks += 1
+
+        if self.report_second > 0 and now - self.last_report >= self.report_second:
+            self.report()
+
+    def wait(self) -> None:
+        """Sleep until the next deadline"""
+        delay = self.next_delay()
+        if delay > 0:
+            sleep(delay)
+        self.start_tick()
+
+    async def wait_async(self) -> None:
+        """Sleep until the next deadline without blocking the event loop"""
+        await asyncio.sleep(self.next_delay())
+        self.start_tick()
+
+    def get_stats(self) -> Dict[str, float]:
+        """Get the loop statistics since the last reset
+
+        Returns:
+            Dict[str, float]: ticks, overruns, skipped ticks, mean and p99 period, p50, p99 and max jitter in milliseconds
+        """
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "mean_period_ms": self.periods.mean,
+            "p99_period_ms": self.periods.percentile(0.99),
+            "p50_jitter_ms": self.jitter.percentile(0.50),
+            "p99_jitter_ms": self.jitter.percentile(0.99),
+            "max_jitter_ms": self.jitter.max,
+        }
+
+    def reset_stats(self) -> None:
+        """Reset the loop statistics"""
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.periods.reset()
+        self.jitter.reset()
+
+    def report(self) -> None:
+        """Print the loop statistics and start a new period"""
+        self.last_report = monotonic()
+        stats = self.get_stats()
+        print(f"{self.name} loop: {stats['ticks']} ticks at {self.period * 1000:.1f} ms, "
+              f"period mean {stats['mean_period_ms']:.2f} ms p99 <{stats['p99_period_ms']:g} ms, "
+              f"jitter p50 <{stats['p50_jitter_ms']:g} ms p99 <{stats['p99_jitter_ms']:g} ms max {stats['max_jitter_ms']:.2f} ms, "
+              f"{stats['overruns']} overruns, {stats['skipped']} skipped")
+        self.reset_stats()
@@ -0,0 +1,141 @@
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+from decouple import config, Csv
+
+# NAMED_VALUE_FLOAT names are truncated to 10 characters
+MAVLINK_NAME_LENGTH = 10
+# fields of each gas sensor, suffixes of the sensor name
+GAS_FIELD_SUFFIXES = ("VOLTAGE", "PPM", "VALUE", "PERCENT")
+# fields of the temperature service
+COMPENSATION_FIELDS = ("TEMP", "HUMIDITY")
+DEFAULT_SENSOR_NAME = "GAS"
+ADS1115_ADDRESSES = (0x48, 0x49, 0x4A, 0x4B)
+
+
+class GasSensor(NamedTuple):
+    """One MQ-series sensor of the registry"""
+    # prefix of the field names of the sensor, e.g. GAS gives GAS_PPM
+    name: str
+    # I2C address of the ADS1115 the sensor is wired to
+    address: int
+    # single ended input of the ADS1115, 0 to 3
+    pin: int
+    # calibration resistance of the sensor
+    rzero: float
+    # gases estimated by the multi-gas model besides the CO2 ppm, see mq135.MQ135GasModel
+    gases: Tuple[str, ...] = ()
+
+    @property
+    def fields(self) -> List[str]:
+        """Field names of the sensor, in the order of GAS_FIELD_SUFFIXES, then one per gas"""
+        return [f"{self.name}_{suffix}" for suffix in GAS_FIELD_SUFFIXES + self.gases]
+
+    @property
+    def gas_fields(self) -> List[str]:
+        """Field names of the gas estimates of the sensor, in the order of its gases"""
+        return [f"{self.name}_{gas}" for gas in self.gases]
+
+    @property
+    def rzero_name(self) -> str:
+        """Env variable of the calibrated rzero, RZERO for the default sensor"""
+        return 'RZERO' if self.name == DEFAULT_SENSOR_NAME else f'RZERO_{self.name}'
+
+
+def parse_gas_sensor(spec: str) -> GasSensor:
+    """Parse a sensor spec NAME:ADDRESS:PIN[:RZERO]
+
+    The address is an integer literal, e.g. 0x49. Without RZERO, the rzero is read from the
+    RZERO_NAME env variable, or RZERO for the default GAS sensor.
+
+    Args:
+        spec (str): the sensor spec, e.g. GAS2:0x49:1 or GAS3:0x49:2:76.5
+
+    Raises:
+        ValueError: if the spec is malformed or has no rzero
+
+    Returns:
+        GasSensor: the sensor
+    """
+    parts = spec.strip().split(':')
+    if len(parts) not in (3, 4) or not parts[0].isidentifier():
+        raise ValueError(f"Invalid gas sensor {spec!r}, expected NAME:ADDRESS:PIN[:RZERO]")
+    name = parts[0].upper()
+    try:
+        address = int(parts[1], 0)
+        pin = int(parts[2])
+    except ValueError:
+        raise ValueError(f"Invalid address or pin in gas sensor {spec!r}")
+    if address not in ADS1115_ADDRESSES:
+        raise ValueError(f"Invalid ADS1115 address {parts[1]} of gas sensor {name}, expected one of 0x48 to 0x4B")
+    if not 0 <= pin <= 3:
+        raise ValueError(f"Invalid pin {pin} of gas sensor {name}, expected 0 to 3")
+
+    if len(parts) == 4:
+        rzero = float(parts[3])
+    else:
+        rzero_name = 'RZERO' if name == DEFAULT_SENSOR_NAME else f'RZERO_{name}'
+        rzero = config(rzero_name, default=config('RZERO', default='nan'), cast=float)
+    return GasSensor(name, address, pin, rzero)
+
+
+def parse_gas_sensors(specs: Optional[Iterable[str]] = None, gases: Optional[Iterable[str]] = None) -> List[GasSensor]:
+    """Parse the sensor registry
+
+    Args:
+        specs (Optional[Iterable[str]], optional): sensor specs, see parse_gas_sensor. Defaults to the GAS_SENSORS env
+            variable, or the single GAS sensor on input 0 of the ADS1115 at 0x48.
+        gases (Optional[Iterable[str]], optional): gases estimated for every sensor besides the CO2 ppm, e.g. NH4,
+            see mq135.MQ135GasModel. Defaults to the GAS_MODEL_GASES env variable, or none.
+
+    Raises:
+        ValueError: if a spec or gas is invalid, a sensor is on the temperature input, or two sensors share an input or a field name
+
+    Returns:
+        List[GasSensor]: the sensors, in the order of the specs
+    """
+    if specs is None:
+        specs = config('GAS_SENSORS', default='', cast=Csv())
+    specs = [spec for spec in specs if spec.strip()]
+    sensors = [parse_gas_sensor(spec) for spec in specs] or [parse_gas_sensor(f"{DEFAULT_SENSOR_NAME}:0x48:0")]
+
+    if gases is None:
+        gases = config('GAS_MODEL_GASES', default='', cast=Csv())
+    gases = tuple(gas.strip().upper() for gas in gases if gas.strip())
+    for gas in gases:
+        if not gas.isidentifier() or gas in GAS_FIELD_SUFFIXES:
+            raise ValueError(f"Invalid gas {gas!r}")
+        if gases.count(gas) > 1:
+            raise ValueError(f"Gas {gas} is listed twice")
+    sensors = [sensor._replace(gases=gases) for sensor in sensors]
+
+    # adc loads numpy through its sample ring, which the importers of the registry may not need
+    from adc import TEMPERATURE_ADDRESS, TEMPERATURE_PIN
+
+    inputs = set()
+    names = set()
+    for sensor in sensors:
+        if (sensor.address, sensor.pin) == (TEMPERATURE_ADDRESS, TEMPERATURE_PIN):
+            raise ValueError(f"Gas sensor {sensor.name} uses input {sensor.pin} of ADS1115 {sensor.address:#x}, the input of the temperature sensor")
+        if (sensor.address, sensor.pin) in inputs:
+            raise ValueError(f"Gas sensor {sensor.name} uses input {sensor.pin} of ADS1115 {sensor.address:#x} twice")
+        inputs.add((sensor.address, sensor.pin))
+        for field in sensor.fields:
+            if field[:MAVLINK_NAME_LENGTH] in names:
+                raise ValueError(f"Field {field} of gas sensor {sensor.name} is not unique in its first {MAVLINK_NAME_LENGTH} characters")
+            names.add(field[:MAVLINK_NAME_LENGTH])
+    return sensors
+
+
+def get_field_names(sensors: Optional[List[GasSensor]] = None) -> List[str]:
+    """Get every field name of the registry: the fields of each gas sensor, then the compensation fields
+
+    With the default registry, these are the values of utils.SensorReadingFieldNames.
+
+    Args:
+        sensors (Optional[List[GasSensor]], optional): the sensors. Defaults to parse_gas_sensors().
+
+    Returns:
+        List[str]: the field names
+    """
+    if sensors is None:
+        sensors = parse_gas_sensors()
+    return [field for sensor in sensors for field in sensor.fields] + list(COMPENSATION_FIELDS)
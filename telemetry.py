@@ -0,0 +1,95 @@
+"""
+Packed telemetry format
+
+All sensor fields of one tick are sent as a single MAVLink 2 DEBUG_FLOAT_ARRAY message:
+ - name: PACKED_ARRAY_NAME
+ - array_id: format version, selects the field order in PACKED_FIELD_ORDER
+ - time_usec: time since the forwarder connected in microseconds
+ - data: field values in the order of the version, nan for fields without a value
+
+MAVLink 2 truncates trailing zero bytes of the payload, so the unused tail of the
+58 float data array does not go over the radio.
+
+Version 1 is the single GAS sensor. Version 2 is a sensor array: TEMP and HUMIDITY, then
+the PPM and VALUE fields of each gas sensor in the order of the GAS_SENSORS registry, see
+sensors.py, each followed by its GAS_MODEL_GASES estimates. The voltage and percent follow
+from the value, so they are left out to fit 28 sensors in one message. The decoder reads the
+same registry to name the fields.
+"""
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+from sensors import COMPENSATION_FIELDS, DEFAULT_SENSOR_NAME, GasSensor
+
+PACKED_ARRAY_NAME = "GAS_PACK"
+PACKED_FORMAT_VERSION = 1
+PACKED_ARRAY_VERSION = 2
+PACKED_ARRAY_LENGTH = 58
+
+PACKED_FIELD_ORDER: Dict[int, Tuple[str, ...]] = {
+    1: ("GAS_VOLTAGE", "GAS_PPM", "GAS_VALUE", "GAS_PERCENT", "TEMP", "HUMIDITY"),
+}
+PACKED_VERSIONS = (PACKED_FORMAT_VERSION, PACKED_ARRAY_VERSION)
+
+
+def get_packed_version(sensors: List[GasSensor]) -> int:
+    """Get the format version of a sensor registry, 1 for the single GAS sensor without gas estimates"""
+    if len(sensors) == 1 and sensors[0].name == DEFAULT_SENSOR_NAME and not sensors[0].gases:
+        return PACKED_FORMAT_VERSION
+    return PACKED_ARRAY_VERSION
+
+
+def get_field_order(version: int, sensors: Optional[List[GasSensor]] = None) -> Tuple[str, ...]:
+    """Get the field order of a format version
+
+    Args:
+        version (int): format version
+        sensors (Optional[List[GasSensor]], optional): sensor registry of version 2. Defaults to no gas sensor.
+
+    Raises:
+        ValueError: if the version is unknown or the sensors do not fit in a message
+
+    Returns:
+        Tuple[str, ...]: field names in the order of the data array
+    """
+    if version in PACKED_FIELD_ORDER:
+        return PACKED_FIELD_ORDER[version]
+    if version != PACKED_ARRAY_VERSION:
+        raise ValueError(f"Unknown packed telemetry version: {version}")
+
+    order = COMPENSATION_FIELDS + tuple(field for sensor in sensors or ()
+                                        for field in [f"{sensor.name}_PPM", f"{sensor.name}_VALUE"] + sensor.gas_fields)
+    if len(order) > PACKED_ARRAY_LENGTH:
+        raise ValueError(f"{len(sensors)} gas sensors do not fit in one packed telemetry message")
+    return order
+
+
+def pack_fields(values: Dict[str, float], version: int = PACKED_FORMAT_VERSION, order: Optional[Tuple[str, ...]] = None) -> List[float]:
+    """Pack field values into the data array of a packed telemetry message
+
+    Args:
+        values (Dict[str, float]): value of each field name. Missing fields are sent as nan
+        version (int, optional): format version. Defaults to PACKED_FORMAT_VERSION.
+        order (Optional[Tuple[str, ...]], optional): field order, see get_field_order. Defaults to the order of version 1.
+
+    Returns:
+        List[float]: data array of PACKED_ARRAY_LENGTH floats
+    """
+    data = [float(values.get(name, math.nan)) for name in order or PACKED_FIELD_ORDER[version]]
+    return data + [0.0] * (PACKED_ARRAY_LENGTH - len(data))
+
+
+def unpack_fields(version: int, data: Iterable[float], sensors: Optional[List[GasSensor]] = None) -> Dict[str, float]:
+    """Unpack the data array of a packed telemetry message
+
+    Args:
+        version (int): format version, the array_id of the message
+        data (Iterable[float]): data array of the message
+        sensors (Optional[List[GasSensor]], optional): sensor registry of version 2 messages. Defaults to no gas sensor.
+
+    Raises:
+        ValueError: if the version is unknown
+
+    Returns:
+        Dict[str, float]: value of each field name
+    """
+    return dict(zip(get_field_order(version, sensors), data))
@@ -1,10 +1,120 @@
-import time
-from utils import connect_redis, print_if_debug, is_none_or_whitespace, init_sensor, get_temp_sensor_reading, SensorReadingFieldNames, Buffer
+from utils import connect_redis, print_if_debug, is_none_or_whitespace, get_temp_sensor_reading, SensorReadingFieldNames, RedisPublisher, TEMP_HISTORY_STREAM, TEMP_UPDATES_CHANNEL
 import argparse
-from decouple import config
-import adafruit_ads1x15.ads1115 as ADS
+from decouple import config, Csv
+from adc import ADCChannel, TEMPERATURE_ADDRESS, TEMPERATURE_PIN, get_sensor_voltage, init_sensor
+from buffers import Buffer
+from sampler import SampleRing
+from scheduler import DeadlineScheduler
+from filters import FilterChain, parse_filter_chain
+from instrumentation import Logger, set_log_level, start_metrics_export
+from typing import List, Optional
 
 DEBUG = False
+log = Logger("temp")
+
+
+class TemperatureReader:
+    """Reads the temperature sensor and sets the temperature of one tick on a publisher
+
+    Shared by this service and the single process runtime, see runtime.py.
+    """
+
+    def __init__(self, sensor: ADCChannel, buffer: Buffer, publisher: RedisPublisher,
+                 cutoff_value: float = 6.0, sampler: Optional[SampleRing] = None, chain: Optional[FilterChain] = None):
+        """Initialize the reader
+
+        Args:
+            sensor (ADCChannel): the temperature sensor
+            buffer (Buffer): outlier filter of the temperature
+            publisher (RedisPublisher): publisher the fields are set on, anything with its set method
+            cutoff_value (float, optional): outlier cutoff of the buffer. Defaults to 6.0.
+            sampler (Optional[SampleRing], optional): background samples of the sensor, filtered in blocks. Defaults to one read per tick.
+            chain (Optional[FilterChain], optional): filters the temperature instead of the buffer. Defaults to None.
+        """
+        self.sensor = sensor
+        self.buffer = buffer
+        self.publisher = publisher
+        self.cutoff_value = cutoff_value
+        self.sampler = sampler
+        self.chain = chain
+        self.cursor = 0
+        self.humidity = float('nan')
+
+    def read(self) -> None:
+        """Read the sensor and set the filtered temperature of this tick
+
+        Raises:
+            RuntimeError: if no temperature was read
+        """
+        if self.sampler is not None:
+            # convert and filter every sample taken since the last refresh
+            temperature = None
+            filtered_temperature = float('nan')
+            while True:
+                values, _, self.cursor = self.sampler.read(self.cursor)
+                if len(values) == 0:
+                    break
+                block = get_temp_sensor_reading(get_sensor_voltage(self.sensor, values))
+                filtered_temperature = self.filter(block, filtered_temperature)
+                temperature = float(block[-1])
+            log.debug("Raw Temperature reading: %s", temperature)
+        else:
+            voltage = self.sensor.voltage
+            temperature = get_temp_sensor_reading(voltage)
+            filtered_temperature = self.filter(temperature)
+
+            log.debug("Raw Temperature reading: %s", temperature, voltage=voltage)
+
+        if is_none_or_whitespace(temperature) or is_none_or_whitespace(self.humidity):
+            raise RuntimeError("Failed to read temperature or humidity")
+
+        log.debug("Filtered Temperature: %s", filtered_temperature)
+
+        # set the values in redis, unless a decimating filter has no output yet
+        if filtered_temperature == filtered_temperature:
+            self.publisher.set(SensorReadingFieldNames.TEMPERATURE, filtered_temperature)
+
+    def filter(self, values, previous: float = float('nan')) -> float:
+        """Filter a temperature or a block of temperatures through the buffer or the filter chain
+
+        Args:
+            values (array_like): temperatures, oldest first
+            previous (float, optional): filtered temperature to keep if the chain has no output. Defaults to nan.
+
+        Returns:
+            float: the latest filtered temperature
+        """
+        if self.chain is None:
+            self.buffer.add_many(values)
+            return self.buffer.get(m=self.cutoff_value)
+
+        out = self.chain.process(values)
+        return float(out[-1]) if len(out) else previous
+
+
+def create_temperature_reader(publisher: RedisPublisher, buffer_size: int = 4, cutoff_value: float = 6.0, sample_rate: int = 0,
+                              filters: Optional[List[str]] = None) -> TemperatureReader:
+    """Initialize the temperature sensor on its ADC channel and a reader setting its fields on a publisher
+
+    Args:
+        publisher (RedisPublisher): publisher the fields are set on
+        buffer_size (int, optional): buffer size of the temperature filter. Defaults to 4.
+        cutoff_value (float, optional): outlier cutoff of the temperature filter. Defaults to 6.0.
+        sample_rate (int, optional): background samples per second, 0 reads one sample per tick. Defaults to 0.
+        filters (Optional[List[str]], optional): filter chain stage specs replacing the buffer, see parse_filter_chain. Defaults to None.
+
+    Returns:
+        TemperatureReader: the reader
+    """
+    # the ADC is shared with the other channels, conversions are scheduled by the ADC manager
+    sensor = init_sensor(pin=TEMPERATURE_PIN, rate=sample_rate, address=TEMPERATURE_ADDRESS)
+    sampler = sensor if sample_rate > 0 else None
+    if sampler is not None:
+        print_if_debug(f"Sampling temperature in the background at {sample_rate} SPS", DEBUG)
+
+    chain = parse_filter_chain(filters or [])
+    return TemperatureReader(sensor, Buffer(buffer_size, "temp_buffer"), publisher, cutoff_value, sampler, chain)
+
 
 def main():
     parser = argparse.ArgumentParser(description='Read temperature and humidity sensor data and send it to redis')
@@ -37,7 +147,39 @@ def main():
                         help='Buffer size for the number of readings to consider. Default to TEMP_BUFFER_SIZE env variable or 4',
                         default=config('TEMP_BUFFER_SIZE', default=4, cast=int))
 
+    parser.add_argument('-a', '--sample-rate',
+                        type=int,
+                        help='Sample the ADC channel in the background at this rate through the shared ADC scheduler and filter every sample. '
+                             '0 reads one sample per refresh. Default to TEMP_SAMPLE_RATE env variable or 0',
+                        default=config('TEMP_SAMPLE_RATE', default=0, cast=int))
+    parser.add_argument('-F', '--filter',
+                        type=str,
+                        action='append',
+                        help='Filter chain stage as NAME:ARG:ARG, replacing the buffer. Can be repeated, applied in order. '
+                             'Stages: outlier, ema, kalman, fir, cic, buffer. Default to TEMP_FILTERS env variable',
+                        default=None)
+    parser.add_argument('-o', '--overrun-policy',
+                        choices=['skip', 'catch-up'],
+                        help='When a tick overruns its deadline, skip the missed ticks or run them back to back. Default to LOOP_OVERRUN_POLICY env variable or skip',
+                        default=config('LOOP_OVERRUN_POLICY', default='skip'))
+    parser.add_argument('-H', '--history-maxlen',
+                        type=int,
+                        help='Also append the values of every tick to the HISTORY_TEMP redis stream, trimmed to about this many records, '
+                             '0 to keep no history. Default to TEMP_HISTORY_MAXLEN env variable or 0',
+                        default=config('TEMP_HISTORY_MAXLEN', default=0, cast=int))
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        help='Serve the metrics as Prometheus text on this HTTP port, 0 to not serve. Default to METRICS_PORT env variable or 0',
+                        default=config('METRICS_PORT', default=0, cast=int))
+    parser.add_argument('--metrics-redis',
+                        type=float,
+                        help='Write the metrics to the METRICS_TEMP redis hash every this many seconds, 0 to not write. Default to METRICS_REDIS_SECOND env variable or 0',
+                        default=config('METRICS_REDIS_SECOND', default=0.0, cast=float))
+
     args = parser.parse_args()
+    # repeated options replace the env list rather than extend it
+    if args.filter is None:
+        args.filter = config('TEMP_FILTERS', default='', cast=Csv())
 
     # check if args.refresh_rate is lower than 5.0
     if args.refresh_rate < 5.0:
@@ -45,42 +187,32 @@ def main():
 
     global DEBUG
     DEBUG = args.debug
+    if DEBUG:
+        set_log_level('debug')
    
     r = connect_redis(args.password, DEBUG)
-    sensor = init_sensor(pin=ADS.P3)
-
-    temperature = float('nan')
-    humidity = float('nan')
-
-    buffer = Buffer(args.buffer_size)
+    start_metrics_export('temp', args.metrics_port, r, args.metrics_redis)
+    publisher = RedisPublisher(r, args.expire_time, channel=TEMP_UPDATES_CHANNEL, history=TEMP_HISTORY_STREAM, history_maxlen=args.history_maxlen)
+    try:
+        reader = create_temperature_reader(publisher, args.buffer_size, args.cutoff_value, args.sample_rate, args.filter)
+    except ValueError as e:
+        parser.error(str(e))
+    scheduler = DeadlineScheduler(args.refresh_rate, "Temperature", args.overrun_policy, report_second=60 if DEBUG else 0)
 
     while True:
         try:
-            voltage = sensor.voltage
-            temperature = get_temp_sensor_reading(voltage)
-            
-            print_if_debug("Raw Temperature reading: " + str(temperature), DEBUG)
-            print_if_debug("Raw Voltage reading: " + str(voltage), DEBUG)
-
-            if is_none_or_whitespace(temperature) or is_none_or_whitespace(humidity):
-                raise RuntimeError("Failed to read temperature or humidity")
-
-            # filter value
-            buffer.add(temperature)
-            filtered_temperature = buffer.get(m=args.cutoff_value)
-            print_if_debug("Filtered Temperature: " + str(filtered_temperature), DEBUG)
-
-            # set the values in redis
-            r.set(SensorReadingFieldNames.TEMPERATURE, filtered_temperature, ex=args.expire_time)
-            print_if_debug("Set Temperature and Humidity to redis", DEBUG)
+            reader.read()
+            publisher.tick()
+            log.debug("Set Temperature and Humidity to redis")
         except RuntimeError as error:
+            # wait for the next tick like a successful read, retrying at once would spin on the ADC
             print(error.args[0])
-            continue
         except Exception as error:
-            buffer.reset()
+            reader.buffer.reset()
             raise error
 
-        time.sleep(args.refresh_rate)
+        scheduler.wait()
+
 
 if __name__ == "__main__":
     try:
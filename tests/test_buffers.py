@@ -0,0 +1,76 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buffers import Buffer
+
+
+def reference_mean(values, m: float = 6.0) -> float:
+    """Mean of the window by the median / MAD formula Buffer replaced"""
+    data = np.asarray(values, dtype=float)
+    data = data[~np.isnan(data)]
+    if len(data) == 0:
+        return np.nan
+    with np.errstate(invalid='ignore'):
+        d = np.abs(data - np.median(data))
+        mdev = np.median(d)
+        s = d / (mdev if mdev else 1.)
+        inliers = data[s < m]
+    return float(inliers.mean()) if len(inliers) else np.nan
+
+
+def window(values, size: int):
+    return values[-size:]
+
+
+def test_large_outlier_does_not_cancel_the_inliers():
+    buffer = Buffer(4)
+    values = []
+    for value in (400, 401, 1e20, 402, 403, 404, 405):
+        buffer.add(value)
+        values.append(value)
+        assert buffer.get() == pytest.approx(reference_mean(window(values, 4)))
+    assert buffer.get() == pytest.approx(403.5)
+
+
+def test_infinite_sample_is_rejected():
+    buffer = Buffer(4)
+    values = []
+    for value in (400, 401, 402, np.inf, 403, 404, 405, 406):
+        buffer.add(value)
+        values.append(value)
+        assert buffer.get() == pytest.approx(reference_mean(window(values, 4)))
+
+
+@pytest.mark.parametrize('size', [1, 2, 4, 10, 31])
+def test_matches_reference_with_outliers(size: int):
+    rng = np.random.default_rng(size)
+    values = rng.normal(400, 5, 2000)
+    outliers = rng.random(len(values))
+    values[outliers < 0.05] *= 10.0 ** rng.integers(-20, 21, int(np.count_nonzero(outliers < 0.05)))
+    values[outliers > 0.98] = np.nan
+    values[(outliers > 0.5) & (outliers < 0.502)] = np.inf
+
+    buffer = Buffer(size)
+    for i, value in enumerate(values):
+        buffer.add(value)
+        expected = reference_mean(values[max(0, i + 1 - size):i + 1])
+        actual = buffer.get()
+        if np.isnan(expected):
+            assert np.isnan(actual)
+        else:
+            assert actual == pytest.approx(expected, rel=1e-9)
+
+
+def test_add_many_keeps_the_sum_exact():
+    buffer = Buffer(4)
+    buffer.add_many([400, 1e20, 401, 402, np.inf])
+    assert buffer.get() == pytest.approx(reference_mean([1e20, 401, 402, np.inf]))
+    values = [1e20, 401, 402, np.inf]
+    for value in (403, 404, 405, 406):
+        buffer.add(value)
+        values.append(value)
+        assert buffer.get() == pytest.approx(reference_mean(window(values, 4)))
+    assert buffer.get() == pytest.approx(404.5)
@@ -0,0 +1,225 @@
+import math
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from buffers import Buffer
+from filters import BufferFilter, CICDecimator, EMAFilter, FIRDecimator, KalmanFilter, OutlierFilter, parse_filter_chain
+
+
+def make_stream(count: int = 2000, seed: int = 0, nan: bool = True) -> np.ndarray:
+    """Noisy ramp with occasional outliers and nan samples"""
+    rng = np.random.default_rng(seed)
+    values = 400 + 0.05 * np.arange(count) + rng.normal(0, 5, count)
+    values[rng.random(count) < 0.01] *= 50
+    if nan:
+        values[rng.random(count) < 0.02] = np.nan
+    return values
+
+
+def split(values: np.ndarray, seed: int = 1):
+    """Split a stream into blocks of random sizes, one sample blocks included"""
+    rng = np.random.default_rng(seed)
+    start = 0
+    while start < len(values):
+        size = int(rng.choice([1, 1, 2, 3, 7, 16, 64, 300]))
+        yield values[start:start + size]
+        start += size
+
+
+def run_blocks(stage, values: np.ndarray, seed: int = 1) -> np.ndarray:
+    return np.concatenate([stage.process(block) for block in split(values, seed)])
+
+
+def fill_nan(values: np.ndarray) -> np.ndarray:
+    """Repeat the previous sample in place of nan, nan before the first sample"""
+    out = np.array(values, dtype=float)
+    for i in range(1, len(out)):
+        if math.isnan(out[i]):
+            out[i] = out[i - 1]
+    return out
+
+
+def reference_ema(values: np.ndarray, alpha: float) -> np.ndarray:
+    out = np.empty(len(values))
+    y = math.nan
+    for i, x in enumerate(fill_nan(values)):
+        if math.isnan(y):
+            y = x
+        elif not math.isnan(x):
+            y += alpha * (x - y)
+        out[i] = y
+    return out
+
+
+def reference_kalman(values: np.ndarray, q: float, r: float, dt: float) -> np.ndarray:
+    f = np.array([[1., dt], [0., 1.]])
+    noise = q * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+    h = np.array([[1., 0.]])
+    x = None
+    p = None
+    out = np.empty(len(values))
+    for i, z in enumerate(values):
+        if x is None:
+            if not math.isnan(z):
+                x = np.array([z, 0.])
+                p = np.diag([r, r])
+            out[i] = x[0] if x is not None else math.nan
+            continue
+        x = f @ x
+        p = f @ p @ f.T + noise
+        if not math.isnan(z):
+            k = p @ h.T / (h @ p @ h.T + r)
+            x = x + (k * (z - h @ x)).ravel()
+            p = (np.eye(2) - k @ h) @ p
+        out[i] = x[0]
+    return out
+
+
+def reference_decimate(values: np.ndarray, taps: np.ndarray, factor: int) -> np.ndarray:
+    """Keep every factor-th output of the FIR filter, the stream extended back by its first sample"""
+    x = fill_nan(values)
+    taps = np.asarray(taps, dtype=float) / np.sum(taps)
+    out = []
+    for k in range(factor - 1, len(x), factor):
+        out.append(sum(taps[j] * x[max(k - j, 0)] for j in range(len(taps))))
+    return np.array(out)
+
+
+def reference_cic(values: np.ndarray, factor: int, order: int) -> np.ndarray:
+    """Cascade of moving sums of factor samples, then keep every factor-th output"""
+    x = fill_nan(values)
+    pad = order * (factor - 1)
+    y = np.concatenate((np.full(pad, x[0]), x))
+    for _ in range(order):
+        y = np.array([y[max(i - factor + 1, 0):i + 1].sum() for i in range(len(y))])
+    y = y[pad:] / factor ** order
+    return y[factor - 1::factor]
+
+
+def reference_buffer_mean(values: np.ndarray, m: float = 6.0) -> float:
+    data = values[~np.isnan(values)]
+    if len(data) == 0:
+        return math.nan
+    d = np.abs(data - np.median(data))
+    mdev = np.median(d)
+    s = d / (mdev if mdev else 1.)
+    return float(data[s < m].mean())
+
+
+def assert_same(actual: np.ndarray, expected: np.ndarray) -> None:
+    assert len(actual) == len(expected)
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize('alpha', [0.01, 0.1, 0.5, 1.0])
+def test_ema_filter_matches_reference(alpha: float):
+    values = make_stream()
+    values[:3] = np.nan
+    assert_same(run_blocks(EMAFilter(alpha), values), reference_ema(values, alpha))
+
+
+def test_ema_filter_alpha_one_is_identity():
+    stage = EMAFilter(1.0)
+    assert np.array_equal(stage.process(np.array([1., 2., 3.])), [1., 2., 3.])
+    assert np.array_equal(stage.process(np.array([np.nan, 4.])), [3., 4.])
+
+
+def test_ema_filter_long_block_stays_in_range():
+    values = make_stream(20000, nan=False)
+    assert_same(EMAFilter(0.5).process(values), reference_ema(values, 0.5))
+
+
+@pytest.mark.parametrize('dt', [0.05, 1.0])
+def test_kalman_filter_matches_reference(dt: float):
+    values = make_stream(500)
+    values[:2] = np.nan
+    stage = KalmanFilter(0.5, 25.0, dt)
+    assert_same(run_blocks(stage, values), reference_kalman(values, 0.5, 25.0, dt))
+
+
+@pytest.mark.parametrize('factor', [1, 4, 16])
+def test_fir_decimator_matches_reference(factor: int):
+    values = make_stream(1000)
+    stage = FIRDecimator(factor)
+    expected = reference_decimate(values, stage.kernel[::-1], factor)
+    assert_same(run_blocks(stage, values), expected)
+
+
+@pytest.mark.parametrize('factor,order', [(2, 1), (4, 3), (8, 2)])
+def test_cic_decimator_matches_reference(factor: int, order: int):
+    values = make_stream(1000)
+    assert_same(run_blocks(CICDecimator(factor, order), values), reference_cic(values, factor, order))
+
+
+def test_outlier_filter_matches_reference_on_long_blocks():
+    values = make_stream()
+    stage = OutlierFilter(6, min_block=5)
+    for block in np.array_split(values, 40):
+        valid = block[~np.isnan(block)]
+        center = np.median(valid)
+        mdev = np.median(np.abs(valid - center))
+        with np.errstate(invalid='ignore'):
+            expected = np.where(np.abs(block - center) >= 6 * (mdev if mdev else 1.), center, block)
+        assert_same(stage.process(block), expected)
+
+
+def test_outlier_filter_one_sample_per_block():
+    rng = np.random.default_rng(0)
+    values = rng.normal(400, 5, 50)
+    values[20] = 1e6
+
+    stage = OutlierFilter(6)
+    out = np.concatenate([stage.process(np.array([value])) for value in values])
+    assert np.isfinite(stage.scale)
+    assert out[20] < 500
+    # the samples before the first MAD pass unchanged
+    assert np.array_equal(out[:4], values[:4])
+
+
+def test_outlier_filter_nan_passes_through():
+    stage = OutlierFilter(6)
+    out = stage.process(np.array([np.nan, 1., 2., 3., 4., 5., np.nan]))
+    assert np.isnan(out[0]) and np.isnan(out[-1])
+    assert np.isnan(OutlierFilter(6).process(np.array([np.nan]))[0])
+
+
+@pytest.mark.parametrize('size', [1, 10, 50])
+def test_buffer_filter_matches_reference(size: int):
+    values = make_stream(1000)
+    stage = BufferFilter(size)
+    seen = []
+    for block in split(values):
+        seen.extend(block.tolist())
+        out = stage.process(block)
+        assert_same(out, [reference_buffer_mean(np.array(seen[-size:]))])
+
+
+def test_buffer_filter_is_the_buffer_of_the_services():
+    values = make_stream(300)
+    stage = BufferFilter(10)
+    buffer = Buffer(10)
+    for value in values:
+        buffer.add(value)
+        assert_same(stage.process(np.array([value])), [buffer.get()])
+
+
+def test_filter_chain_matches_its_stages():
+    values = make_stream()
+    chain = parse_filter_chain(['outlier:6', 'cic:4:3', 'ema:0.2'])
+    stages = [OutlierFilter(6), CICDecimator(4, 3), EMAFilter(0.2)]
+    for block in split(values):
+        expected = block
+        for stage in stages:
+            if len(expected) == 0:
+                break
+            expected = stage.process(expected)
+        assert_same(chain.process(block), expected)
+
+
+@pytest.mark.parametrize('spec', ['ema:0.1:0.2', 'ema:x', 'ema:2', 'fir'])
+def test_parse_filter_chain_rejects_invalid_arguments(spec: str):
+    with pytest.raises(ValueError, match='Invalid filter stage'):
+        parse_filter_chain([spec])
@@ -0,0 +1,148 @@
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class FieldPolicy:
+    """Transmission policy of one sensor field"""
+
+    def __init__(self, absolute_deadband: float = 0.0, relative_deadband: float = 0.0, max_silence: float = 1.0, priority: int = 0):
+        """Initialize the policy
+
+        Args:
+            absolute_deadband (float, optional): change smaller or equal to this is not sent. Defaults to 0.0.
+            relative_deadband (float, optional): change smaller or equal to this fraction of the last sent value is not sent. Defaults to 0.0.
+            max_silence (float, optional): seconds after which the value is resent even if unchanged. Defaults to 1.0.
+            priority (int, optional): fields with higher priority are sent first when the byte budget is short. Defaults to 0.
+        """
+        self.absolute_deadband = absolute_deadband
+        self.relative_deadband = relative_deadband
+        self.max_silence = max_silence
+        self.priority = priority
+
+    @staticmethod
+    def parse(spec: str, default: Optional["FieldPolicy"] = None) -> Tuple[str, "FieldPolicy"]:
+        """Parse a FIELD=ABSOLUTE:RELATIVE:MAX_SILENCE:PRIORITY policy. Omitted values are those of the default policy
+
+        Args:
+            spec (str): policy specification, e.g. GAS_PPM=0.5:0.01:2:10
+            default (Optional[FieldPolicy], optional): policy of the fields without one. Defaults to FieldPolicy().
+
+        Returns:
+            Tuple[str, FieldPolicy]: field name and policy
+        """
+        default = default or FieldPolicy()
+        name, _, values = spec.partition('=')
+        values = values.split(':')
+        keys = ('absolute_deadband', 'relative_deadband', 'max_silence', 'priority')
+        kwargs = {key: getattr(default, key) for key in keys}
+        for key, value, cast in zip(keys, values, (float, float, float, int)):
+            if value.strip():
+                kwargs[key] = cast(value)
+        return name.strip(), FieldPolicy(**kwargs)
+
+
+class TransmissionScheduler:
+    """Decides which sensor fields are sent each tick
+
+    A field is due when it has never been sent, when it moved outside its deadband since the
+    last sent value, or when it has been silent for its max silence. A nan is sent once and not
+    repeated until a number has been sent again. Due fields are sent by priority while a token
+    bucket of bytes per second allows, the rest stay due for the next tick. In packed mode all
+    due fields share one message, which is sent whole or not at all.
+    """
+
+    def __init__(self, policies: Dict[str, FieldPolicy], default_policy: Optional[FieldPolicy] = None,
+                 byte_budget: float = 0.0, message_bytes: int = 26, packed: bool = False):
+        """Initialize the scheduler
+
+        Args:
+            policies (Dict[str, FieldPolicy]): policy of each field name
+            default_policy (Optional[FieldPolicy], optional): policy of fields without one. Defaults to FieldPolicy().
+            byte_budget (float, optional): bytes per second available for sensor messages, 0 for unlimited. Defaults to 0.0.
+            message_bytes (int, optional): bytes of one message on the link. Defaults to 26, a MAVLink 1 NAMED_VALUE_FLOAT.
+            packed (bool, optional): all fields of a tick are sent in one message. Defaults to False.
+        """
+        self.policies = policies
+        self.default_policy = default_policy or FieldPolicy()
+        self.byte_budget = byte_budget
+        self.message_bytes = message_bytes
+        self.packed = packed
+        self.tokens = byte_budget
+        self.last_refill: Optional[float] = None
+        self.last_value: Dict[str, float] = dict()
+        self.last_time: Dict[str, float] = dict()
+
+    def get_policy(self, name: str) -> FieldPolicy:
+        """Get the policy of a field name"""
+        return self.policies.get(name, self.default_policy)
+
+    def is_due(self, name: str, value: float, now: float) -> bool:
+        """Check if a value of a field should be sent
+
+        Args:
+            name (str): field name
+            value (float): current value
+            now (float): current monotonic time in seconds
+
+        Returns:
+            bool: True if the value should be sent
+        """
+        if name not in self.last_value:
+            return True
+
+        last = self.last_value[name]
+        if math.isnan(value):
+            return not math.isnan(last)
+        if math.isnan(last):
+            return True
+
+        policy = self.get_policy(name)
+        if now - self.last_time[name] >= policy.max_silence:
+            return True
+
+        deadband = max(policy.absolute_deadband, policy.relative_deadband * abs(last))
+        return abs(value - last) > deadband
+
+    def select(self, values: Dict[str, float], now: float) -> List[str]:
+        """Select the fields to send this tick and record them as sent
+
+        Args:
+            values (Dict[str, float]): current value of each field name
+            now (float): current monotonic time in seconds
+
+        Returns:
+            List[str]: names of the fields to send, highest priority first
+        """
+        due = [name for name, value in values.items() if self.is_due(name, value, now)]
+        # highest priority first, then the field that has waited longest
+        due.sort(key=lambda name: (-self.get_policy(name).priority, self.last_time.get(name, -math.inf)))
+
+        if self.byte_budget > 0:
+            if self.last_refill is not None:
+                self.tokens = min(self.byte_budget, self.tokens + (now - self.last_refill) * self.byte_budget)
+            self.last_refill = now
+            if self.packed:
+                messages = 1 if due and self.tokens >= self.message_bytes else 0
+                due = due if messages else []
+            else:
+                due = due[:int(self.tokens // self.message_bytes)]
+                messages = len(due)
+            self.tokens -= messages * self.message_bytes
+
+        for name in due:
+            self.last_value[name] = values[name]
+            self.last_time[name] = now
+        return due
+
+
+def parse_policies(specs: Iterable[str], default: Optional[FieldPolicy] = None) -> Dict[str, FieldPolicy]:
+    """Parse FIELD=ABSOLUTE:RELATIVE:MAX_SILENCE:PRIORITY policies into a dictionary
+
+    Args:
+        specs (Iterable[str]): policy specifications
+        default (Optional[FieldPolicy], optional): policy the omitted values are taken from. Defaults to FieldPolicy().
+
+    Returns:
+        Dict[str, FieldPolicy]: policy of each field name
+    """
+    return dict(FieldPolicy.parse(spec, default) for spec in specs if spec.strip())
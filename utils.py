@@ -1,63 +1,19 @@
-import redis
+import json
+import math
+import struct
+import time
+import zlib
 from decouple import config
 from enum import Enum
-from typing import Tuple
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 from typing_extensions import Self
-import numpy as np
-import board
-import busio
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+from instrumentation import METRICS
 
-class Buffer:
-    """A circular buffer to store values and get the mean of the buffer without the nan values
-    """
-
-    def __init__(self, size: int):
-        """Initialize the buffer
+if TYPE_CHECKING:
+    # imported by connect_redis, so services without redis do not load it
+    import redis
 
-        Args:
-            size (int): size of the buffer
-        """
-        self.size = size
-        self.buffer = np.empty(size)
-        self.buffer[:] = np.nan
-        self.index = 0
-    
-    def add(self, value: float) -> None:
-        """Add a value to the buffer
-
-        Args:
-            value (float): value to add
-        """
-        self.buffer[self.index] = value
-        self.index = (self.index + 1) % self.size
-    
-    def get(self, m = 6.0) -> float:
-        """Get the mean of the buffer without the nan values and remove outliers
-
-        Args:
-            m (float, optional): Outlier cutoff value. Defaults to 6.0.
-
-        Returns:
-            float: The mean, or nan if the buffer is empty
-        """
-        data = self.buffer[~np.isnan(self.buffer)]
-
-        if len(data) == 0:
-            return np.nan
-        
-        d = np.abs(data - np.median(data))
-        mdev = np.median(d)
-        s = d / (mdev if mdev else 1.)
-        return float(data[s < m].mean())
-
-    
-    def reset(self) -> None:
-        """ Reset the buffer to nan values """
-        self.buffer = np.empty(self.size)
-        self.buffer[:] = np.nan
-        self.index = 0
 
 class SensorReadingFieldNames(str, Enum):
     """
@@ -81,26 +37,6 @@ class SensorReadingFieldNames(str, Enum):
         """
         return tuple(SensorReadingFieldNames)
 
-def init_sensor(pin: ADS) -> AnalogIn:
-    """Initialize the analog gas sensor
-
-    Args:
-        pin (ADS): sensor pin of the plugged in sensor on the ADS1115.
-
-    Returns:
-        AnalogIn: the analog sensor object
-    """
-    # Initialize the I2C bus
-    i2c = busio.I2C(board.SCL, board.SDA)
-
-    # Create the ADC object using the I2C bus
-    ads = ADS.ADS1115(i2c)
-
-    # Define the sensor (Analog input)
-    sensor = AnalogIn(ads, pin)
-
-    return sensor
-
 def get_temp_sensor_reading(voltage: float) -> float:
     """Get the temperature sensor reading
 
@@ -113,7 +49,7 @@ def get_temp_sensor_reading(voltage: float) -> float:
     return 100 * voltage - 50
 
 
-def connect_redis(password: str, debug: bool = False) -> redis.Redis:
+def connect_redis(password: str, debug: bool = False) -> "redis.Redis":
     """
     Connect to redis.
 
@@ -124,6 +60,8 @@ def connect_redis(password: str, debug: bool = False) -> redis.Redis:
     Returns:
         redis.Redis: redis connection
     """
+    import redis
+
     host = config("REDIS_HOST", default="127.0.0.1")
     port = config("REDIS_PORT", default=6379, cast=int)
     r = redis.Redis(host=host, port=port, db=0, password=password)
@@ -140,6 +78,481 @@ def connect_redis(password: str, debug: bool = False) -> redis.Redis:
         return r
 
 
+# sensor updates channels of the services, see RedisPublisher and FieldCache
+GAS_UPDATES_CHANNEL = "SENSOR_UPDATES_GAS"
+TEMP_UPDATES_CHANNEL = "SENSOR_UPDATES_TEMP"
+SENSOR_UPDATES_CHANNELS = (GAS_UPDATES_CHANNEL, TEMP_UPDATES_CHANNEL)
+
+
+def encode_sensor_update(values: Dict[str, Tuple[float, float]]) -> str:
+    """Encode sensor values for a sensor updates channel
+
+    Args:
+        values (Dict[str, Tuple[float, float]]): value and sensor timestamp of each field
+
+    Returns:
+        str: encoded message
+    """
+    return json.dumps({getattr(key, 'value', key): [float(value), timestamp] for key, (value, timestamp) in values.items()})
+
+
+def decode_sensor_update(message: Union[str, bytes]) -> Dict[str, Tuple[float, float]]:
+    """Decode a message from a sensor updates channel
+
+    Args:
+        message (Union[str, bytes]): encoded message
+
+    Returns:
+        Dict[str, Tuple[float, float]]: value and sensor timestamp of each field
+    """
+    return {key: (value, timestamp) for key, (value, timestamp) in json.loads(message).items()}
+
+
+# history streams of the services, see RedisPublisher and HistoryReader
+GAS_HISTORY_STREAM = "HISTORY_GAS"
+TEMP_HISTORY_STREAM = "HISTORY_TEMP"
+
+
+class HistoryRecord(NamedTuple):
+    """Values set in one loop tick, read back from a history stream"""
+    stream: str
+    id: str
+    timestamp: float
+    values: Dict[str, float]
+
+
+def get_history_schema_key(stream: str) -> str:
+    """Get the redis hash holding the field names of each schema id of a history stream"""
+    return f"{stream}_SCHEMA"
+
+
+def get_history_schema_id(fields: Tuple[str, ...]) -> str:
+    """Get the id of an ordered set of field names, the stream entry field of its records"""
+    return f"{zlib.crc32(','.join(fields).encode()):08x}"
+
+
+@lru_cache(maxsize=None)
+def _history_struct(count: int) -> struct.Struct:
+    return struct.Struct(f'<d{count}f')
+
+
+def pack_history_record(timestamp: float, values: Iterable[float]) -> bytes:
+    """Pack the values of a tick as a float64 unix timestamp followed by one float32 per field, little endian
+
+    Args:
+        timestamp (float): sensor time of the tick
+        values (Iterable[float]): values in the order of the schema
+
+    Returns:
+        bytes: the record
+    """
+    values = tuple(values)
+    return _history_struct(len(values)).pack(timestamp, *values)
+
+
+def unpack_history_record(data: bytes, fields: Tuple[str, ...]) -> Tuple[float, Dict[str, float]]:
+    """Unpack a record of pack_history_record
+
+    Args:
+        data (bytes): the record
+        fields (Tuple[str, ...]): field names of its schema
+
+    Raises:
+        ValueError: if the record does not have one value per field
+
+    Returns:
+        Tuple[float, Dict[str, float]]: timestamp and value of each field
+    """
+    layout = _history_struct(len(fields))
+    if len(data) != layout.size:
+        raise ValueError(f"History record of {len(data)} bytes does not match its {len(fields)} fields")
+    timestamp, *values = layout.unpack(data)
+    return timestamp, dict(zip(fields, values))
+
+
+class RedisPublisher:
+    """Collects the redis writes of a loop tick and sends them in one pipelined transaction
+
+    Writes to the same key within a batch are coalesced, only the latest value is sent.
+    If a channel is given, the values are also published on it in the same transaction
+    together with the time they were set, so forwarders can react to updates instead of polling.
+
+    With a history stream, the values of every tick are also appended to the stream as one
+    binary record, see pack_history_record, so readers get every tick even when the keys were
+    overwritten in between, see HistoryReader. The stream is trimmed to about history_maxlen
+    records, and the field names of each record layout are kept in a hash next to it, see
+    get_history_schema_key.
+    """
+
+    def __init__(self, r: "redis.Redis", expire_time: Optional[int] = None, batch_ticks: int = 1, channel: Optional[str] = None,
+                 history: Optional[str] = None, history_maxlen: int = 0):
+        """Initialize the publisher
+
+        Args:
+            r (redis.Redis): redis connection
+            expire_time (Optional[int], optional): default expire time for the keys in seconds. Defaults to None.
+            batch_ticks (int, optional): number of ticks to collect before sending. Defaults to 1.
+            channel (Optional[str], optional): pub/sub channel to announce updates on. Defaults to None.
+            history (Optional[str], optional): stream to append the values of each tick to. Defaults to None.
+            history_maxlen (int, optional): approximate number of records kept in the stream, 0 to not append. Defaults to 0.
+        """
+        self.r = r
+        self.expire_time = expire_time
+        self.batch_ticks = max(1, batch_ticks)
+        self.channel = channel
+        self.history = history if history_maxlen > 0 else None
+        self.history_maxlen = history_maxlen
+        self.pending: Dict[str, Tuple[float, Optional[int], float]] = dict()
+        # values and latest timestamp of the current tick, then the records of the closed ticks
+        self.record: Dict[str, float] = dict()
+        self.record_time = 0.0
+        self.records: List[Tuple[float, Dict[str, float]]] = []
+        self.schemas = set()
+        self.ticks = 0
+        self.rtt_timer = METRICS.timer("redis_publish_ms", "redis round trip of a publisher flush")
+        self.history_counter = METRICS.counter("history_records_total", "records appended to the history streams")
+
+    def set(self, key: str, value: float, ex: Optional[int] = None, timestamp: Optional[float] = None) -> None:
+        """Queue a value to be written on the next flush
+
+        Args:
+            key (str): redis key
+            value (float): value to write
+            ex (Optional[int], optional): expire time in seconds. Defaults to the publisher expire time.
+            timestamp (Optional[float], optional): time the value was read, announced on the channel. Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        self.pending[key] = (value, self.expire_time if ex is None else ex, timestamp)
+        if self.history is not None:
+            self.record[getattr(key, 'value', key)] = value
+            self.record_time = max(self.record_time, timestamp)
+
+    def close_record(self) -> None:
+        """Queue the values set since the last record as one history record"""
+        if self.record:
+            self.records.append((self.record_time, self.record))
+            self.record = dict()
+            self.record_time = 0.0
+            # records of failed flushes are sent with the next one, up to the length of the stream
+            if len(self.records) > self.history_maxlen:
+                del self.records[:-self.history_maxlen]
+
+    def tick(self) -> bool:
+        """Mark the end of a loop tick and flush once batch_ticks ticks are collected
+
+        Returns:
+            bool: True if the pending writes were sent
+        """
+        self.close_record()
+        self.ticks += 1
+        if self.ticks < self.batch_ticks:
+            return False
+
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        """Send all pending writes in one pipelined transaction"""
+        self.ticks = 0
+        self.close_record()
+        if not self.pending:
+            return
+
+        pipe = self.r.pipeline(transaction=True)
+        for key, (value, ex, _) in self.pending.items():
+            pipe.set(key, value, ex=ex)
+        if self.channel is not None:
+            update = {key: (value, timestamp) for key, (value, _, timestamp) in self.pending.items()}
+            pipe.publish(self.channel, encode_sensor_update(update))
+        schemas = set()
+        for timestamp, record in self.records:
+            fields = tuple(record)
+            schema = get_history_schema_id(fields)
+            if schema not in self.schemas and schema not in schemas:
+                pipe.hset(get_history_schema_key(self.history), schema, ','.join(fields))
+                schemas.add(schema)
+            # MAXLEN ~ trims whole macro nodes only, much cheaper than an exact length
+            pipe.xadd(self.history, {schema: pack_history_record(timestamp, record.values())}, maxlen=self.history_maxlen, approximate=True)
+        start = self.rtt_timer.start()
+        pipe.execute()
+        self.rtt_timer.stop(start)
+        self.schemas.update(schemas)
+        self.history_counter.inc(len(self.records))
+        self.pending.clear()
+        self.records.clear()
+
+
+def get_fields(r: "redis.Redis", fields: Iterable[str]) -> Dict[str, Optional[bytes]]:
+    """Get several keys from redis in a single MGET
+
+    Args:
+        r (redis.Redis): redis connection
+        fields (Iterable[str]): keys to get
+
+    Returns:
+        Dict[str, Optional[bytes]]: value of each key, None if the key does not exist
+    """
+    fields = tuple(fields)
+    return dict(zip(fields, r.mget(fields)))
+
+
+class FieldCache:
+    """Local copy of redis fields, kept up to date by a sensor updates channel
+
+    The fields are read once with their TTL, then every update a RedisPublisher announces on
+    the channel replaces the cached value, so reading a field costs no round trip. A cached
+    value expires like its redis key: the TTL of each field is measured on its first update
+    and the fields are read again every resync_second, which also covers updates missed while
+    disconnected. Expired, too old or missing fields read as their default.
+    """
+
+    def __init__(self, r: "redis.Redis", defaults: Dict[str, float], channel: str = TEMP_UPDATES_CHANNEL,
+                 max_age: Optional[float] = None, resync_second: float = 60):
+        """Initialize the cache
+
+        Args:
+            r (redis.Redis): redis connection
+            defaults (Dict[str, float]): cached fields and the value of each when missing or stale
+            channel (str, optional): pub/sub channel of the updates, the fields set by other publishers are not decoded. Defaults to TEMP_UPDATES_CHANNEL.
+            max_age (Optional[float], optional): seconds after the sensor read a value goes stale, on top of the TTL. Defaults to None.
+            resync_second (float, optional): seconds between two reads of every field from redis. Defaults to 60.
+        """
+        self.r = r
+        self.defaults = {getattr(key, 'value', key): value for key, value in defaults.items()}
+        self.channel = channel
+        self.max_age = max_age
+        self.resync_second = resync_second
+        # value, sensor timestamp and expire time of each field, unix times
+        self.values: Dict[str, Tuple[float, float, float]] = dict()
+        self.ttl: Dict[str, Optional[float]] = dict()
+        self.pubsub: Optional["redis.client.PubSub"] = None
+        # redis is imported by the connection already, looked up here to keep it out of the module imports
+        from redis.exceptions import ConnectionError as RedisConnectionError
+        self.connection_error = RedisConnectionError
+        self.next_resync = 0.0
+        self.updates = 0
+        self.round_trips = 0
+        self.rtt_timer = METRICS.timer("redis_sync_ms", "redis round trip of a field cache sync")
+
+    def sync(self) -> None:
+        """Read every field and its remaining TTL in one pipelined round trip"""
+        pipe = self.r.pipeline(transaction=False)
+        for key in self.defaults:
+            pipe.get(key)
+            pipe.pttl(key)
+        start = self.rtt_timer.start()
+        replies = pipe.execute()
+        self.rtt_timer.stop(start)
+        self.round_trips += 1
+
+        now = time.time()
+        for key, value, pttl in zip(self.defaults, replies[0::2], replies[1::2]):
+            value = convert_to_float_or_default(value)
+            if math.isnan(value):
+                self.values.pop(key, None)
+                continue
+            # -1 is a key without expire time
+            expires = now + pttl / 1000 if pttl >= 0 else math.inf
+            # the sensor read time is not stored with the key, keep the one of the last update
+            timestamp = self.values[key][1] if key in self.values else now
+            self.values[key] = (value, timestamp, expires)
+        self.next_resync = now + self.resync_second
+
+    def measure_ttl(self, key: str) -> None:
+        """Measure the TTL of a field right after its update set it"""
+        pttl = self.r.pttl(key)
+        self.round_trips += 1
+        self.ttl[key] = pttl / 1000 if pttl >= 0 else None
+
+    def poll(self) -> None:
+        """Apply the updates received since the last poll without waiting
+
+        Subscribes and reads every field on the first poll and after a lost connection.
+        """
+        try:
+            if self.pubsub is None:
+                # subscribe before reading, so no update falls in between
+                self.pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(self.channel)
+                self.sync()
+
+            while True:
+                message = self.pubsub.get_message(timeout=0)
+                if message is None:
+                    break
+                now = time.time()
+                for key, (value, timestamp) in decode_sensor_update(message['data']).items():
+                    if key not in self.defaults:
+                        continue
+                    if key not in self.ttl:
+                        self.measure_ttl(key)
+                    ttl = self.ttl[key]
+                    self.values[key] = (value, timestamp, now + ttl if ttl is not None else math.inf)
+                    self.updates += 1
+
+            if time.time() >= self.next_resync:
+                self.sync()
+        except self.connection_error:
+            # keep the cached values until they expire, subscribe again on the next poll
+            if self.pubsub is not None:
+                self.pubsub.close()
+            self.pubsub = None
+
+    def get(self, key: str) -> float:
+        """Get the cached value of a field, or its default if missing, expired or too old
+
+        Args:
+            key (str): field name
+
+        Returns:
+            float: the value
+        """
+        key = getattr(key, 'value', key)
+        if key not in self.values:
+            return self.defaults[key]
+        value, timestamp, expires = self.values[key]
+        now = time.time()
+        if now >= expires or (self.max_age is not None and now - timestamp > self.max_age) or math.isnan(value):
+            return self.defaults[key]
+        return value
+
+    def age(self, key: str) -> float:
+        """Seconds since the sensor read the cached value of a field, inf if missing
+
+        A value only known from a sync is aged from the time of the sync.
+
+        Args:
+            key (str): field name
+
+        Returns:
+            float: the age
+        """
+        key = getattr(key, 'value', key)
+        if key not in self.values:
+            return math.inf
+        return time.time() - self.values[key][1]
+
+
+def _history_id(position: Union[str, float, None], default: str) -> str:
+    """Get the stream id of a range bound given as a stream id or unix seconds"""
+    if position is None:
+        return default
+    if isinstance(position, (int, float)):
+        return str(int(position * 1000))
+    return position
+
+
+def _next_history_id(entry_id: str) -> str:
+    """Get the smallest stream id after an id, the exclusive start of the next page"""
+    ms, _, sequence = entry_id.partition('-')
+    return f"{ms}-{int(sequence or 0) + 1}"
+
+
+class HistoryReader:
+    """Reads the records of history streams in bulk, see RedisPublisher
+
+    range returns the records between two times or ids, read returns the records appended
+    since the last read, so a consumer gets every tick once. The field names of each record
+    layout are read once from the schema hash of its stream and cached. Records of an unknown
+    layout are skipped and counted.
+
+    Stream ids are the redis time of the append, milliseconds after the sensor time of the
+    record. Records trimmed from a stream before being read are lost, size the stream for the
+    longest pause of the readers.
+    """
+
+    def __init__(self, r: "redis.Redis", streams: Iterable[str], start: str = '$'):
+        """Initialize the reader
+
+        Args:
+            r (redis.Redis): redis connection
+            streams (Iterable[str]): history streams to read
+            start (str, optional): id read returns the records after, '$' for the records appended from now, '0' for every record. Defaults to '$'.
+        """
+        self.r = r
+        self.last_ids: Dict[str, str] = {stream: start for stream in streams}
+        self.schemas: Dict[Tuple[str, str], Tuple[str, ...]] = dict()
+        self.skipped = 0
+
+    def get_schema(self, stream: str, schema: str) -> Optional[Tuple[str, ...]]:
+        """Get the field names of a record layout, None if unknown"""
+        key = (stream, schema)
+        if key not in self.schemas:
+            fields = self.r.hget(get_history_schema_key(stream), schema)
+            if fields is None:
+                return None
+            self.schemas[key] = tuple(fields.decode().split(','))
+        return self.schemas[key]
+
+    def decode(self, stream: str, entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[HistoryRecord]:
+        """Decode the entries of a stream into records, skipping the unknown layouts"""
+        records = []
+        for entry_id, entry in entries:
+            entry_id = entry_id.decode()
+            for schema, data in entry.items():
+                fields = self.get_schema(stream, schema.decode())
+                try:
+                    if fields is None:
+                        raise ValueError(f"Unknown history schema {schema}")
+                    timestamp, values = unpack_history_record(data, fields)
+                except ValueError:
+                    self.skipped += 1
+                    continue
+                records.append(HistoryRecord(stream, entry_id, timestamp, values))
+        return records
+
+    def range(self, stream: str, start: Union[str, float, None] = None, end: Union[str, float, None] = None,
+              count: Optional[int] = None, page: int = 10000) -> List[HistoryRecord]:
+        """Get the records of a stream between two positions, oldest first
+
+        Args:
+            stream (str): history stream
+            start (Union[str, float, None], optional): first stream id or unix time in seconds. Defaults to the oldest record.
+            end (Union[str, float, None], optional): last stream id or unix time in seconds, included. Defaults to the newest record.
+            count (Optional[int], optional): maximum number of records. Defaults to every record.
+            page (int, optional): records fetched per round trip. Defaults to 10000.
+
+        Returns:
+            List[HistoryRecord]: the records
+        """
+        start, end = _history_id(start, '-'), _history_id(end, '+')
+        records = []
+        while count is None or len(records) < count:
+            size = page if count is None else min(page, count - len(records))
+            entries = self.r.xrange(stream, start, end, count=size)
+            records.extend(self.decode(stream, entries))
+            if len(entries) < size:
+                break
+            start = _next_history_id(entries[-1][0].decode())
+        return records
+
+    def read(self, count: int = 10000, block: Optional[float] = None) -> List[HistoryRecord]:
+        """Get the records appended to the streams since the last read
+
+        Args:
+            count (int, optional): maximum number of records per stream. Defaults to 10000.
+            block (Optional[float], optional): seconds to wait for a record if there is none, None to not wait. Defaults to None.
+
+        Returns:
+            List[HistoryRecord]: the records, oldest first in each stream
+        """
+        if '$' in self.last_ids.values():
+            # resolve the start to the last id now, or records appended between two reads would be missed
+            for stream, last_id in self.last_ids.items():
+                if last_id == '$':
+                    newest = self.r.xrevrange(stream, count=1)
+                    self.last_ids[stream] = newest[0][0].decode() if newest else '0'
+
+        replies = self.r.xread(self.last_ids, count=count, block=None if block is None else max(1, int(block * 1000)))
+        records = []
+        for stream, entries in replies or ():
+            stream = stream.decode() if isinstance(stream, bytes) else stream
+            if entries:
+                self.last_ids[stream] = entries[-1][0].decode()
+                records.extend(self.decode(stream, entries))
+        return records
+
+
 def is_float(value: str) -> bool:
     """Check if the value is a float
 